@@ -0,0 +1,70 @@
+;;;; Lisp-side benchmarks of cl4py.
+;;;;
+;;;; This file is loaded into the Lisp process by benchmarks.py.  Each
+;;;; benchmark function returns the time per call in seconds, measured
+;;;; without any communication with Python.
+
+(in-package #:cl4py)
+
+(defun benchmark-seconds (function number)
+  (funcall function) ; Warm up.
+  (let ((start (get-internal-real-time)))
+    (loop repeat number do (funcall function))
+    (/ (float (- (get-internal-real-time) start) 1d0)
+       internal-time-units-per-second
+       number)))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Printing
+
+(defun pyprint-benchmark-data (kind size)
+  (ecase kind
+    (:list (loop for i below size collect i))
+    (:nested (loop for i below size collect (list i (list i i))))
+    (:strings (loop for i below size collect (princ-to-string i)))
+    (:string (make-string size :initial-element #\x))
+    (:escaped-string
+     (let ((string (make-string size :initial-element #\x)))
+       (loop for i below size by 10 do (setf (char string i) #\"))
+       string))
+    (:vector (make-array size :initial-element 1.5d0))
+    (:shared (let ((cons (list 1 2)))
+               (loop repeat size collect cons)))))
+
+(defun pyprint-benchmark (kind size number &optional (circle t))
+  (let ((data (pyprint-benchmark-data kind size))
+        (stream (make-string-output-stream))
+        (*pyprint-circle* circle))
+    (benchmark-seconds
+     (lambda ()
+       (pyprint data stream)
+       (get-output-stream-string stream))
+     number)))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Decoding
+
+;;; Return the text of a request, as it would be written by LISPIFY.
+(defun decode-benchmark-text (kind size)
+  (with-output-to-string (stream)
+    (write-string "(" stream)
+    (loop for i below size do
+      (ecase kind
+        (:list (format stream "~D " i))
+        (:symbols (format stream "|CL-USER|::|SYMBOL-~D| " (mod i 100)))
+        (:strings (format stream "\"string ~D\" " i))
+        (:nested (format stream "(~D (|COMMON-LISP|::|LIST| ~D)) " i i))
+        (:vector (format stream "#(~D ~D) " i i))))
+    (write-string ")" stream)))
+
+(defun decode-benchmark (kind size number &optional (decoder :decode))
+  (let ((text (decode-benchmark-text kind size)))
+    (benchmark-seconds
+     (ecase decoder
+       (:decode (lambda () (decode-request text #())))
+       (:read (lambda ()
+                (let ((*readtable* *cl4py-readtable*))
+                  (read-from-string text)))))
+     number)))
@@ -0,0 +1,296 @@
+"""The cl4py benchmark suite.
+
+Run it with
+
+    python bench/benchmarks.py --output results.json
+
+and compare two runs with
+
+    python bench/benchmarks.py --compare old.json new.json
+
+Each benchmark is repeated several times, and the minimum, median and mean
+time per iteration are reported in seconds.  Benchmarks that process data
+also report their throughput in items or bytes per second.  The suite
+needs a working Lisp, but no network access.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import cl4py # pylint: disable=wrong-import-position
+from cl4py.writer import lispify # pylint: disable=wrong-import-position
+
+
+# A list of (name, function) tuples.  Each function receives the options
+# and a Lisp object, and returns a dict of results.
+benchmarks = []
+
+
+def benchmark(name):
+    def register(function):
+        benchmarks.append((name, function))
+        return function
+    return register
+
+
+def measure(function, options, number=None, items=None, size=None):
+    """Call FUNCTION NUMBER times per repetition and return a dict with the
+time per call.  ITEMS and SIZE describe the work done per call."""
+    function() # Warm up.
+    if number is None:
+        # Aim for repetitions of about a tenth of a second.
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        number = max(1, min(10000, int(0.1 / max(elapsed, 1e-7))))
+    timings = []
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    result = {'number': number,
+              'repeat': options.repeat,
+              'min': min(timings),
+              'median': statistics.median(timings),
+              'mean': statistics.mean(timings)}
+    if items is not None:
+        result['items'] = items
+        result['items_per_second'] = items / result['min']
+    if size is not None:
+        result['bytes'] = size
+        result['bytes_per_second'] = size / result['min']
+    return result
+
+
+### Round Trips
+
+@benchmark('startup')
+def bench_startup(options, lisp):
+    # pylint: disable=unused-argument
+    def start():
+        cl4py.Lisp(framed=not options.text).terminate()
+    return measure(start, options, number=1)
+
+
+@benchmark('eval/empty')
+def bench_empty_eval(options, lisp):
+    return measure(lambda: lisp.eval(()), options)
+
+
+@benchmark('eval/arithmetic')
+def bench_arithmetic(options, lisp):
+    return measure(lambda: lisp.eval( ('+', 1, 2) ), options)
+
+
+@benchmark('call/wrapper')
+def bench_wrapper_call(options, lisp):
+    add = lisp.function('+')
+    return measure(lambda: add(1, 2), options)
+
+
+@benchmark('call/keywords')
+def bench_keyword_call(options, lisp):
+    make_list = lisp.function('make-list')
+    return measure(lambda: make_list(3, initial_element=1), options)
+
+
+@benchmark('find_package')
+def bench_find_package(options, lisp):
+    return measure(lambda: lisp.find_package('CL'), options, number=1)
+
+
+### Reader and Writer
+
+def sample_data(kind, n):
+    if kind == 'list':
+        return cl4py.List(*range(n))
+    elif kind == 'string':
+        return 'x' * n
+    elif kind == 'dict':
+        return {i: str(i) for i in range(n)}
+    elif kind == 'symbol':
+        return cl4py.List(*(cl4py.Symbol('SYMBOL-{}'.format(i), 'CL-USER')
+                            for i in range(n)))
+    elif kind == 'circular':
+        data = [None] * n
+        for i in range(n):
+            data[i] = [i, data]
+        return data
+    raise ValueError(kind)
+
+
+for kind in ['list', 'string', 'dict', 'symbol', 'circular']:
+    @benchmark('writer/' + kind)
+    def bench_writer(options, lisp, kind=kind):
+        data = sample_data(kind, options.size)
+        return measure(lambda: lispify(lisp, data), options, items=options.size)
+
+    @benchmark('reader/' + kind)
+    def bench_reader(options, lisp, kind=kind):
+        text = lispify(lisp, sample_data(kind, options.size))
+        return measure(lambda: lisp.readtable.read_string(text), options,
+                       items=options.size, size=len(text.encode('utf-8')))
+
+    @benchmark('roundtrip/' + kind)
+    def bench_roundtrip(options, lisp, kind=kind):
+        identity = lisp.function('identity')
+        data = sample_data(kind, options.size)
+        return measure(lambda: identity(cl4py.Quote(data)), options, items=options.size)
+
+
+### Arrays
+
+# All dtypes that are known to the Lisp side, see DEFINE-DTYPE in py.lisp.
+dtypes = ['bool', 'int8', 'int16', 'int32', 'int64',
+          'uint8', 'uint16', 'uint32', 'uint64',
+          'float32', 'float64', 'complex64', 'complex128']
+
+array_sizes = [10, 1000, 100000, 1000000]
+
+for dtype in dtypes:
+    for n in array_sizes:
+        @benchmark('array/{}/{}'.format(dtype, n))
+        def bench_array(options, lisp, dtype=dtype, n=n):
+            identity = lisp.function('identity')
+            array = numpy.arange(n).astype(dtype)
+            return measure(lambda: identity(array), options,
+                           number=max(1, min(100, 10000 // n)),
+                           items=n, size=2 * array.nbytes)
+
+
+for n in array_sizes:
+    @benchmark('bytes/{}'.format(n))
+    def bench_bytes(options, lisp, n=n):
+        identity = lisp.function('identity')
+        data = bytes(n)
+        return measure(lambda: identity(data), options,
+                       number=max(1, min(100, 10000 // n)),
+                       items=n, size=2 * n)
+
+
+### Lisp
+
+# Benchmarks of the Lisp side of cl4py, see benchmarks.lisp.  Their
+# timings are measured within Lisp.
+
+def measure_lisp(lisp, form, options, items=None):
+    """Like measure, but FORM is evaluated in Lisp and returns the time per
+call in seconds."""
+    timings = [lisp.eval(form) for _ in range(options.repeat)]
+    result = {'repeat': options.repeat,
+              'min': min(timings),
+              'median': statistics.median(timings),
+              'mean': statistics.mean(timings)}
+    if items is not None:
+        result['items'] = items
+        result['items_per_second'] = items / result['min']
+    return result
+
+
+for kind in ['list', 'nested', 'strings', 'string', 'escaped-string', 'vector', 'shared']:
+    @benchmark('lisp/pyprint/' + kind)
+    def bench_pyprint(options, lisp, kind=kind):
+        form = ('cl4py::pyprint-benchmark', cl4py.Keyword(kind.upper()),
+                options.size, 10)
+        return measure_lisp(lisp, form, options, items=options.size)
+
+@benchmark('lisp/pyprint/list-without-circle')
+def bench_pyprint_without_circle(options, lisp):
+    form = ('cl4py::pyprint-benchmark', cl4py.Keyword('LIST'), options.size, 10, ())
+    return measure_lisp(lisp, form, options, items=options.size)
+
+
+for kind in ['list', 'symbols', 'strings', 'nested', 'vector']:
+    for decoder in ['decode', 'read']:
+        @benchmark('lisp/{}/{}'.format(decoder, kind))
+        def bench_decode(options, lisp, kind=kind, decoder=decoder):
+            form = ('cl4py::decode-benchmark', cl4py.Keyword(kind.upper()),
+                    options.size, 10, cl4py.Keyword(decoder.upper()))
+            return measure_lisp(lisp, form, options, items=options.size)
+
+
+### Driver
+
+def metadata(lisp):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'lisp': '{} {}'.format(lisp.eval( ('lisp-implementation-type',) ),
+                                   lisp.eval( ('lisp-implementation-version',) )),
+            'protocol': 'framed' if lisp.protocol.framed else 'text',
+            'threaded': lisp.threaded}
+
+
+def run(options):
+    lisp = cl4py.Lisp(framed=not options.text)
+    lisp.function('load')(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       'benchmarks.lisp'))
+    results = {}
+    for name, function in benchmarks:
+        if options.filter and not any(fnmatch.fnmatch(name, pattern)
+                                      for pattern in options.filter):
+            continue
+        results[name] = function(options, lisp)
+        if not options.quiet:
+            print('{:32} {:12.3e} s'.format(name, results[name]['min']),
+                  file=sys.stderr)
+    return {'metadata': metadata(lisp), 'results': results}
+
+
+def compare(old, new):
+    """Print the ratio of the new and old minimum times of each benchmark."""
+    for name, result in new['results'].items():
+        if name in old['results']:
+            ratio = result['min'] / old['results'][name]['min']
+            print('{:32} {:12.3e} s {:8.2f}x'.format(name, result['min'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the cl4py benchmarks.')
+    parser.add_argument('--output', help='The JSON file for the results.')
+    parser.add_argument('--filter', action='append',
+                        help='Only run benchmarks matching this glob pattern.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--size', type=int, default=1000,
+                        help='The number of items for reader and writer benchmarks.')
+    parser.add_argument('--text', action='store_true',
+                        help='Use the text protocol instead of framing.')
+    parser.add_argument('--quiet', action='store_true')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two JSON files instead of running.')
+    options = parser.parse_args()
+    if options.compare:
+        (old, new) = [json.load(open(path)) for path in options.compare]
+        compare(old, new)
+        return
+    results = run(options)
+    if options.output:
+        with open(options.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,7 @@
-from .data import List, DottedList, Quote, Cons, Symbol, Keyword
-from .lisp import Lisp
-
+from .data import List, DottedList, Quote, Cons, Symbol, Keyword, StaleHandleError
+from .protocol import ProtocolError, DecodeError
+from .lisp import Lisp, LispFuture, LispTimeoutError, LispCancelledError, LispTerminatedError, serve
+from .pool import ConnectionPool, connect
+from .supervisor import Supervisor
+from .memoize import MemoizedFunction
+from .writer import register_encoder, unregister_encoder
@@ -1,5 +1,5 @@
 import io
-import numpy
+import sys
 from .data import *
 
 
@@ -33,7 +33,9 @@ instances.
         atom = not (isinstance(obj, Cons) or
                     isinstance(obj, list) or
                     (isinstance(obj, tuple) and len(obj) > 0) or
-                    isinstance(obj, dict))
+                    isinstance(obj, dict) or
+                    isinstance(obj, LispStructure) or
+                    (is_ndarray(obj) and obj.dtype.hasobject))
         if atom:
             return
         key = id(obj)
@@ -53,14 +55,16 @@ instances.
         elif isinstance(obj, tuple):
             for elt in obj:
                 scan(elt)
-        elif isinstance(obj, numpy.ndarray):
-            if obj.dtype.hasobject:
-                for elt in numpy.nditer(obj):
-                    scan(elt)
+        elif is_ndarray(obj):
+            for elt in obj.ravel().tolist():
+                scan(elt)
         elif isinstance(obj, dict):
             for key, val in obj.items():
                 scan(key)
                 scan(val)
+        elif isinstance(obj, LispStructure):
+            for _, val in obj.slot_items():
+                scan(val)
     scan(obj)
     # Phase 2: Create a copy of data, where all references have been
     # replaced by SharpsignEquals or SharpsignSharpsign objects.
@@ -82,11 +86,11 @@ instances.
                 result = Cons(copy(obj.car), copy(obj.cdr))
             elif isinstance(obj, list):
                 result = list(copy(elt) for elt in obj)
-            elif isinstance(obj, numpy.ndarray):
-                if obj.dtype.hasobject:
-                    result = np.vectorize(copy)(obj)
-                else:
-                    result = obj
+            elif is_ndarray(obj):
+                result = sys.modules['numpy'].empty(obj.shape, dtype=object)
+                flat = result.reshape(-1)
+                for index, elt in enumerate(obj.ravel().tolist()):
+                    flat[index] = copy(elt)
             elif isinstance(obj, tuple):
                 # Convert strings to List data to make tuples a shorthand
                 # notation for Lisp data.
@@ -98,6 +102,11 @@ instances.
                 result = {}
                 for key, val in obj.items():
                     result[copy(key)] = copy(val)
+            elif isinstance(obj, LispStructure):
+                result = type(obj)()
+                for slot in obj.__slots__:
+                    if hasattr(obj, slot):
+                        setattr(result, slot, copy(getattr(obj, slot)))
             if n > 0:
                 return SharpsignEquals(n, result)
             else:
@@ -105,6 +114,13 @@ instances.
     return copy(obj)
 
 
+def is_ndarray(obj):
+    # NumPy is only imported by cl4py when needed, and if it hasn't been
+    # imported at all, OBJ cannot be an array.
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(obj, numpy.ndarray)
+
+
 def symbol_from_str(string, readtable):
     stream = io.StringIO(string)
     token = readtable.read(stream)
@@ -16,6 +16,7 @@
 | cl4py.Cons         | <-> | cons                                 |
 | cl4py.Symbol       | <-> | symbol                               |
 | cl4py.LispWrapper  | <-> | #N? handle                           |
+| cl4py.LispStructure| <-> | by-value structure or standard-object|
 | fractions.Fraction | <-> | ratio                                |
 | numpy.array        | <-> | array                                |
 
@@ -24,10 +25,12 @@ strings occurring therein are interpreted as Lisp symbols.  This way,
 Python tuples can be used as a somewhat elegant notation for S-expressions.
 
 '''
+import re
+import keyword
 import reprlib
 
 class LispObject:
-    pass
+    __slots__ = ()
 
 
 class Stream(LispObject):
@@ -187,8 +190,8 @@ class Cons (LispObject):
 
     @property
     def python_name(self):
-        if self.car == Symbol('COMMON-LISP', 'SETF'):
-            return 'set_' + python_name(self.cdr.car)
+        if self.car == Symbol('SETF', 'COMMON-LISP'):
+            return 'set_' + self.cdr.car.python_name
         else:
             raise RuntimeError('Not a function name: {}'.format(self))
 
@@ -263,20 +266,114 @@ def null(arg):
         return False
 
 
+class StaleHandleError(RuntimeError):
+    """Raised when a Lisp object is used after its Lisp process has
+terminated, or with a different Lisp process."""
+
+
 class LispWrapper (LispObject):
+    # True if the handle belongs to a handle scope, and true once the handle
+    # has been freed together with its handle scope, respectively.
+    scoped = False
+    released = False
+
     def __init__(self, lisp, handle):
         self.lisp = lisp
         self.handle = handle
 
     def __del__(self):
-        self.lisp.to_free.append(self.handle)
+        if not self.released:
+            self.lisp.to_free.append(self.handle)
 
     def __call__(self, *args, **kwargs):
-        restAndKeys = [ Quote(arg) for arg in args ]
-        for key, value in kwargs.items():
-            restAndKeys.append(Keyword(key.upper()))
-            restAndKeys.append(Quote(value))
-        return self.lisp.eval(List(Symbol('FUNCALL', 'CL'), Quote(self), *restAndKeys))
+        if self.released:
+            raise StaleHandleError(
+                '{!r} has been released by its handle scope.'.format(self))
+        if not self.lisp.alive:
+            raise StaleHandleError(
+                'The Lisp process of {!r} has terminated.'.format(self))
+        return self.lisp.eval(funcall_form(Quote(self), args, kwargs))
+
+
+def funcall_form(function, args, kwargs):
+    restAndKeys = [ Quote(arg) for arg in args ]
+    for key, value in kwargs.items():
+        restAndKeys.append(Keyword(key.upper()))
+        restAndKeys.append(Quote(value))
+    return List(Symbol('FUNCALL', 'CL'), function, *restAndKeys)
+
+
+class LispStructure (LispObject):
+    """The superclass of all Python classes that represent Lisp structures or
+standard objects that are transferred by value.  Each such class has one
+slot per Lisp slot.  Slots that are unbound in Lisp are unbound in Python,
+too.
+    """
+    __slots__ = ()
+    lisp_name = None
+    lisp_slots = ()
+
+    def __init__(self, *args, **kwargs):
+        for slot, value in zip(self.__slots__, args):
+            setattr(self, slot, value)
+        for slot, value in kwargs.items():
+            setattr(self, slot, value)
+
+    def slot_items(self):
+        """Return a list of (lisp_slot, value) tuples for all bound slots."""
+        items = []
+        for lisp_slot, slot in zip(self.lisp_slots, self.__slots__):
+            try:
+                items.append((lisp_slot, getattr(self, slot)))
+            except AttributeError:
+                pass
+        return items
+
+    @reprlib.recursive_repr("...")
+    def __repr__(self):
+        return "{}({})".format(
+            type(self).__name__,
+            ", ".join("{}={!r}".format(slot, getattr(self, slot))
+                      for slot in self.__slots__
+                      if hasattr(self, slot)))
+
+    def __eq__(self, other):
+        if type(self) is type(other):
+            return self.slot_items() == other.slot_items()
+        else:
+            return False
+
+
+def structure_class(name, slots):
+    """Return a new subclass of LispStructure for the Lisp class with the
+supplied NAME and list of SLOTS, both of which are symbols.
+    """
+    return type(name.python_name, (LispStructure,),
+                {'__slots__': slot_identifiers(slots),
+                 'lisp_name': name,
+                 'lisp_slots': tuple(slots)})
+
+
+def slot_identifiers(slots):
+    """Return a tuple of distinct Python identifiers for the Lisp SLOTS.  The
+python_name of a slot is used where possible, but characters that are not
+allowed in identifiers are replaced, and names that clash with an earlier
+slot, e.g., of the same name in another package, or with an attribute of
+LispStructure, are suffixed with a number."""
+    identifiers = []
+    for slot in slots:
+        # Leading underscores are stripped, because names that start with
+        # two underscores would be mangled.
+        base = re.sub(r'\W', '_', slot.python_name).lstrip('_') or 'slot'
+        if not base.isidentifier() or keyword.iskeyword(base):
+            base = 'slot_' + base
+        identifier = base
+        n = 2
+        while identifier in identifiers or hasattr(LispStructure, identifier):
+            identifier = '{}_{}'.format(base, n)
+            n += 1
+        identifiers.append(identifier)
+    return tuple(identifiers)
 
 
 class LispMacro (LispObject):
@@ -1,48 +1,166 @@
 import subprocess
-import io
+import socket
 import os.path
-from urllib import request
+import logging
+import signal
+import threading
+import itertools
+import weakref
+import queue
+import time
+import contextlib
+import concurrent.futures
 import tempfile
-from pkg_resources import resource_filename
 from collections import deque
-from .data import LispWrapper, Cons, Symbol, Quote
+from .data import LispWrapper, Cons, Symbol, Keyword, Quote, List, funcall_form
 from .reader import Readtable
 from .writer import lispify
+from .metrics import Metrics, RequestMetrics
+from .profiling import ProfileReport
+from .memoize import MemoizedFunction
+from .recording import Recorder
+from .protocol import TextProtocol, ProtocolError, DecodeError, FRAME_VERSION
 
 _DEFAULT_COMMAND = ('sbcl', '--script')
 
+# Wrapper classes only depend on the name of a Lisp class and the names of
+# its member functions, so they can be shared by all Lisp processes that
+# run the same image.  This dict maps from commands to class tables, i.e.,
+# to dicts that map from (class_name, member_names) tuples to wrapper
+# classes.
+class_tables = {}
+
+
+@contextlib.contextmanager
+def _no_lock():
+    # A stand-in for contextlib.nullcontext, which needs Python 3.7.
+    yield
+
 
 class Lisp:
     debug: bool
     _backtrace: bool
 
     def __init__(self, cmd=_DEFAULT_COMMAND, quicklisp=False, debug=False,
-                 backtrace=True):
-        command = list(cmd)
-        p = subprocess.Popen(command + [resource_filename(__name__, 'py.lisp')],
-                             stdin = subprocess.PIPE,
-                             stdout = subprocess.PIPE,
-                             stderr = subprocess.PIPE,
-                             shell = False)
-        self.process = p
-        self.stdin = io.TextIOWrapper(p.stdin, write_through=True,
-                                      line_buffering=1,
-                                      encoding='utf-8')
-        self.stdout = io.TextIOWrapper(p.stdout, encoding='utf-8')
+                 backtrace=True, output=None, stderr=None, output_limit=None,
+                 stderr_lines=100, stderr_line_length=4096, interrupt_grace=1.0,
+                 threads=True, framed=True, address=None, metrics=False,
+                 dynamic_space_size=None, control_stack_size=None,
+                 bytes_consed_between_gcs=None, idle_gc=None, circularity=True,
+                 record=None, core=None):
+        # Lisp output is streamed to this function while evaluating.
+        self.output = output_function(output)
+        # Timings and sizes of each request, see cl4py.metrics.
+        self.metrics = Metrics(metrics)
+        self.stderr_tail = deque(maxlen=stderr_lines)
+        # The pool that this connection belongs to, if any.
+        self.pool = None
+        # All memoized functions of this object, see memoize.
+        self.memoized = weakref.WeakSet()
+        # The recorder of all messages, see start_recording.
+        self.recorder = None
+        if address is None:
+            command = list(cmd)
+            # Runtime options of SBCL must precede all other arguments.
+            if control_stack_size is not None:
+                command[1:1] = ['--control-stack-size', str(control_stack_size)]
+            if dynamic_space_size is not None:
+                command[1:1] = ['--dynamic-space-size', str(dynamic_space_size)]
+            if core is not None:
+                command[1:1] = ['--core', str(core)]
+            p = subprocess.Popen(command + [lisp_source()],
+                                 stdin = subprocess.PIPE,
+                                 stdout = subprocess.PIPE,
+                                 stderr = subprocess.PIPE,
+                                 shell = False)
+            self.process = p
+            self.socket = None
+            (rfile, wfile) = (p.stdout, p.stdin)
+            # The standard error of the Lisp process is drained continuously
+            # by a background thread, so that it never fills up the pipe.
+            # The last few lines are kept for inspection.
+            self.stderr_thread = threading.Thread(
+                target=drain_stderr,
+                args=(p.stderr, self.stderr_tail, stderr_function(stderr),
+                      stderr_line_length),
+                daemon=True)
+            self.stderr_thread.start()
+        else:
+            # Connect to a running Lisp server instead.
+            command = ['--listen', server_address(address)]
+            self.process = None
+            (family, sockaddr) = socket_address(address)
+            self.socket = socket.socket(family)
+            self.socket.connect(sockaddr)
+            (rfile, wfile) = (self.socket.makefile('rb'), self.socket.makefile('wb'))
         # The name of the current package.
         self.package = "COMMON-LISP-USER"
         # Each Lisp process has its own readtable.
         self.readtable = Readtable(self)
         # The classes dict maps from symbols to python classes.
         self.classes = {}
-        # Whenever the reader encounters a Lisp object whose class is not
-        # yet known, it stores it in this {class_name : instances} dict.
-        # This allows us to patch these instances later.
-        self.unpatched_instances = {}
+        # The class table is shared with other Lisp processes that run the
+        # same image.
+        self.class_table = class_tables.setdefault(tuple(command), {})
+        # The structure_classes dict maps from symbols to subclasses of
+        # LispStructure, for classes whose instances are sent by value.
+        self.structure_classes = {}
         # If debug is true, cl4py will print plenty of debug information.
         self.debug = debug
         # Pending objects to free
         self.to_free = deque()
+        # Python functions that have been sent to Lisp are registered here,
+        # so that Lisp can call them, see callback_id.
+        self.callbacks = {}
+        self.callback_ids = {}
+        self.callback_references = {}
+        self.callback_counter = itertools.count(1)
+        self.callback_lock = threading.Lock()
+        # A dict from the ID of each active handle scope to the HandleScope,
+        # and the stack of the handle scopes of each thread.
+        self.handle_scopes = {}
+        self.handle_scope_ids = itertools.count(1)
+        self.handle_scope_stacks = threading.local()
+        # Each request has a unique ID, which is assigned by the dispatcher.
+        # Messages from Lisp are routed to the corresponding request by the
+        # dispatcher.
+        self.dispatcher = Dispatcher()
+        # Messages to Lisp must not be interleaved.
+        self.write_lock = threading.Lock()
+        # Unless Lisp evaluates requests in threads, only one request may be
+        # evaluated at a time.
+        self.lock = threading.RLock()
+        self.interrupt_lock = threading.Lock()
+        # How many seconds to wait for an interrupted evaluation to return.
+        # Without worker threads, the Lisp process is killed afterwards,
+        # see interrupt.
+        self.interrupt_grace = interrupt_grace
+        # All communication starts in the text protocol.  The first message
+        # from Lisp describes its capabilities.
+        self.protocol = TextProtocol(self.readtable, rfile, wfile)
+        (_, _, (threads_supported, interruptible, framing), _) = self.protocol.receive()
+        self.threaded = threads_supported == True
+        self.interruptible = interruptible == True
+        # If both sides support it, switch to the framed protocol.
+        if framed and framing == FRAME_VERSION:
+            self.protocol = self.protocol.upgrade()
+        # From now on, all messages are read by a background thread.  It
+        # only references the protocol and the readtable, which references
+        # this object weakly, so that this object can still be garbage
+        # collected.
+        self.reader_thread = threading.Thread(
+            target=read_messages,
+            args=(self.protocol, self.dispatcher),
+            daemon=True)
+        self.reader_thread.start()
+        if record is not None:
+            self.start_recording(record)
+        if self.threaded and not threads:
+            # A server is shared by several connections, so it always
+            # evaluates requests in threads.
+            if self.process:
+                self.eval( ('setf', 'cl4py::*threads*', ()) )
+            self.threaded = False
 
         # Collect ASDF -- we'll need it for UIOP later
         self.function('CL:REQUIRE')(Symbol("ASDF", "KEYWORD"))
@@ -53,6 +171,22 @@ class Lisp:
             install_and_load_quicklisp(self)
         self._backtrace = backtrace
         self.eval( ('defparameter', 'cl4py::*backtrace*', backtrace) )
+        if output_limit is not None:
+            self.eval( ('defparameter', 'cl4py::*output-limit*', output_limit) )
+        # Detecting shared and circular structure in results can be turned
+        # off, which makes printing large results faster.
+        if not circularity:
+            self.eval( ('defparameter', 'cl4py::*pyprint-circle*', ()) )
+        if bytes_consed_between_gcs is not None:
+            self.eval( ('cl4py::set-bytes-consed-between-gcs', bytes_consed_between_gcs) )
+        # If idle_gc is a number, a full garbage collection is triggered
+        # once Lisp has been idle for that many seconds.
+        self.last_activity = time.monotonic()
+        self.idle_collected = True
+        if idle_gc is not None:
+            threading.Thread(target=collect_when_idle,
+                             args=(weakref.ref(self), idle_gc),
+                             daemon=True).start()
 
 
 
@@ -69,14 +203,225 @@ class Lisp:
 
 
     def __del__(self):
-        alive = self.process.poll() == None
-        if alive:
-            self.stdin.write('(cl4py:quit)\n')
+        self.terminate()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        """Return this connection to its pool, if it has one.  Otherwise,
+terminate it."""
+        if self.pool:
+            self.pool.release(self)
+        else:
+            self.terminate()
+
+
+    def terminate(self):
+        """Terminate the Lisp process, or disconnect from the Lisp server."""
+        self.stop_recording()
+        if self.process:
+            alive = self.process.poll() == None
+            if alive:
+                self.send('quit')
+                self.process.wait()
+        elif not self.dispatcher.closed:
+            try:
+                self.send('quit')
+            except (OSError, EOFError):
+                pass
+            self.disconnect()
+
+
+    def kill(self):
+        """Kill the Lisp process immediately, or drop the connection to the
+Lisp server.  Unlike terminate, this also works when Lisp doesn't respond."""
+        self.stop_recording()
+        if self.process:
+            self.process.kill()
             self.process.wait()
+        else:
+            self.disconnect()
+
+
+    def disconnect(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+    @property
+    def alive(self):
+        if self.process:
+            return self.process.poll() == None
+        else:
+            return not self.dispatcher.closed
+
+
+    def send(self, kind, id=0, text='', sections=()):
+        # pylint: disable=redefined-builtin
+        with self.write_lock:
+            try:
+                size = self.protocol.send(kind, id, text, sections)
+            except (OSError, ValueError) as error:
+                # Writing to a closed pipe or socket.
+                raise self.terminated_error() from error
+            if self.recorder:
+                self.recorder.sent(kind, id, size, text, sections)
+            return size
+
+
+    def start_recording(self, path):
+        """Record all further messages to and from Lisp in the file PATH, see
+cl4py.recording."""
+        self.stop_recording()
+        self.recorder = Recorder(path)
+        self.dispatcher.recorder = self.recorder
+
+
+    def stop_recording(self):
+        recorder = self.recorder
+        if recorder:
+            self.recorder = None
+            self.dispatcher.recorder = None
+            recorder.close()
+
+
+    def eval(self, expr, timeout=None):
+        """Evaluate EXPR in Lisp and return the resulting values.  If TIMEOUT
+is not None, the evaluation is interrupted after that many seconds and a
+LispTimeoutError is raised."""
+        return self._evaluate(expr, Request(), timeout)
+
+
+    def submit(self, expr, timeout=None):
+        """Evaluate EXPR in a background thread and return a LispFuture for
+the resulting values."""
+        future = LispFuture(self)
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._evaluate(expr, future.request, timeout))
+                except BaseException as e: # pylint: disable=broad-except
+                    future.set_exception(e)
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+
+    def interrupt(self, request, reason='cancel'):
+        """Interrupt the evaluation of REQUEST, if it is still running.  The
+REASON is either 'cancel' or 'timeout'.  Return whether the request has
+been interrupted.
+
+With worker threads, only the thread that evaluates REQUEST is interrupted,
+and all other requests are unaffected.  If it doesn't return within
+interrupt_grace seconds, the evaluation raises nonetheless, and its late
+messages are discarded.  Without worker threads, the Lisp
+process is interrupted by a signal, which affects the innermost request,
+i.e., the one that has been sent last.  Other requests cannot be interrupted
+until it has returned, so False is returned for them.  If the interrupted
+request doesn't return within interrupt_grace seconds, or if Lisp cannot be
+interrupted at all, the Lisp process is killed."""
+        with self.interrupt_lock:
+            if request.interrupted or not self.dispatcher.pending(request):
+                return False
+            signaled = not self.threaded and self.process
+            if signaled and self.dispatcher.innermost() is not request:
+                return False
+            request.interrupted = reason
+        if not signaled:
+            self.send('cancel', request.id)
+            # Wake up the thread that waits for the result, see
+            # _receive_result.
+            request.inbox.put(('interrupted', request.id, None, None))
+        elif self.interruptible:
+            self.process.send_signal(signal.SIGINT)
+            timer = threading.Timer(self.interrupt_grace, self._kill, (request,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.process.kill()
+        return True
 
 
-    def eval(self, expr):
-        sexp = lispify(self, expr)
+    def _kill(self, request):
+        if self.dispatcher.pending(request):
+            self.process.kill()
+
+
+    def stream(self, expr, timeout=None, window=8, chunk_size=64):
+        """Return an iterator over the items that are sent by each call to
+cl4py:emit while evaluating EXPR.  The evaluation starts when the first item
+is requested, and the value of EXPR is discarded.  Items are sent in chunks
+of CHUNK_SIZE items, and Lisp waits once WINDOW chunks have not been
+consumed yet.  Closing the iterator early cancels the evaluation."""
+        form = ('cl4py:with-emitter',
+                (Keyword('WINDOW'), window, Keyword('CHUNK-SIZE'), chunk_size),
+                expr)
+        request = Request()
+        run = self._run(form, request, timeout)
+        try:
+            for chunk in run:
+                yield from chunk
+        finally:
+            # Drain all remaining chunks of an interrupted evaluation, so
+            # that Lisp doesn't wait for their acknowledgement.
+            if self.dispatcher.pending(request) and self.interrupt(request):
+                try:
+                    for _ in run:
+                        pass
+                except (LispCancelledError, EOFError):
+                    pass
+            run.close()
+
+
+    def _evaluate(self, expr, request, timeout):
+        return self._complete(self._run(expr, request, timeout))
+
+
+    def _evaluate_text(self, text, sections=(), timeout=None):
+        """Like eval, but TEXT and SECTIONS describe an expression that has
+been lispified already, e.g., by a recorded session."""
+        metrics = RequestMetrics(None) if self.metrics.enabled else None
+        sections = list(sections) if self.protocol.framed else None
+        return self._complete(self._request(text, sections, Request(), timeout,
+                                            metrics, time.perf_counter()))
+
+
+    @staticmethod
+    def _complete(run):
+        """Run the generator RUN, which must not yield, and return its value."""
+        try:
+            next(run)
+        except StopIteration as stop:
+            return stop.value
+        run.close()
+        raise ProtocolError('Unexpected yield message.')
+
+
+    def _run(self, expr, request, timeout):
+        """A generator that evaluates EXPR, yields each chunk of items that
+Lisp emits, and returns the resulting values."""
+        self.last_activity = time.monotonic()
+        self.idle_collected = False
+        metrics = RequestMetrics(None) if self.metrics.enabled else None
+        start = time.perf_counter()
+        sections = [] if self.protocol.framed else None
+        sexp = lispify(self, expr, sections)
+        if metrics:
+            metrics.lispify = time.perf_counter() - start
+        scope = self.current_handle_scope()
+        if scope:
+            # On the Lisp side, #N% declares the handle scope of the request.
+            sexp = '#{}% '.format(scope.id) + sexp
         if self.debug: print(sexp) # pylint: disable=multiple-statements
         to_free = [self.to_free.popleft() for _ in range(len(self.to_free))]
         if to_free:
@@ -84,35 +429,41 @@ class Lisp:
             free_exp = ' '.join('#{}!'.format(handle) for handle in to_free)
             # On the Lisp side, #N! is read as a comment, so a PROGN is not needed here.
             sexp = free_exp + ' ' + sexp
-        self.stdin.write(sexp + '\n')
-        pkg = self.readtable.read(self.stdout)
-        val = self.readtable.read(self.stdout)
-        err = self.readtable.read(self.stdout)
-        msg = self.readtable.read(self.stdout)
+        return (yield from self._request(sexp, sections, request, timeout, metrics, start))
+
+
+    def _request(self, sexp, sections, request, timeout, metrics, start):
+        with _no_lock() if self.threaded else self.lock:
+            self.dispatcher.register(request)
+            try:
+                sent = time.perf_counter()
+                size = self.send('eval', request.id, sexp, sections or ())
+                if metrics:
+                    metrics.id = request.id
+                    metrics.request_size = size
+                    metrics.send = time.perf_counter() - sent
+                    sent = time.perf_counter()
+                pkg, val, err = yield from self._receive_result(request, timeout, metrics)
+                if metrics:
+                    metrics.wait = time.perf_counter() - sent - (metrics.decode or 0)
+            finally:
+                self.dispatcher.unregister(request)
+                self.last_activity = time.monotonic()
+        if metrics:
+            metrics.total = time.perf_counter() - start
+            self.metrics.record(metrics)
         # Update the current package.
         self.package = pkg
-        # Write the Lisp output to the Python output.
-        print(msg,end='')
         # If there is an error, raise it.
         if isinstance(err, Cons):
             condition = err.car
             msg = err.cdr.car if err.cdr else ""
+            if condition == _EVALUATION_INTERRUPTED and request.interrupted:
+                raise interrupted_error(request)(msg)
             def init(self):
                 RuntimeError.__init__(self, msg)
             raise type(str(condition), (RuntimeError,),
                        {'__init__': init})()
-        # Now, check whether there are any unpatched instances.  If so,
-        # figure out their class definitions and patch them accordingly.
-        items = list(self.unpatched_instances.items())
-        self.unpatched_instances.clear()
-        for (cls_name, instances) in items:
-            cls = type(cls_name.python_name, (LispWrapper,), {})
-            self.classes[cls_name] = cls
-            alist = self.function('cl4py:class-information')(cls_name)
-            for cons in alist:
-                add_member_function(cls, cons.car, cons.cdr)
-            for instance in instances:
-                instance.__class__ = cls
         # Finally, return the resulting values.
         if val == ():
             return None
@@ -122,6 +473,286 @@ class Lisp:
             return tuple(val)
 
 
+    def _receive_result(self, request, timeout, metrics):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # The number of chunks of items that have been consumed.
+        consumed = 0
+        # The first message of this request that could not be decoded.
+        error = None
+        # True once Lisp has been asked to unwind the request.
+        unwinding = False
+        while True:
+            try:
+                message = request.inbox.get(
+                    timeout = None if deadline is None else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                if unwinding:
+                    raise interrupted_error(request)(
+                        'The evaluation has been interrupted, but has not returned '
+                        'within {} seconds.'.format(self.interrupt_grace))
+                if self.interrupt(request, 'timeout') or request.interrupted:
+                    deadline = None
+                else:
+                    # A nested request has to return first, see interrupt.
+                    deadline = time.monotonic() + 0.1
+                continue
+            if message is None:
+                if request.interrupted:
+                    raise interrupted_error(request)('The Lisp process has been killed.')
+                if self.dispatcher.error:
+                    raise self.dispatcher.error
+                raise self.terminated_error()
+            # Forward all output until the result arrives.
+            (kind, _, data, info) = message
+            if kind == 'interrupted':
+                # Lisp must unwind within the grace period, see interrupt.
+                unwinding = True
+                deadline = time.monotonic() + self.interrupt_grace
+            elif isinstance(data, DecodeError):
+                if kind == 'result':
+                    raise data
+                elif kind == 'callback':
+                    # Lisp waits for the outcome of the callback.
+                    self._return(request, List(Keyword('ERROR'), str(data)))
+                elif kind == 'yield':
+                    # Lisp waits for the acknowledgement of the chunk, and
+                    # the error is raised once the evaluation has returned.
+                    consumed += 1
+                    self.send('acknowledge', request.id, str(consumed))
+                error = error or data
+            elif kind == 'output':
+                if metrics:
+                    metrics.output_size += len(data)
+                self.output(data)
+            elif kind == 'result':
+                (result, lisp_metrics, released) = list(data)
+                self.release_callback_references(released)
+                if metrics:
+                    (read_time, eval_time, consed, gc_time, print_time) = list(lisp_metrics)
+                    metrics.lisp_read = read_time / 1e6
+                    metrics.lisp_eval = eval_time / 1e6
+                    metrics.lisp_consed = consed
+                    metrics.lisp_gc = gc_time / 1e6
+                    metrics.lisp_print = print_time / 1e6
+                    if info:
+                        (metrics.response_size, metrics.decode) = info
+                if error:
+                    raise error
+                return list(result)
+            elif kind == 'callback':
+                self._call_back(request, data)
+            elif kind == 'yield':
+                yield list(data)
+                consumed += 1
+                self.send('acknowledge', request.id, str(consumed))
+            else:
+                raise ProtocolError('Unexpected {} message.'.format(kind))
+
+
+    def _call_back(self, request, data):
+        """Call the Python function that Lisp has requested while evaluating
+REQUEST, and send the outcome to Lisp.  The function may evaluate further
+requests, because Lisp keeps reading messages while it waits."""
+        (callback_id, arguments) = list(data)
+        try:
+            value = self.callbacks[callback_id](*list(arguments))
+            outcome = List(Keyword('VALUES'), value)
+        except Exception as e: # pylint: disable=broad-except
+            outcome = List(Keyword('ERROR'), '{}: {}'.format(type(e).__name__, e))
+        self._return(request, outcome)
+
+
+    def _return(self, request, outcome):
+        """Send the OUTCOME of a callback, which is either (:VALUES VALUE) or
+(:ERROR MESSAGE), to the Lisp thread that evaluates REQUEST."""
+        sections = [] if self.protocol.framed else None
+        try:
+            text = lispify(self, outcome, sections)
+        except Exception as e: # pylint: disable=broad-except
+            sections = [] if self.protocol.framed else None
+            text = lispify(self, List(Keyword('ERROR'), '{}: {}'.format(type(e).__name__, e)),
+                           sections)
+        self.send('return', request.id, text, sections or ())
+
+
+    def callback_id(self, function):
+        """Return the ID under which Lisp can call FUNCTION.  Each function
+is registered once, and each call counts as one reference from Lisp.  The
+function remains registered until Lisp has released all these references,
+see release_callback_references."""
+        key = callback_key(function)
+        with self.callback_lock:
+            if key not in self.callback_ids:
+                n = next(self.callback_counter)
+                self.callback_ids[key] = n
+                self.callbacks[n] = function
+                self.callback_references[n] = 0
+            n = self.callback_ids[key]
+            self.callback_references[n] += 1
+            return n
+
+
+    def release_callback_references(self, ids):
+        """Forget each function whose references from Lisp have all been
+garbage collected.  IDS contains the ID of a function once per released
+reference."""
+        with self.callback_lock:
+            for n in ids:
+                if n not in self.callback_references:
+                    continue
+                self.callback_references[n] -= 1
+                if self.callback_references[n] <= 0:
+                    self.forget_callback(n)
+
+
+    def release_callback(self, function):
+        """Forget the ID of FUNCTION, so that Lisp can no longer call it."""
+        with self.callback_lock:
+            n = self.callback_ids.get(callback_key(function))
+            if n is not None:
+                self.forget_callback(n)
+
+
+    def forget_callback(self, n):
+        function = self.callbacks.pop(n)
+        del self.callback_references[n]
+        del self.callback_ids[callback_key(function)]
+
+
+    def terminated_error(self):
+        """Return a LispTerminatedError that describes how Lisp has terminated."""
+        if self.process:
+            message = 'The Lisp process has terminated'
+            returncode = self.process.poll()
+            if returncode is not None:
+                message += ' with exit code {}'.format(returncode)
+            if self.stderr_tail:
+                message += ', its last output was: {}'.format(self.stderr_tail[-1])
+            return LispTerminatedError(message + '.')
+        return LispTerminatedError('The connection to the Lisp server has been lost.')
+
+
+    def transfer_by_value(self, class_name, enable=True):
+        """Send all future instances of the Lisp class with the supplied name
+as a snapshot of their slot values, instead of as a handle."""
+        self.eval( ('cl4py:transfer-by-value', ('quote', class_name), enable) )
+
+
+    def wrapper_class(self, name, member_names):
+        """Return the Python class for instances of the Lisp class with the
+supplied name and member functions."""
+        # Names of setf functions are conses, which are not hashable, so we
+        # use the printed representation of each member function name.
+        key = (name, tuple(repr(member_name) for member_name in member_names))
+        cls = self.class_table.get(key)
+        if not cls:
+            cls = type(name.python_name, (LispWrapper,), {})
+            for member_name in member_names:
+                add_member_function(cls, member_name)
+            self.class_table[key] = cls
+        self.classes[name] = cls
+        return cls
+
+
+    @contextlib.contextmanager
+    def profile(self, mode='cpu', sample_interval=0.01):
+        """Profile all evaluations in the body of a with statement, and fill
+in the yielded ProfileReport at its end.  MODE is 'cpu', 'alloc' or 'time'.
+The profiler samples all Lisp threads every SAMPLE_INTERVAL seconds."""
+        report = ProfileReport(mode)
+        report.supported = self.eval(
+            ('cl4py::start-profiling', Keyword(mode.upper()), sample_interval) ) == True
+        try:
+            yield report
+        finally:
+            if report.supported:
+                (flat, graph) = list(self.eval( ('cl4py::stop-profiling',) ))
+                report.parse(flat, graph)
+
+
+    def heap_stats(self):
+        """Return a dict that describes the heap and the garbage collector of
+Lisp.  The sizes are in bytes and the times in seconds.  Statistics that are
+not available are None."""
+        return self.eval( ('cl4py::heap-stats',) )
+
+
+    def gc(self, full=False):
+        """Trigger a garbage collection in Lisp."""
+        self.eval( ('cl4py::collect-garbage', full) )
+
+
+    def memoize(self, function, maxsize=128, ttl=None):
+        """Return a callable that calls FUNCTION, which is either a Lisp
+function or its name, and caches its results in Python.  This is only
+correct for functions whose results depend on nothing but their arguments.
+See cl4py.memoize.MemoizedFunction."""
+        if isinstance(function, (str, Symbol)):
+            function = self.function(function)
+        memoized = MemoizedFunction(function, maxsize, ttl)
+        self.memoized.add(memoized)
+        return memoized
+
+
+    def invalidate_memoized(self):
+        """Discard the cached results of all memoized functions, e.g., after
+redefining some Lisp functions."""
+        for memoized in list(self.memoized):
+            memoized.invalidate_all()
+
+
+    @contextlib.contextmanager
+    def handle_scope(self):
+        """Release all Lisp objects that are returned by evaluations in the
+body of a with statement at its end, using a single request.  Only the
+evaluations of the current thread are affected.  Objects that should
+outlive the block can be passed to the retain method of the yielded
+HandleScope.  Scopes can be nested, in which case retained objects are
+moved to the enclosing scope.  Results that contain such objects are not
+cached by memoized functions."""
+        stack = self.handle_scope_stack()
+        parent = stack[-1] if stack else None
+        scope = HandleScope(next(self.handle_scope_ids), parent)
+        self.handle_scopes[scope.id] = scope
+        stack.append(scope)
+        try:
+            yield scope
+        finally:
+            stack.pop()
+            del self.handle_scopes[scope.id]
+            for wrapper in list(scope.wrappers):
+                wrapper.released = True
+            if parent:
+                parent.wrappers.update(scope.retained)
+            if self.alive:
+                self.eval( ('cl4py::free-handle-scope', scope.id,
+                            parent.id if parent else (),
+                            *(wrapper.handle for wrapper in scope.retained)) )
+
+
+    def handle_scope_stack(self):
+        stack = getattr(self.handle_scope_stacks, 'stack', None)
+        if stack is None:
+            stack = self.handle_scope_stacks.stack = []
+        return stack
+
+
+    def current_handle_scope(self):
+        stack = getattr(self.handle_scope_stacks, 'stack', None)
+        return stack[-1] if stack else None
+
+
+    def add_to_handle_scope(self, id, wrapper):
+        # pylint: disable=redefined-builtin
+        wrapper.scoped = True
+        scope = self.handle_scopes.get(id)
+        if scope:
+            scope.wrappers.add(wrapper)
+        else:
+            # The scope has ended already, so Lisp has freed the handle.
+            wrapper.released = True
+
+
     def find_package(self, name):
         return self.function('CL:FIND-PACKAGE')(name)
 
@@ -130,9 +761,288 @@ class Lisp:
         return self.eval( ('CL:FUNCTION', name) )
 
 
-def add_member_function(cls, name, gf):
+def callback_key(function):
+    """Return the key of FUNCTION in the callback_ids dict of a Lisp object.
+Bound methods are created anew on each attribute access, but they are equal
+if they have the same object and function."""
+    try:
+        hash(function)
+        return function
+    except TypeError:
+        return id(function)
+
+
+def lisp_source():
+    """Return the file name of py.lisp, the Lisp side of cl4py."""
+    return os.path.join(os.path.dirname(__file__), 'py.lisp')
+
+
+class HandleScope:
+    """The Lisp objects that have been returned within a with statement of
+Lisp.handle_scope, see there."""
+    def __init__(self, id, parent):
+        # pylint: disable=redefined-builtin
+        self.id = id
+        self.parent = parent
+        self.wrappers = weakref.WeakSet()
+        self.retained = []
+
+    def retain(self, wrapper):
+        """Keep WRAPPER alive after the end of this scope, and return it."""
+        if wrapper in self.wrappers:
+            self.wrappers.discard(wrapper)
+            self.retained.append(wrapper)
+        return wrapper
+
+
+class LispTimeoutError(TimeoutError):
+    """Raised when an evaluation has been interrupted because it exceeded its
+timeout."""
+
+
+class LispTerminatedError(EOFError):
+    """Raised when the Lisp process has terminated, or when the connection
+to the Lisp server has been lost."""
+
+
+class LispCancelledError(concurrent.futures.CancelledError):
+    """Raised when an evaluation has been interrupted because it was
+cancelled."""
+
+
+def socket_address(address):
+    """Return the socket family and the socket address of ADDRESS, which is
+either the file name of a Unix domain socket, the number of a TCP port on
+the local host, or a (host, port) tuple."""
+    if isinstance(address, int):
+        return (socket.AF_INET, ('127.0.0.1', address))
+    elif isinstance(address, tuple):
+        return (socket.AF_INET, address)
+    else:
+        return (socket.AF_UNIX, os.path.abspath(address))
+
+
+def server_address(address):
+    """Return ADDRESS in the format that is understood by the Lisp server."""
+    (family, address) = socket_address(address)
+    if family == socket.AF_UNIX:
+        return address
+    else:
+        return str(address[1])
+
+
+def serve(address, cmd=_DEFAULT_COMMAND, timeout=60):
+    """Start a Lisp server that listens on ADDRESS, and return its process
+once it accepts connections."""
+    process = subprocess.Popen(list(cmd) + [lisp_source(),
+                                            '--listen', server_address(address)],
+                               stdin = subprocess.DEVNULL)
+    (family, sockaddr) = socket_address(address)
+    deadline = time.monotonic() + timeout
+    while True:
+        if process.poll() != None:
+            raise RuntimeError('The Lisp server has terminated.')
+        try:
+            with socket.socket(family) as s:
+                s.connect(sockaddr)
+                return process
+        except OSError:
+            if time.monotonic() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.05)
+
+
+class Request:
+    """The state of a single evaluation.  The inbox receives all messages from
+Lisp that belong to this request.  The interrupted attribute is None,
+'cancel', or 'timeout'."""
+    def __init__(self):
+        self.id = None
+        self.inbox = queue.Queue()
+        self.interrupted = None
+
+
+# The largest request ID that fits into the header of a frame.
+_MAX_REQUEST_ID = 2**32 - 1
+
+
+class Dispatcher:
+    """Routes messages from Lisp to the inboxes of the pending requests."""
+    def __init__(self):
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.closed = False
+        self.error = None
+        # The recorder of all dispatched messages, if any.
+        self.recorder = None
+
+    def register(self, request):
+        """Assign a fresh ID to REQUEST, and route all messages with that ID
+to its inbox.  IDs are unsigned 32-bit integers, so they wrap around, but
+the IDs of pending requests are skipped."""
+        with self.lock:
+            if self.closed:
+                raise self.error or LispTerminatedError('The Lisp process has terminated.')
+            while True:
+                self.last_id = self.last_id % _MAX_REQUEST_ID + 1
+                if self.last_id not in self.requests:
+                    break
+            request.id = self.last_id
+            self.requests[request.id] = request
+
+    def unregister(self, request):
+        with self.lock:
+            self.requests.pop(request.id, None)
+
+    def pending(self, request):
+        with self.lock:
+            return self.requests.get(request.id) is request
+
+    def innermost(self):
+        """Return the pending request that has been sent last, or None.  IDs
+wrap around, but the requests dict preserves the order of registration."""
+        with self.lock:
+            return list(self.requests.values())[-1] if self.requests else None
+
+    def dispatch(self, message):
+        recorder = self.recorder
+        if recorder:
+            recorder.received(message)
+        with self.lock:
+            request = self.requests.get(message[1])
+        # Messages for requests that have been abandoned are dropped.
+        if request:
+            request.inbox.put(message)
+
+    def close(self, error=None):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = error
+            requests = list(self.requests.values())
+        for request in requests:
+            request.inbox.put(None)
+
+
+def read_messages(protocol, dispatcher):
+    # In the framed protocol, messages that cannot be decoded are delivered
+    # to their request as a DecodeError, see FramedProtocol.receive.
+    try:
+        while True:
+            dispatcher.dispatch(protocol.receive())
+    except (EOFError, OSError):
+        pass
+    except ValueError as error:
+        # Reading from a stream that has been closed.
+        if not protocol.rfile.closed:
+            dispatcher.close(decode_failure(error))
+    except ProtocolError as error:
+        # The stream is out of sync, so no further message can be read.
+        dispatcher.close(error)
+    except Exception as error: # pylint: disable=broad-except
+        # A message of the text protocol could not be decoded, and the end
+        # of that message is unknown.
+        dispatcher.close(decode_failure(error))
+    finally:
+        dispatcher.close()
+
+
+def decode_failure(error):
+    failure = ProtocolError('Cannot decode a message from Lisp: {!r}'.format(error))
+    failure.__cause__ = error
+    return failure
+
+
+def interrupted_error(request):
+    if request.interrupted == 'timeout':
+        return LispTimeoutError
+    else:
+        return LispCancelledError
+
+
+class LispFuture(concurrent.futures.Future):
+    """The future result of an evaluation.  Unlike other futures, it can also
+be cancelled while it is running, in which case the evaluation is
+interrupted and the future raises a LispCancelledError."""
+    def __init__(self, lisp):
+        super().__init__()
+        self.lisp = lisp
+        self.request = Request()
+
+    def cancel(self):
+        if super().cancel():
+            return True
+        return self.lisp.interrupt(self.request, 'cancel')
+
+
+_EVALUATION_INTERRUPTED = Symbol('EVALUATION-INTERRUPTED', 'CL4PY')
+
+def output_function(target):
+    """Return a function that forwards Lisp output to TARGET, which is either
+None, a callable, or a logging.Logger.  None means that the output is written
+to sys.stdout."""
+    if target is None:
+        return lambda text: print(text, end='')
+    elif isinstance(target, logging.Logger):
+        return lambda text: target.info(text.rstrip('\n'))
+    else:
+        return target
+
+
+def stderr_function(target):
+    """Like output_function, but None means that the text is discarded."""
+    if target is None:
+        return lambda text: None
+    elif isinstance(target, logging.Logger):
+        return lambda text: target.warning(text.rstrip('\n'))
+    else:
+        return target
+
+
+def drain_stderr(stream, tail, function, line_length):
+    for line in iter(lambda: stream.readline(line_length), b''):
+        text = line.decode('utf-8', errors='replace')
+        tail.append(text)
+        function(text)
+
+
+def collect_when_idle(ref, delay):
+    """Collect the garbage of the Lisp object referenced by the weak reference
+REF once it has been idle for DELAY seconds."""
+    while True:
+        lisp = ref()
+        if lisp is None or not lisp.alive:
+            return
+        idle = time.monotonic() - lisp.last_activity
+        if lisp.idle_collected or lisp.dispatcher.requests:
+            wait = delay
+        elif idle >= delay:
+            try:
+                lisp.gc(full=True)
+            except Exception: # pylint: disable=broad-except
+                return
+            lisp.idle_collected = True
+            wait = delay
+        else:
+            wait = delay - idle
+        del lisp
+        time.sleep(wait)
+
+
+def add_member_function(cls, name):
     method_name = name.python_name
-    setattr(cls, method_name, lambda self, *args: gf(self, *args))
+    function = List(Symbol('FUNCTION', 'CL'), name)
+    if isinstance(name, Cons):
+        # Setf functions receive the new value as their first argument.
+        def member_function(self, value, *args, **kwargs):
+            return self.lisp.eval(funcall_form(function, (value, self, *args), kwargs))
+    else:
+        def member_function(self, *args, **kwargs):
+            return self.lisp.eval(funcall_form(function, (self, *args), kwargs))
+    setattr(cls, method_name, member_function)
 
 
 def install_and_load_quicklisp(lisp):
@@ -144,9 +1054,11 @@ def install_and_load_quicklisp(lisp):
 
 
 def install_quicklisp(lisp):
+    # urllib is only needed here, so it is not imported at load time.
+    import urllib.request
     url = 'https://beta.quicklisp.org/quicklisp.lisp'
     with tempfile.NamedTemporaryFile(prefix='quicklisp-', suffix='.lisp') as tmp:
-        with request.urlopen(url) as u:
+        with urllib.request.urlopen(url) as u:
             tmp.write(u.read())
         lisp.function('cl:load')(tmp.name)
     print('Installing Quicklisp...')
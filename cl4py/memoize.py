@@ -0,0 +1,161 @@
+import sys
+import time
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from fractions import Fraction
+from .data import Cons, Symbol, LispWrapper, LispStructure
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+# The types whose instances are their own canonical form.
+_SCALAR_TYPES = (bool, int, float, complex, str, bytes, Fraction, type(None))
+
+
+def canonical_form(obj):
+    """Return a hashable object that is equal for all arguments that Lisp
+considers equal.  The type of each scalar is part of its canonical form,
+because Lisp distinguishes 1, 1.0 and T."""
+    if isinstance(obj, _SCALAR_TYPES):
+        return (type(obj), obj)
+    elif isinstance(obj, Symbol):
+        return (Symbol, obj.name, obj.package)
+    elif isinstance(obj, Cons):
+        elements = []
+        while isinstance(obj, Cons):
+            elements.append(canonical_form(obj.car))
+            obj = obj.cdr
+        return (Cons, tuple(elements), canonical_form(obj))
+    elif isinstance(obj, (tuple, list)):
+        return (type(obj), tuple(canonical_form(elt) for elt in obj))
+    elif isinstance(obj, dict):
+        return (dict, tuple((canonical_form(key), canonical_form(value))
+                            for key, value in obj.items()))
+    elif isinstance(obj, (bytearray, memoryview)):
+        return (bytes, bytes(obj))
+    elif isinstance(obj, LispWrapper):
+        # Each Lisp object has its own handle, so handles are compared by
+        # identity.
+        return (LispWrapper, obj.handle)
+    numpy = sys.modules.get('numpy')
+    if numpy:
+        if isinstance(obj, numpy.ndarray):
+            if obj.dtype.hasobject:
+                return (numpy.ndarray, obj.shape,
+                        tuple(canonical_form(elt) for elt in obj.ravel().tolist()))
+            # Arrays are hashed by content.
+            digest = hashlib.sha1(numpy.ascontiguousarray(obj).data).digest()
+            return (numpy.ndarray, obj.dtype.str, obj.shape, digest)
+        elif isinstance(obj, numpy.generic):
+            return (type(obj), obj.item())
+    raise TypeError('Cannot memoize calls with the argument {!r}.'.format(obj))
+
+
+def contains_scoped_handle(obj, seen=None):
+    """Return whether OBJ contains a Lisp object that belongs to a handle
+scope, and that will therefore be released at the end of that scope.
+Results may be circular, so SEEN holds the IDs of all visited objects."""
+    if isinstance(obj, LispWrapper):
+        return obj.scoped
+    if isinstance(obj, _SCALAR_TYPES + (Symbol,)):
+        return False
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return False
+    seen.add(id(obj))
+    if isinstance(obj, Cons):
+        # Long lists are traversed iteratively.
+        while True:
+            if contains_scoped_handle(obj.car, seen):
+                return True
+            obj = obj.cdr
+            if not isinstance(obj, Cons) or id(obj) in seen:
+                break
+            seen.add(id(obj))
+        return contains_scoped_handle(obj, seen)
+    elif isinstance(obj, (tuple, list)):
+        return any(contains_scoped_handle(elt, seen) for elt in obj)
+    elif isinstance(obj, dict):
+        return any(contains_scoped_handle(key, seen) or contains_scoped_handle(value, seen)
+                   for key, value in obj.items())
+    elif isinstance(obj, LispStructure):
+        return any(contains_scoped_handle(value, seen) for _, value in obj.slot_items())
+    numpy = sys.modules.get('numpy')
+    if numpy and isinstance(obj, numpy.ndarray) and obj.dtype.hasobject:
+        return any(contains_scoped_handle(elt, seen) for elt in obj.ravel().tolist())
+    return False
+
+
+class MemoizedFunction:
+    """A callable that caches the results of calling FUNCTION.  At most
+MAXSIZE results are kept, and the least recently used result is discarded
+first.  If TTL is not None, results expire after TTL seconds.  Results are
+shared between calls, so they must not be modified.  Results that contain
+Lisp objects of a handle scope are not cached, because they are released
+at the end of that scope."""
+    def __init__(self, function, maxsize=128, ttl=None):
+        self.function = function
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Incremented whenever all results are discarded, so that results
+        # of calls that were running at that time are not cached.
+        self.generation = 0
+
+    def key(self, args, kwargs):
+        return (canonical_form(args),
+                tuple(sorted((key, canonical_form(value))
+                             for key, value in kwargs.items())))
+
+    def __call__(self, *args, **kwargs):
+        key = self.key(args, kwargs)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and (self.ttl is None or now - entry[1] < self.ttl):
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+        # The lock is not held while calling Lisp, so that concurrent calls
+        # don't wait for each other.
+        value = self.function(*args, **kwargs)
+        with self.lock:
+            if generation != self.generation or contains_scoped_handle(value):
+                return value
+            self.cache[key] = (value, now)
+            self.cache.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+        return value
+
+    def cache_info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.cache))
+
+    def invalidate(self, *args, **kwargs):
+        """Discard the cached result of calling this function with ARGS and
+KWARGS, and return whether there was one."""
+        key = self.key(args, kwargs)
+        with self.lock:
+            return self.cache.pop(key, None) is not None
+
+    def invalidate_all(self):
+        """Discard all cached results."""
+        with self.lock:
+            self.cache.clear()
+            self.generation += 1
+
+    def cache_clear(self):
+        """Discard all cached results and reset the statistics."""
+        with self.lock:
+            self.cache.clear()
+            self.generation += 1
+            self.hits = 0
+            self.misses = 0
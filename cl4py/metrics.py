@@ -0,0 +1,124 @@
+import math
+import threading
+
+
+class RequestMetrics:
+    """The timings (in seconds) and sizes (in bytes) of a single request.
+Timings that cannot be measured with the current protocol are None.
+
+lispify       - Converting the expression to text, including decircularize.
+send          - Writing the request to Lisp.
+wait          - Waiting for the result after the request has been sent.
+decode        - Parsing the result.
+total         - The whole evaluation, as seen by the caller.
+lisp_read     - Reading the request in Lisp.
+lisp_eval     - Evaluating the request in Lisp.
+lisp_print    - Printing the result in Lisp.
+lisp_gc       - Garbage collection in Lisp during the evaluation.
+lisp_consed   - Bytes allocated in Lisp during the evaluation.
+request_size  - The size of the request.
+response_size - The size of the result.
+output_size   - The number of characters of output.
+"""
+    __slots__ = ('id', 'lispify', 'send', 'wait', 'decode', 'total',
+                 'lisp_read', 'lisp_eval', 'lisp_print', 'lisp_gc',
+                 'lisp_consed', 'request_size', 'response_size',
+                 'output_size')
+
+    def __init__(self, id):
+        # pylint: disable=redefined-builtin
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        self.id = id
+        self.output_size = 0
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __repr__(self):
+        return 'RequestMetrics({})'.format(
+            ', '.join('{}={!r}'.format(key, value)
+                      for key, value in self.as_dict().items()
+                      if value is not None))
+
+
+class Histogram:
+    """A histogram with logarithmic buckets.  Each bucket is identified by
+the exponent of its upper bound, i.e., a value V falls into the bucket K
+with 2**(K-1) < V <= 2**K.  Zero falls into the bucket None."""
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        bucket = math.ceil(math.log2(value)) if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """Return an upper bound for the Q-quantile of all values."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda k: -math.inf if k is None else k):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return 0 if bucket is None else min(2 ** bucket, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.mean,
+                'min': self.min, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99)}
+
+
+class Metrics:
+    """Collects the RequestMetrics of all requests of a Lisp object.  Each
+metric is aggregated in a histogram, and each hook is called with the
+RequestMetrics of each request.  Nothing is recorded unless enabled is
+true."""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.hooks = []
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Call HOOK with the RequestMetrics of each request, and enable
+recording."""
+        self.hooks.append(hook)
+        self.enabled = True
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, metrics):
+        with self.lock:
+            for key, value in metrics.as_dict().items():
+                if key != 'id' and value is not None:
+                    self.histograms.setdefault(key, Histogram()).add(value)
+        for hook in self.hooks:
+            hook(metrics)
+
+    def summary(self):
+        """Return a dict from the name of each metric to a dict with its
+count, sum, mean, min, max and some quantiles."""
+        with self.lock:
+            return {key: histogram.summary()
+                    for key, histogram in self.histograms.items()}
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
@@ -0,0 +1,77 @@
+import threading
+from .data import Symbol, Keyword
+from .lisp import Lisp
+
+
+class ConnectionPool:
+    """A pool of connections to the Lisp server at ADDRESS.  Connections are
+created on demand, and up to MAXSIZE idle connections are kept for later
+reuse.  All other keyword arguments are passed to each new Lisp object."""
+    def __init__(self, address, maxsize=4, **kwargs):
+        self.address = address
+        self.maxsize = maxsize
+        self.kwargs = kwargs
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return an idle connection, or a new one if there is none.  The
+connection is returned to the pool by calling its close method."""
+        with self.lock:
+            while self.idle:
+                lisp = self.idle.pop()
+                if lisp.alive:
+                    return lisp
+        lisp = Lisp(address=self.address, **self.kwargs)
+        lisp.pool = self
+        return lisp
+
+    def release(self, lisp):
+        """Return LISP to the idle connections.  Any recording is stopped, and
+the current package is reset to COMMON-LISP-USER.  All other state of the
+connection, e.g., its handles, is kept, so the next user of the connection
+may still see it."""
+        lisp.stop_recording()
+        if lisp.alive and lisp.package != 'COMMON-LISP-USER':
+            try:
+                lisp.eval( (Symbol('IN-PACKAGE', 'COMMON-LISP'),
+                            Keyword('COMMON-LISP-USER')) )
+            except Exception:
+                lisp.terminate()
+                return
+        with self.lock:
+            if lisp.alive and len(self.idle) < self.maxsize:
+                self.idle.append(lisp)
+                return
+        lisp.terminate()
+
+    def close(self):
+        """Disconnect all idle connections."""
+        with self.lock:
+            (idle, self.idle) = (self.idle, [])
+        for lisp in idle:
+            lisp.terminate()
+
+
+# A dict from addresses to connection pools.
+pools = {}
+
+pools_lock = threading.Lock()
+
+
+def connect(address, **kwargs):
+    """Return a connection to the Lisp server at ADDRESS, which is either the
+file name of a Unix domain socket, the number of a TCP port on the local
+host, or a (host, port) tuple.  Closing the connection returns it to a
+pool, from which later calls to connect with the same address are served.
+The keyword arguments are only used when the pool is created, and a
+ValueError is raised if they differ from those of the existing pool."""
+    with pools_lock:
+        pool = pools.get(address)
+        if pool is None:
+            pool = pools[address] = ConnectionPool(address, **kwargs)
+        elif (kwargs.pop('maxsize', pool.maxsize) != pool.maxsize or
+              kwargs != pool.kwargs):
+            raise ValueError('The pool of connections to {!r} has been created '
+                             'with different arguments.'.format(address))
+    return pool.acquire()
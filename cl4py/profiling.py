@@ -0,0 +1,78 @@
+import re
+
+# A line of the flat report of SB-SPROF, i.e., the rank, the self count and
+# percentage, the total count and percentage, the cumulative count and
+# percentage, the number of calls, and the function.
+_FLAT_LINE = re.compile(r'^\s*(\d+)\s+(\d+)\s+([\d.]+)\s+(\d+)\s+([\d.]+)'
+                        r'\s+(\d+)\s+([\d.]+)\s+(\S+)\s+(.*?)\s*$')
+
+# The primary line of an entry of the call graph report, i.e., the self
+# count and percentage, the total count and percentage, the function, and
+# its index.
+_PRIMARY_LINE = re.compile(r'^\s*(\d+)\s+([\d.]+)\s+(\d+)\s+([\d.]+)\s+(.*?)\s+\[(\d+)\]\s*$')
+
+# A line with a caller or callee of an entry of the call graph report.
+_EDGE_LINE = re.compile(r'^\s*(\d+)\s+([\d.]+)\s+(.*?)\s+\[(\d+)\]\s*$')
+
+
+class ProfileReport:
+    """The result of profiling Lisp with lisp.profile().  The attribute flat
+is a list of dicts with the keys function, self, total and calls, sorted
+by self count.  The attribute graph is a list of dicts with the keys
+function, self, total, callers and callees, where callers and callees are
+lists of (function, count) tuples.  All counts are numbers of samples.  If
+profiling is not supported by the Lisp implementation, supported is false
+and both lists are empty."""
+    def __init__(self, mode):
+        self.mode = mode
+        self.supported = None
+        self.flat = []
+        self.graph = []
+        self.text = ''
+
+    def __repr__(self):
+        return '<ProfileReport mode={} entries={}>'.format(self.mode, len(self.flat))
+
+    def parse(self, flat_text, graph_text):
+        self.supported = True
+        self.text = flat_text
+        self.flat = parse_flat_report(flat_text)
+        self.graph = parse_graph_report(graph_text)
+
+
+def parse_flat_report(text):
+    entries = []
+    for line in text.splitlines():
+        match = _FLAT_LINE.match(line)
+        if match:
+            calls = match.group(8)
+            entries.append({'function': match.group(9),
+                            'self': int(match.group(2)),
+                            'total': int(match.group(4)),
+                            'calls': int(calls) if calls.isdigit() else None})
+    return entries
+
+
+def parse_graph_report(text):
+    entries = []
+    # The entries of the call graph are separated by lines of dashes.  Each
+    # entry consists of the callers, the primary line, and the callees.
+    for block in re.split(r'^-+$', text, flags=re.MULTILINE):
+        entry = None
+        callers = []
+        callees = []
+        for line in block.splitlines():
+            primary = _PRIMARY_LINE.match(line)
+            edge = _EDGE_LINE.match(line)
+            if primary and entry is None:
+                entry = {'function': primary.group(5),
+                         'self': int(primary.group(1)),
+                         'total': int(primary.group(3))}
+            elif edge:
+                (callees if entry else callers).append(
+                    (edge.group(3), int(edge.group(1))))
+        if entry:
+            entry['callers'] = callers
+            entry['callees'] = callees
+            entries.append(entry)
+    return entries
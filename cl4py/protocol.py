@@ -0,0 +1,138 @@
+import io
+import time
+import struct
+
+# The version of the framed protocol that is spoken by this module.
+FRAME_VERSION = 1
+
+# Each frame starts with the magic string b'CL', the protocol version, the
+# kind of message, the number of binary sections, the request ID, and the
+# length of the text in octets.  All integers are unsigned and big-endian.
+_FRAME_HEADER = struct.Struct('>2sBBHII')
+
+_SECTION_LENGTH = struct.Struct('>Q')
+
+_FRAME_KINDS = {'eval': 1, 'cancel': 2, 'quit': 3, 'output': 4, 'result': 5,
+                'callback': 6, 'return': 7, 'yield': 8, 'acknowledge': 9}
+
+_FRAME_KIND_NAMES = {code: kind for kind, code in _FRAME_KINDS.items()}
+
+
+class ProtocolError(RuntimeError):
+    """Signaled when a message from Lisp cannot be decoded."""
+
+
+class DecodeError(ProtocolError):
+    """The data of a frame whose text or sections cannot be decoded.  The
+frame has been read completely, so the following frames are not affected.
+The original exception is the cause of this one."""
+
+
+class TextProtocol:
+    """Messages are S-expressions, and the text of each request is preceded
+by its length.  Arrays are transferred via the file system."""
+    framed = False
+
+    def __init__(self, readtable, rfile, wfile):
+        self.readtable = readtable
+        self.rfile = io.TextIOWrapper(rfile, encoding='utf-8')
+        self.wfile = io.TextIOWrapper(wfile, write_through=True,
+                                      line_buffering=1, encoding='utf-8')
+
+    def send(self, kind, id=0, text='', sections=()):
+        """Send a message and return its size in characters."""
+        # pylint: disable=redefined-builtin,unused-argument
+        if kind in ('eval', 'return'):
+            message = '(:{} {} {})'.format(kind.upper(), id, len(text)) + text + '\n'
+        elif kind == 'cancel':
+            message = '(:CANCEL {})\n'.format(id)
+        elif kind == 'acknowledge':
+            message = '(:ACKNOWLEDGE {} {})\n'.format(id, text)
+        elif kind == 'quit':
+            message = '(:QUIT)\n'
+        else:
+            raise ProtocolError('Cannot send {} messages.'.format(kind))
+        self.wfile.write(message)
+        return len(message)
+
+    def receive(self):
+        """Return the kind, the request ID, the data and the statistics of the
+next message.  The text protocol collects no statistics."""
+        message = self.readtable.read(self.rfile)
+        kind = message.car.name.lower()
+        if kind == 'hello':
+            return (kind, 0, list(message.cdr), None)
+        elif kind in ('output', 'result', 'callback', 'yield'):
+            return (kind, message.cdr.car, message.cdr.cdr.car, None)
+        else:
+            raise ProtocolError('Invalid message: {}'.format(message))
+
+    def upgrade(self):
+        """Switch to the framed protocol and return it."""
+        self.wfile.write('(:PROTOCOL {})\n'.format(FRAME_VERSION))
+        return FramedProtocol(self.readtable,
+                              self.rfile.detach(),
+                              self.wfile.detach())
+
+
+class FramedProtocol:
+    """Messages are frames with a binary header, a text, and any number of
+binary sections.  Arrays are transferred as binary sections."""
+    framed = True
+
+    def __init__(self, readtable, rfile, wfile):
+        self.readtable = readtable
+        self.rfile = rfile
+        self.wfile = wfile
+
+    def send(self, kind, id=0, text='', sections=()):
+        """Send a message and return its size in bytes."""
+        # pylint: disable=redefined-builtin
+        data = text.encode('utf-8')
+        header = _FRAME_HEADER.pack(b'CL', FRAME_VERSION, _FRAME_KINDS[kind],
+                                    len(sections), id, len(data))
+        self.wfile.write(b''.join(
+            [header]
+            + [_SECTION_LENGTH.pack(len(section)) for section in sections]
+            + [data]))
+        # Sections are written one by one, so that large buffers are passed
+        # to the stream without being copied.
+        for section in sections:
+            self.wfile.write(section)
+        self.wfile.flush()
+        return (_FRAME_HEADER.size + _SECTION_LENGTH.size * len(sections)
+                + len(data) + sum(len(section) for section in sections))
+
+    def receive(self):
+        """Return the kind, the request ID, the data and the statistics of the
+next message.  The statistics are the size of the frame in bytes and the
+seconds spent decoding it."""
+        (magic, version, code, count, id, length) = \
+            _FRAME_HEADER.unpack(self.read(_FRAME_HEADER.size))
+        if magic != b'CL' or version != FRAME_VERSION or code not in _FRAME_KIND_NAMES:
+            raise ProtocolError('Invalid frame header.')
+        kind = _FRAME_KIND_NAMES[code]
+        lengths = [_SECTION_LENGTH.unpack(self.read(_SECTION_LENGTH.size))[0]
+                   for _ in range(count)]
+        text = self.read(length)
+        sections = [self.read(n) for n in lengths]
+        if kind not in ('output', 'result', 'callback', 'yield'):
+            raise ProtocolError('Cannot receive {} messages.'.format(kind))
+        start = time.perf_counter()
+        try:
+            if kind == 'output':
+                data = text.decode('utf-8')
+            else:
+                data = self.readtable.read_string(text.decode('utf-8'), sections)
+        except Exception as error: # pylint: disable=broad-except
+            # The error is raised by the request that this frame belongs to.
+            data = DecodeError('Cannot decode a {} message: {!r}'.format(kind, error))
+            data.__cause__ = error
+        size = _FRAME_HEADER.size + _SECTION_LENGTH.size * count + length + sum(lengths)
+        return (kind, id, data, (size, time.perf_counter() - start))
+
+    def read(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise EOFError()
+        return data
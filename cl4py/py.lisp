@@ -15,14 +15,54 @@
    #+mezzano   #:mezzano.clos
 
    #:compute-class-precedence-list
+   #:class-finalized-p
+   #:class-slots
+   #:finalize-inheritance
+   #:slot-definition-name
    #:specializer-direct-methods
    #:method-specializers
    #:method-generic-function
-   #:generic-function-name)
+   #:generic-function-name
+   #:funcallable-standard-class
+   #:set-funcallable-instance-function)
+  (:import-from
+   #+abcl      #:gray-streams
+   #+allegro   #:excl
+   #+clisp     #:gray
+   #+clozure   #:ccl
+   #+cmu       #:ext
+   #+ecl       #:gray
+   #+clasp     #:gray
+   #+lispworks #:stream
+   #+mcl       #:ccl
+   #+sbcl      #:sb-gray
+   #+scl       #:ext
+   #+mezzano   #:mezzano.gray
+
+   #:fundamental-character-output-stream
+   #:fundamental-character-input-stream
+   #:fundamental-binary-input-stream
+   #:stream-read-char
+   #:stream-unread-char
+   #:stream-read-byte
+   #:stream-write-char
+   #:stream-write-string
+   #:stream-line-column
+   #:stream-finish-output
+   #:stream-force-output)
   (:export
    #:cl4py
    #:quit
-   #:class-information
+   #:transfer-by-value
+   #:evaluation-interrupted
+   #:python-error
+   #:python-function
+   #:python-bytes
+   #:with-emitter
+   #:emit
+   #:python-iterator
+   #:next-item
+   #:do-items
    #:dtype-from-type
    #:dtype-from-code
    #:dtype-endianness
@@ -41,6 +81,66 @@
 ;;; reads expressions from the Python side and prints results back to
 ;;; Python.
 
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Threads
+;;;
+;;; On implementations with thread support, requests from Python are
+;;; evaluated by a pool of worker threads.  Elsewhere, all requests are
+;;; evaluated by the REPL itself, one at a time.  The following functions
+;;; and macros are a minimal portability layer.
+
+(defun threads-supported-p ()
+  #+sb-thread t
+  #-sb-thread nil)
+
+(defun current-thread ()
+  #+sbcl sb-thread:*current-thread*
+  #-sbcl t)
+
+(defun make-lock (name)
+  #+sb-thread (sb-thread:make-mutex :name name)
+  #-sb-thread name)
+
+(defmacro with-lock ((lock) &body body)
+  #+sb-thread `(sb-thread:with-recursive-lock (,lock) ,@body)
+  #-sb-thread `(progn ,lock ,@body))
+
+(defmacro without-interrupts (&body body)
+  #+sbcl `(sb-sys:without-interrupts ,@body)
+  #-sbcl `(progn ,@body))
+
+(defun make-condition-variable (name)
+  #+sb-thread (sb-thread:make-waitqueue :name name)
+  #-sb-thread name)
+
+;;; Wait until CONDITION-VARIABLE is notified, or until TIMEOUT seconds have
+;;; passed, in which case false is returned.  LOCK is held again afterwards
+;;; in either case.
+(defun condition-variable-wait (condition-variable lock &optional timeout)
+  #+sb-thread (or (sb-thread:condition-wait condition-variable lock :timeout timeout)
+                  (progn (unless (sb-thread:holding-mutex-p lock)
+                           (sb-thread:grab-mutex lock))
+                         nil))
+  #-sb-thread (progn lock timeout
+                     (error "Cannot wait for ~S without threads." condition-variable)))
+
+(defun condition-variable-notify (condition-variable)
+  #+sb-thread (sb-thread:condition-notify condition-variable)
+  #-sb-thread condition-variable)
+
+(defun condition-variable-broadcast (condition-variable)
+  #+sb-thread (sb-thread:condition-broadcast condition-variable)
+  #-sb-thread condition-variable)
+
+(defun spawn-thread (function name)
+  #+sb-thread (sb-thread:make-thread function :name name)
+  #-sb-thread (error "Cannot spawn the thread ~S." name))
+
+(defun interrupt-thread (thread function)
+  #+sbcl (sb-thread:interrupt-thread thread function)
+  #-sbcl (progn thread (funcall function)))
+
 ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 ;;;
 ;;; Object Handles
@@ -50,21 +150,65 @@
 ;;; handles, by means of the #n? and #n! reader macros. The Python side is
 ;;; responsible for declaring when a handle may be deleted.
 
-(defvar *handle-counter* 0)
+;;; Each connection to Python has its own handle table.  Handles can also
+;;; belong to a handle scope, which is identified by an integer that Python
+;;; has chosen.  All handles of a scope are freed at once, see
+;;; FREE-HANDLE-SCOPE.
+
+(defstruct (handle-table (:constructor make-handle-table ()))
+  (counter 0)
+  (objects (make-hash-table :test #'eql) :read-only t)
+  ;; A hash table from handle scopes to lists of their handles.
+  (scopes (make-hash-table :test #'eql) :read-only t)
+  (lock (make-lock "cl4py handles") :read-only t))
+
+;;; The handle table of the connection whose request is being processed.
+(defvar *handle-table* (make-handle-table))
 
-(defvar *foreign-objects* (make-hash-table :test #'eql))
+;;; The handle scope of the request that is being processed, or NIL.
+(defvar *handle-scope* nil)
 
 (defun free-handle (handle)
-  (remhash handle *foreign-objects*))
+  (let ((table *handle-table*))
+    (with-lock ((handle-table-lock table))
+      (remhash handle (handle-table-objects table)))))
 
 (defun handle-object (handle)
-  (or (gethash handle *foreign-objects*)
-      (error "Invalid Handle.")))
+  (let ((table *handle-table*))
+    (or (with-lock ((handle-table-lock table))
+          (gethash handle (handle-table-objects table)))
+        (error "Invalid Handle."))))
 
 (defun object-handle (object)
-  (let ((handle (incf *handle-counter*)))
-    (setf (gethash handle *foreign-objects*) object)
-    handle))
+  (let ((table *handle-table*)
+        (scope *handle-scope*))
+    (with-lock ((handle-table-lock table))
+      (let ((handle (incf (handle-table-counter table))))
+        (setf (gethash handle (handle-table-objects table)) object)
+        (when scope
+          (push handle (gethash scope (handle-table-scopes table))))
+        handle))))
+
+;;; Free all handles of SCOPE, except for the RETAINED ones, which are moved
+;;; to the scope PARENT instead, unless it is NIL.  Return the number of
+;;; freed handles.
+(defun free-handle-scope (scope parent &rest retained)
+  (let* ((table *handle-table*)
+         (objects (handle-table-objects table))
+         (scopes (handle-table-scopes table))
+         (retained (let ((set (make-hash-table :test #'eql)))
+                     (dolist (handle retained set)
+                       (setf (gethash handle set) t))))
+         (count 0))
+    (with-lock ((handle-table-lock table))
+      (dolist (handle (gethash scope scopes))
+        (cond ((not (gethash handle retained))
+               (remhash handle objects)
+               (incf count))
+              (parent
+               (push handle (gethash parent scopes)))))
+      (remhash scope scopes))
+    count))
 
 ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 ;;;
@@ -76,22 +220,99 @@
   (free-handle n)
   (values))
 
+;;; The #n% reader macro declares that all handles that are created while
+;;; processing the current request belong to the handle scope N.
+(defun sharpsign-percent-sign (s c n)
+  (declare (ignore s c))
+  (setf *handle-scope* n)
+  (values))
+
 ;;; The #n? reader macro retrieves the object corresponding to the supplied
 ;;; handle.
 (defun sharpsign-question-mark (s c n)
   (declare (ignore s c))
   (handle-object n))
 
+;;; While reading or printing the text of a frame, this variable holds the
+;;; vector of binary sections of that frame.  Otherwise, it is NIL.
+(defvar *sections* nil)
+
 ;;; The #N reader macro is used to retrieve NumPy arrays.  For performance
 ;;; reasons, those arrays are not communicated as text, but in a binary
-;;; format via the file system.
+;;; format via the file system.  Arrays of objects are the exception.  They
+;;; are written as a list of their dimensions, followed by their elements in
+;;; row-major order, e.g., #N((2 2) 1 "a" 2 "b").
 (defun sharpsign-n (s c n)
   (declare (ignore c n))
-  (let* ((file (read s))
-         (array (load-array file)))
-    (delete-file file)
+  (when (char= (peek-char t s t nil t) #\()
+    (read-char s t nil t)
+    (return-from sharpsign-n (read-object-array s)))
+  (let ((source (read s)))
+    ;; In the framed protocol, the array is one of the binary sections of
+    ;; the current message.
+    (if (integerp source)
+        (octets-array (aref *sections* source))
+        (let ((array (load-array source)))
+          (delete-file source)
+          array))))
+
+(defun read-object-array (s)
+  (let ((array (make-array (read s t nil t))))
+    (loop for index below (array-total-size array) do
+      (setf (row-major-aref array index) (read s t nil t)))
+    (unless (char= (peek-char t s t nil t) #\))
+      (error "Too many elements for an array of dimensions ~S."
+             (array-dimensions array)))
+    (read-char s t nil t)
     array))
 
+;;; Octet vectors are only sent back to Python as bytes objects if they
+;;; have been received as bytes objects, or if they have been passed to
+;;; PYTHON-BYTES.  All other octet vectors are NumPy arrays in Python.
+(defvar *python-bytes*
+  (make-hash-table :test 'eq
+                   #+sbcl :weakness #+sbcl :key
+                   #+sbcl :synchronized #+sbcl t))
+
+(defun python-bytes (octets)
+  "Return the octet vector OCTETS, which is sent to Python as a bytes object."
+  (check-type octets (simple-array (unsigned-byte 8) (*)))
+  (setf (gethash octets *python-bytes*) t)
+  octets)
+
+(defun python-bytes-p (object)
+  (values (gethash object *python-bytes*)))
+
+;;; The #Y reader macro is used to retrieve Python bytes objects, which are
+;;; octet vectors in Lisp.  In the framed protocol, the octets are a binary
+;;; section, and the section itself is returned without copying.  In the
+;;; text protocol, the octets are written as a string of hex digits.
+(defun sharpsign-y (s c n)
+  (declare (ignore c n))
+  (let ((source (read s)))
+    (python-bytes
+     (if (integerp source)
+         (aref *sections* source)
+         (hex-octets source)))))
+
+(defun hex-octets (string)
+  (let ((octets (make-array (floor (length string) 2)
+                            :element-type '(unsigned-byte 8))))
+    (loop for index below (length octets) do
+      (setf (aref octets index)
+            (+ (* 16 (digit-char-p (schar string (* 2 index)) 16))
+               (digit-char-p (schar string (1+ (* 2 index))) 16))))
+    octets))
+
+;;; Python sends infinities and NaNs as #F(WIDTH BITS), where BITS are the
+;;; bits of an IEEE 754 float of WIDTH bits.
+(defun sharpsign-f (s c n)
+  (declare (ignore c n))
+  (destructuring-bind (width bits) (read s t nil t)
+    (ecase width
+      (32 (decode-float32 bits))
+      (64 (decode-float64 bits)))))
+
 ;;; We introduce a curly bracket notation to send hash tables.
 (defun left-curly-bracket (stream char)
   (declare (ignore char))
@@ -114,15 +335,85 @@
   (error 'unmatched-closing-curly-bracket
          :stream stream))
 
+;;; The #S reader macro reconstructs instances that have been transferred
+;;; by value.  Unlike the standard #S syntax, it works for both structures
+;;; and standard objects, and it doesn't call any constructor.  Instead, a
+;;; fresh instance is allocated and each supplied slot is set directly.
+(defun sharpsign-s (s c n)
+  (declare (ignore c n))
+  (destructuring-bind (class-name &rest plist) (read s t nil t)
+    (let ((instance (allocate-instance (find-class class-name))))
+      (loop for (slot-name value) on plist by #'cddr do
+        (setf (slot-value instance slot-name) value))
+      instance)))
+
 (defvar *cl4py-readtable*
   (let ((r (copy-readtable)))
     (set-dispatch-macro-character #\# #\! 'sharpsign-exclamation-mark r)
     (set-dispatch-macro-character #\# #\? 'sharpsign-question-mark r)
+    (set-dispatch-macro-character #\# #\% 'sharpsign-percent-sign r)
     (set-dispatch-macro-character #\# #\N 'sharpsign-n r)
+    (set-dispatch-macro-character #\# #\S 'sharpsign-s r)
+    (set-dispatch-macro-character #\# #\Y 'sharpsign-y r)
+    (set-dispatch-macro-character #\# #\F 'sharpsign-f r)
     (set-macro-character #\{ 'left-curly-bracket nil r)
     (set-macro-character #\} 'right-curly-bracket nil r)
     (values r)))
 
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; By-Value Transfer
+;;;
+;;; By default, structures and standard objects are sent to Python as
+;;; handles, so that each slot access from Python costs one round trip.
+;;; Classes can opt in to being sent as a snapshot of their slot values
+;;; instead, using the notation #S(CLASS-NAME SLOT-1 VALUE-1 ...).  The
+;;; first time an instance of such a class is sent, its class name is
+;;; replaced by a list of the class name and all its slot names, so that
+;;; the Python side can generate a suitable class.  The slot names are sent
+;;; again whenever the class has been redefined with different slots.
+
+;;; A hash table whose keys are the names of all classes whose instances
+;;; should be sent by value.
+(defvar *by-value-classes* (make-hash-table :test #'eq))
+
+;;; A hash table that maps the names of all by-value classes whose slot
+;;; names have already been sent to Python to the list of those slot names.
+(defvar *announced-by-value-classes* (make-hash-table :test #'eq))
+
+(defun transfer-by-value (class-name &optional (enable t))
+  (if enable
+      (setf (gethash class-name *by-value-classes*) t)
+      (remhash class-name *by-value-classes*))
+  class-name)
+
+(defun by-value-p (object)
+  (values (gethash (class-name (class-of object)) *by-value-classes*)))
+
+(defun class-slot-names (class)
+  (unless (class-finalized-p class)
+    (finalize-inheritance class))
+  (mapcar #'slot-definition-name (class-slots class)))
+
+(defun by-value-plist (object)
+  (loop for slot-name in (class-slot-names (class-of object))
+        when (slot-boundp object slot-name)
+          collect slot-name
+          and collect (slot-value object slot-name)))
+
+(defun pyprint-write-by-value (object stream)
+  (let* ((class (class-of object))
+         (class-name (class-name class))
+         (slot-names (class-slot-names class)))
+    (write-string "#S" stream)
+    (pyprint-object
+     (cons (if (equal (gethash class-name *announced-by-value-classes*) slot-names)
+               class-name
+               (progn (setf (gethash class-name *announced-by-value-classes*) slot-names)
+                      (cons class-name slot-names)))
+           (by-value-plist object))
+     stream)))
+
 ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 ;;;
 ;;; Printing for Python
@@ -132,8 +423,14 @@
 ;;; before sending them to Python and replace occurrences of non
 ;;; serializable objects with reference handles.
 ;;;
-;;; The printed structure is scanned first, such that circular structure
-;;; can be printed correctly using #N= and #N#.
+;;; Unless *PYPRINT-CIRCLE* is false, the printed structure is scanned
+;;; first, such that shared and circular structure can be printed correctly
+;;; using #N= and #N#.  Objects that cannot contain other objects, such as
+;;; numbers, symbols and strings, are never scanned.
+;;;
+;;; The common types of objects are printed by PYPRINT-OBJECT, which
+;;; dispatches with TYPECASE.  All other objects are printed by the generic
+;;; function PYPRINT-WRITE.
 
 ;;; Each entry in the *pyprint-table* is either the value T, meaning the
 ;;; object has been visited once, or its ID (an integer), meaning the
@@ -145,6 +442,11 @@
 
 (defvar *pyprint-counter*)
 
+;;; Whether shared and circular structure is detected when printing.  If
+;;; it is false, printing is faster, but circular structure cannot be
+;;; printed at all, and shared structure is printed multiple times.
+(defvar *pyprint-circle* t)
+
 ;; We use this dummy package during printing, to have each symbol written
 ;; with its full package prefix.
 (defpackage #:cl4py-empty-package (:use))
@@ -154,49 +456,62 @@
 (defgeneric pyprint-write (object stream))
 
 (defun pyprint (object &optional (stream *standard-output*))
-  (let ((*pyprint-table* (make-hash-table :test #'eql))
+  (let ((*pyprint-table* (make-hash-table :test #'eq))
         (*pyprint-counter* 0))
-    (pyprint-scan object)
+    (when *pyprint-circle*
+      (pyprint-scan-object object))
     (with-standard-io-syntax
       (let ((*package* (find-package '#:cl4py-empty-package)))
-        (pyprint-write object stream)))
+        (pyprint-object object stream)))
     (terpri stream)
     object))
 
-(defmethod pyprint-scan :around ((object t))
-  (unless (or (symbolp object)
-              (numberp object)
-              (characterp object))
-    (multiple-value-bind (value present-p)
-        (gethash object *pyprint-table*)
-      (cond ((not present-p)
-             (setf (gethash object *pyprint-table*) t)
-             (call-next-method))
-            ((eq value t)
-             (setf (gethash object *pyprint-table*)
-                   (incf *pyprint-counter*))))
-      (values))))
+;;; Record a visit of OBJECT, and return whether it is the first one.
+(defun pyprint-visit (object)
+  (let ((value (gethash object *pyprint-table*)))
+    (cond ((not value)
+           (setf (gethash object *pyprint-table*) t))
+          ((eq value t)
+           (setf (gethash object *pyprint-table*) (incf *pyprint-counter*))
+           nil)
+          (t nil))))
+
+(defun pyprint-scan-object (object)
+  ;; The cdrs of lists are scanned iteratively, so that long lists don't
+  ;; exhaust the stack.
+  (loop
+    (typecase object
+      ((or number symbol character string)
+       (return))
+      ((and array (not (array t)))
+       (pyprint-visit object)
+       (return))
+      (cons
+       (unless (pyprint-visit object)
+         (return))
+       (pyprint-scan-object (car object))
+       (setf object (cdr object)))
+      (t
+       (when (pyprint-visit object)
+         (pyprint-scan object))
+       (return)))))
 
 (defmethod pyprint-scan ((object t))
   (declare (ignore object)))
 
-(defmethod pyprint-scan ((cons cons))
-  (pyprint-scan (car cons))
-  (pyprint-scan (cdr cons)))
-
 (defmethod pyprint-scan ((sequence sequence))
-  (map nil #'pyprint-scan sequence))
+  (map nil #'pyprint-scan-object sequence))
 
 (defmethod pyprint-scan ((array array))
   (loop for index below (array-total-size array) do
-    (pyprint-scan (row-major-aref array index))))
+    (pyprint-scan-object (row-major-aref array index))))
 
 (defmethod pyprint-scan ((hash-table hash-table))
   (when (eq (hash-table-test hash-table) 'equal)
     (maphash
      (lambda (key value)
-       (pyprint-scan key)
-       (pyprint-scan value))
+       (pyprint-scan-object key)
+       (pyprint-scan-object value))
      hash-table)))
 
 (defconstant +syntax-tag+ 0)
@@ -222,45 +537,145 @@
                   alist))))
     alist))
 
+(defmethod pyprint-scan ((object structure-object))
+  (when (by-value-p object)
+    (mapc #'pyprint-scan-object (by-value-plist object))))
+
+(defmethod pyprint-scan ((object standard-object))
+  (when (by-value-p object)
+    (mapc #'pyprint-scan-object (by-value-plist object))))
+
 (defmethod pyprint-scan ((package package))
-  (pyprint-scan (package-name package))
-  (mapc #'pyprint-scan (package-contents-alist package)))
-
-(defmethod pyprint-write :around ((object t) stream)
-  (let ((id (gethash object *pyprint-table*)))
-    (if (integerp id)
-        (cond ((plusp id)
-               (setf (gethash object *pyprint-table*) (- id))
-               (format stream "#~D=" id)
-               (call-next-method))
-              ((minusp id)
-               (format stream "#~D#" (- id))))
-        (call-next-method))))
+  (mapc #'pyprint-scan-object (package-contents-alist package)))
+
+;;; Return the ID of OBJECT if it has been scanned multiple times, or NIL.
+;;; As long as no object has been scanned multiple times, the table need
+;;; not be consulted at all.
+(declaim (inline pyprint-id))
+(defun pyprint-id (object)
+  (when (plusp *pyprint-counter*)
+    (let ((id (gethash object *pyprint-table*)))
+      (and (integerp id) id))))
+
+(defun pyprint-object (object stream)
+  (let ((id (pyprint-id object)))
+    (when id
+      (when (minusp id)
+        (format stream "#~D#" (- id))
+        (return-from pyprint-object))
+      (setf (gethash object *pyprint-table*) (- id))
+      (format stream "#~D=" id)))
+  (typecase object
+    (number (pyprint-number object stream))
+    (symbol (write object :stream stream))
+    (string (pyprint-string object stream))
+    (cons (pyprint-list object stream))
+    (simple-vector (pyprint-simple-vector object stream))
+    (t (pyprint-write object stream))))
+
+;;; Floats are printed with the shortest number of digits that reads back
+;;; as the same float.  Infinities and NaNs have no such representation, so
+;;; they are written as #F(WIDTH BITS) instead.
+(defun pyprint-number (number stream)
+  (typecase number
+    ((or single-float double-float)
+     (if (float-finite-p number)
+         (write number :stream stream)
+         (multiple-value-bind (bits width) (float-bits number)
+           (format stream "#F(~D ~D)" width bits))))
+    ((complex (or single-float double-float))
+     (write-string "#C(" stream)
+     (pyprint-number (realpart number) stream)
+     (write-char #\Space stream)
+     (pyprint-number (imagpart number) stream)
+     (write-char #\) stream))
+    (t (write number :stream stream))))
+
+;;; Strings are written in chunks between the characters that have to be
+;;; escaped.
+(defun pyprint-string (string stream)
+  (write-char #\" stream)
+  (loop with start = 0
+        for end = (position-if (lambda (char) (or (char= char #\") (char= char #\\)))
+                               string :start start)
+        do (write-string string stream :start start :end end)
+        while end do
+          (write-char #\\ stream)
+          (write-char (char string end) stream)
+          (setf start (1+ end)))
+  (write-char #\" stream))
+
+(defun pyprint-list (list stream)
+  (write-string "(" stream)
+  (loop for cons = list then cdr
+        for cdr = (cdr cons) do
+          (pyprint-object (car cons) stream)
+          (write-string " " stream)
+          (cond ((null cdr)
+                 (loop-finish))
+                ((or (atom cdr)
+                     (pyprint-id cdr))
+                 (write-string " . " stream)
+                 (pyprint-object cdr stream)
+                 (loop-finish))))
+  (write-string ")" stream))
+
+(defun pyprint-simple-vector (vector stream)
+  (write-string "#(" stream)
+  (loop for elt across vector do
+    (pyprint-object elt stream)
+    (write-char #\space stream))
+  (write-string ")" stream))
+
+;;; Objects that cannot be printed readably are sent as #N?CLASS-NAME.  The
+;;; first time an instance of a particular class is sent, the class name is
+;;; replaced by a list of the class name and the names of all its member
+;;; functions.  This way, the Python side can generate a suitable wrapper
+;;; class without any further round trips.
+
+;;; A hash table whose keys are the names of all classes whose member
+;;; functions have already been sent to Python.
+(defvar *announced-classes* (make-hash-table :test #'eq))
 
 (defmethod pyprint-write ((object t) stream)
-  (format stream "#~D?~S"
-          (object-handle object)
-          (class-name (class-of object))))
+  (let* ((class (class-of object))
+         (class-name (class-name class)))
+    ;; Handles of a handle scope are written as #n$SCOPE, so that Python
+    ;; can release them together with their scope.
+    (if *handle-scope*
+        (format stream "#~D$~D " (object-handle object) *handle-scope*)
+        (format stream "#~D?" (object-handle object)))
+    (pyprint-object
+     (if (gethash class-name *announced-classes*)
+         class-name
+         (progn (setf (gethash class-name *announced-classes*) t)
+                (cons class-name (class-member-function-names class))))
+     stream)))
 
 (defmethod pyprint-write ((number number) stream)
-  (write number :stream stream))
+  (pyprint-number number stream))
 
 (defmethod pyprint-write ((symbol symbol) stream)
   (write symbol :stream stream))
 
 (defmethod pyprint-write ((string string) stream)
-  (write-char #\" stream)
-  (loop for char across string do
-    (when (member char '(#\" #\\))
-      (write-char #\\ stream))
-    (write-char char stream))
-  (write-char #\" stream))
+  (pyprint-string string stream))
 
 (defmethod pyprint-write ((character character) stream)
   (write character :stream stream))
 
 (defmethod pyprint-write ((pathname pathname) stream)
-  (pyprint-write (namestring (truename pathname)) stream))
+  (pyprint-string (namestring (truename pathname)) stream))
+
+(defmethod pyprint-write ((object structure-object) stream)
+  (if (by-value-p object)
+      (pyprint-write-by-value object stream)
+      (call-next-method)))
+
+(defmethod pyprint-write ((object standard-object) stream)
+  (if (by-value-p object)
+      (pyprint-write-by-value object stream)
+      (call-next-method)))
 
 (defun specializer-direct-member-functions (specializer)
   (loop for method in (specializer-direct-methods specializer)
@@ -274,81 +689,79 @@
    (mapcan #'specializer-direct-member-functions
            (remove (find-class 't) (compute-class-precedence-list class)))))
 
+(defun class-member-function-names (class)
+  (remove-if-not #'member-function-name-p
+                 (mapcar #'generic-function-name
+                         (class-member-functions class))))
+
 (defmethod pyprint-write ((package package) stream)
   (write-string "#M" stream)
-  (pyprint-write
+  (pyprint-object
    (cons (package-name package)
          (package-contents-alist package))
    stream))
 
 (defmethod pyprint-write ((cons cons) stream)
-  (write-string "(" stream)
-  (loop for car = (car cons)
-        for cdr = (cdr cons) do
-          (pyprint-write car stream)
-          (write-string " " stream)
-          (cond ((null cdr)
-                 (loop-finish))
-                ((or (atom cdr)
-                     (integerp (gethash cdr *pyprint-table*)))
-                 (write-string " . " stream)
-                 (pyprint-write cdr stream)
-                 (loop-finish))
-                (t
-                 (setf cons cdr))))
-  (write-string ")" stream))
+  (pyprint-list cons stream))
 
 (defmethod pyprint-write ((vector vector) stream)
-  (cond ((simple-vector-p vector)
-         (write-string "#(" stream)
-         (loop for elt across vector do
-           (pyprint-write elt stream)
-           (write-char #\space stream))
-         (write-string ")" stream))
-        (t
-         (call-next-method))))
+  (if (simple-vector-p vector)
+      (pyprint-simple-vector vector stream)
+      (call-next-method)))
 
 (defmethod pyprint-write ((hash-table hash-table) stream)
   (cond ((eql (hash-table-test hash-table) 'equal)
          (write-string "{" stream)
          (maphash
           (lambda (key value)
-            (pyprint-write key stream)
+            (pyprint-object key stream)
             (write-char #\space stream)
-            (pyprint-write value stream)
+            (pyprint-object value stream)
             (write-char #\space stream))
           hash-table)
          (write-string "}" stream))
         (t
          (call-next-method))))
 
-(defun array-contents (array)
-  (labels ((contents (dimensions index)
-             (if (null dimensions)
-                 (row-major-aref array index)
-                 (let* ((dimension (car dimensions))
-                        (dimensions (cdr dimensions))
-                        (count (reduce #'* dimensions)))
-                   (loop for i below dimension
-                         collect (contents dimensions index)
-                         do (incf index count))))))
-    (contents (array-dimensions array) 0)))
+;;; Octet vectors are sent as Python bytes objects, either as a binary
+;;; section or as a string of hex digits.
+(defun pyprint-octets (octets stream)
+  (declare (type (simple-array (unsigned-byte 8) (*)) octets))
+  (write-char #\# stream)
+  (write-char #\Y stream)
+  (if *sections*
+      (write (vector-push-extend octets *sections*) :stream stream)
+      (let ((digits "0123456789abcdef"))
+        (write-char #\" stream)
+        (loop for octet across octets do
+          (write-char (schar digits (ash octet -4)) stream)
+          (write-char (schar digits (logand octet 15)) stream))
+        (write-char #\" stream))))
 
 (defmethod pyprint-write ((array array) stream)
   (let ((dtype (ignore-errors (dtype-from-type (array-element-type array)))))
-    (cond ((or (not dtype)
+    (cond ((and (typep array '(simple-array (unsigned-byte 8) (*)))
+                (python-bytes-p array))
+           (pyprint-octets array stream))
+          ((or (not dtype)
                (eq (dtype-type dtype) t))
            ;; Case 1 - General Arrays.
+           (write-string "#N(" stream)
+           (pyprint-object (array-dimensions array) stream)
+           (loop for index below (array-total-size array) do
+             (write-char #\space stream)
+             (pyprint-object (row-major-aref array index) stream))
+           (write-char #\) stream))
+          (*sections*
            (write-char #\# stream)
-           (write (array-rank array) :stream stream)
-           (write-char #\A stream)
-           (pyprint-write (array-contents array) stream))
+           (write-char #\N stream)
+           (write (vector-push-extend (array-octets array) *sections*) :stream stream))
           (t
            (let ((path (format nil "/tmp/cl4py-array-~D.npy" (random most-positive-fixnum))))
              (store-array array path)
              (write-char #\# stream)
              (write-char #\N stream)
-             (pyprint-write path stream))))))
+             (pyprint-string path stream))))))
 
 ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 ;;;
@@ -437,10 +850,49 @@
                (scale-float (if (zerop sign) float-significand (- float-significand))
                             (- exponent ,(+ exponent-offset significand-bits)))))))))) ; (E)
 
-;; And instances of the above for the common forms of floats.
+;; And instances of the above for the common forms of floats.  On SBCL,
+;; the bits of each float are accessed directly instead, which is faster and
+;; also works for infinities and NaNs.
 (declaim (inline encode-float32 decode-float32 encode-float64 decode-float64))
-(make-float-converters encode-float32 decode-float32 8 23 nil)
-(make-float-converters encode-float64 decode-float64 11 52 nil)
+#-sbcl (make-float-converters encode-float32 decode-float32 8 23 nil)
+#-sbcl (make-float-converters encode-float64 decode-float64 11 52 nil)
+
+#+sbcl
+(progn
+  (defun encode-float32 (float)
+    (declare (single-float float))
+    (ldb (byte 32 0) (sb-kernel:single-float-bits float)))
+
+  (defun decode-float32 (bits)
+    (declare (type (unsigned-byte 32) bits))
+    (sb-kernel:make-single-float
+     (if (logbitp 31 bits) (- bits (expt 2 32)) bits)))
+
+  (defun encode-float64 (float)
+    (declare (double-float float))
+    (logior (ash (ldb (byte 32 0) (sb-kernel:double-float-high-bits float)) 32)
+            (sb-kernel:double-float-low-bits float)))
+
+  (defun decode-float64 (bits)
+    (declare (type (unsigned-byte 64) bits))
+    (let ((high (ldb (byte 32 32) bits)))
+      (sb-kernel:make-double-float
+       (if (logbitp 31 high) (- high (expt 2 32)) high)
+       (ldb (byte 32 0) bits)))))
+
+;;; Return the bits of FLOAT and their number.
+(defun float-bits (float)
+  (etypecase float
+    (single-float (values (encode-float32 float) 32))
+    (double-float (values (encode-float64 float) 64))))
+
+;;; Return whether FLOAT is neither infinite nor a NaN, i.e., whether all
+;;; bits of its exponent are not set.
+(defun float-finite-p (float)
+  (multiple-value-bind (bits width) (float-bits float)
+    (if (= width 32)
+        (/= (ldb (byte 8 23) bits) #xFF)
+        (/= (ldb (byte 11 52) bits) #x7FF))))
 
 (defconstant +endianness+
   #+(and sbcl little-endian) :little-endian
@@ -501,6 +953,7 @@
 
 (define-dtype "O" 't 64)
 (define-dtype "?" 'bit 1)
+(define-dtype "|b1" 'bit 1)
 (define-dtype "b" '(unsigned-byte 8) 8)
 (define-multibyte-dtype "i1" '(signed-byte 8) 8)
 (define-multibyte-dtype "i2" '(signed-byte 16) 16)
@@ -705,25 +1158,11 @@
   ;; We open the file twice - once with a stream element type of
   ;; (unsigned-byte 8) to write the header, and once with a stream element
   ;; type suitable for writing the array content.
-  (let* ((dtype (dtype-from-type (array-element-type array)))
-         (metadata (array-metadata-string array))
-         (metadata-length (- (* 64 (ceiling (+ 10 (length metadata)) 64)) 10)))
+  (let ((dtype (dtype-from-type (array-element-type array))))
     (with-open-file (stream filename :direction :output
                                      :element-type '(unsigned-byte 8)
                                      :if-exists :supersede)
-      (write-sequence #(#x93 78 85 77 80 89) stream) ; The magic string.
-      (write-byte 1 stream) ; Major version.
-      (write-byte 0 stream) ; Minor version.
-      ;; Write the length of the metadata string (2 bytes, little endian).
-      (write-byte (ldb (byte 8 0) metadata-length) stream)
-      (write-byte (ldb (byte 8 8) metadata-length) stream)
-      ;; Write the metadata string.
-      (loop for char across metadata do
-        (write-byte (char-code char) stream))
-      ;; Pad the header with spaces for 64 byte alignment.
-      (loop repeat (- metadata-length (length metadata) 1) do
-        (write-byte (char-code #\space) stream))
-      (write-byte (char-code #\newline) stream)) ; Finish with a newline.
+      (write-sequence (array-header-octets array) stream))
     ;; Now, open the file a second time to write the array contents.
     (let* ((chunk-size (if (subtypep (array-element-type array) 'complex)
                            (/ (dtype-size dtype) 2)
@@ -757,6 +1196,169 @@
            (loop for index below total-size do
              (write-byte (row-major-aref array index) stream))))))))
 
+;;; Return the header of a Numpy file containing ARRAY as a vector of
+;;; octets.
+(defun array-header-octets (array)
+  (let* ((metadata (array-metadata-string array))
+         (metadata-length (- (* 64 (ceiling (+ 10 (length metadata)) 64)) 10))
+         (octets (make-array (+ 10 metadata-length)
+                             :element-type '(unsigned-byte 8)
+                             ;; Pad the header with spaces for 64 byte
+                             ;; alignment.
+                             :initial-element (char-code #\space))))
+    (replace octets #(#x93 78 85 77 80 89)) ; The magic string.
+    (setf (aref octets 6) 1) ; Major version.
+    (setf (aref octets 7) 0) ; Minor version.
+    ;; The length of the metadata string (2 bytes, little endian).
+    (setf (aref octets 8) (ldb (byte 8 0) metadata-length))
+    (setf (aref octets 9) (ldb (byte 8 8) metadata-length))
+    (loop for char across metadata
+          for index from 10 do
+            (setf (aref octets index) (char-code char)))
+    ;; Finish with a newline.
+    (setf (aref octets (+ 9 metadata-length)) (char-code #\newline))
+    octets))
+
+;;; The following two functions convert arrays to and from the contents of
+;;; Numpy files, without going through the file system.  Each element is
+;;; split into chunks, i.e., integers of the size of the element or, for
+;;; complex numbers, of the size of its real part.
+
+(defun dtype-chunk-octets (dtype)
+  (max 1 (floor (if (subtypep (dtype-type dtype) 'complex)
+                    (/ (dtype-size dtype) 2)
+                    (dtype-size dtype))
+                8)))
+
+(defun array-octets (array)
+  (let* ((header (array-header-octets array))
+         (dtype (dtype-from-type (array-element-type array)))
+         (chunk-octets (dtype-chunk-octets dtype))
+         (little-endian (eq (dtype-endianness dtype) :little-endian))
+         (total-size (array-total-size array))
+         (octets (make-array (+ (length header)
+                                (* total-size
+                                   chunk-octets
+                                   (if (subtypep (dtype-type dtype) 'complex) 2 1)))
+                             :element-type '(unsigned-byte 8)))
+         (position (length header)))
+    (replace octets header)
+    (flet ((store-chunk (integer)
+             (loop for index below chunk-octets do
+               (setf (aref octets (+ position
+                                     (if little-endian
+                                         index
+                                         (- chunk-octets index 1))))
+                     (ldb (byte 8 (* 8 index)) integer)))
+             (incf position chunk-octets)))
+      (loop for index below total-size do
+        (let ((element (row-major-aref array index)))
+          (etypecase element
+            (single-float
+             (store-chunk (encode-float32 element)))
+            (double-float
+             (store-chunk (encode-float64 element)))
+            ((complex single-float)
+             (store-chunk (encode-float32 (realpart element)))
+             (store-chunk (encode-float32 (imagpart element))))
+            ((complex double-float)
+             (store-chunk (encode-float64 (realpart element)))
+             (store-chunk (encode-float64 (imagpart element))))
+            (integer
+             (store-chunk element))))))
+    octets))
+
+(defun octets-array (octets)
+  (unless (and (> (length octets) 10)
+               (equalp (subseq octets 0 6) #(#x93 78 85 77 80 89)))
+    (error "Not a Numpy file."))
+  (let* ((major-version (aref octets 6))
+         (header-start (if (= major-version 1) 10 12))
+         (header-len (loop for index below (- header-start 8)
+                           sum (ash (aref octets (+ 8 index)) (* 8 index))))
+         (dict (read-python-object-from-string
+                (map 'string #'code-char
+                     (subseq octets header-start (+ header-start header-len)))))
+         (dtype (dtype-from-code (gethash "descr" dict)))
+         (element-type (dtype-type dtype))
+         (array (make-array (gethash "shape" dict) :element-type element-type))
+         (chunk-octets (dtype-chunk-octets dtype))
+         (little-endian (eq (dtype-endianness dtype) :little-endian))
+         (position (+ header-start header-len)))
+    (when (gethash "fortran_order" dict)
+      (error "Reading arrays in Fortran order is not yet supported."))
+    (flet ((load-chunk ()
+             (let ((integer 0))
+               (loop for index below chunk-octets do
+                 (setf integer
+                       (logior integer
+                               (ash (aref octets (+ position
+                                                    (if little-endian
+                                                        index
+                                                        (- chunk-octets index 1))))
+                                    (* 8 index)))))
+               (incf position chunk-octets)
+               integer)))
+      (let ((decode
+              (cond ((subtypep element-type 'single-float)
+                     (lambda () (decode-float32 (load-chunk))))
+                    ((subtypep element-type 'double-float)
+                     (lambda () (decode-float64 (load-chunk))))
+                    ((subtypep element-type '(complex single-float))
+                     (lambda () (complex (decode-float32 (load-chunk))
+                                         (decode-float32 (load-chunk)))))
+                    ((subtypep element-type '(complex double-float))
+                     (lambda () (complex (decode-float64 (load-chunk))
+                                         (decode-float64 (load-chunk)))))
+                    ((subtypep element-type 'unsigned-byte)
+                     #'load-chunk)
+                    (t
+                     (lambda ()
+                       (let ((integer (load-chunk)))
+                         (if (logbitp (1- (* 8 chunk-octets)) integer)
+                             (- integer (ash 1 (* 8 chunk-octets)))
+                             integer)))))))
+        (loop for index below (array-total-size array) do
+          (setf (row-major-aref array index) (funcall decode)))))
+    array))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Profiling
+;;;
+;;; On SBCL, Python can profile its requests with the statistical profiler
+;;; SB-SPROF, which is only loaded on demand.  The reports are sent to
+;;; Python as text, where they are parsed.  On other implementations,
+;;; profiling does nothing.
+
+(defun sprof-function (name)
+  (fdefinition (find-symbol name "SB-SPROF")))
+
+(defun start-profiling (mode sample-interval)
+  (declare (ignorable mode sample-interval))
+  #+sbcl
+  (progn
+    (require :sb-sprof)
+    (funcall (sprof-function "RESET"))
+    (funcall (sprof-function "START-PROFILING")
+             :mode mode
+             :sample-interval sample-interval
+             :threads :all)
+    t)
+  #-sbcl
+  nil)
+
+;;; Stop profiling and return a list of the flat report and the call graph
+;;; report, or NIL if profiling is not supported.
+(defun stop-profiling ()
+  (when (find-package "SB-SPROF")
+    (funcall (sprof-function "STOP-PROFILING"))
+    (flet ((report (type)
+             (with-output-to-string (stream)
+               (funcall (sprof-function "REPORT") :type type :stream stream))))
+      (list (report :flat)
+            (report :graph)))))
+
 ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 ;;;
 ;;; Miscellaneous
@@ -773,18 +1375,12 @@
          (simple-condition-format-control simple-condition)
          (simple-condition-format-arguments simple-condition)))
 
-(defun class-information (class-name)
-  (let ((class (find-class class-name nil))
-        (alist '()))
-    (loop for member-function in (class-member-functions class) do
-      (let ((name (generic-function-name member-function)))
-        (when (or (symbolp name)
-                  (and (consp name)
-                       (eq (car name) 'setf)
-                       (symbolp (cadr name))
-                       (null (cddr name))))
-          (push (cons name member-function) alist))))
-    alist))
+(defun member-function-name-p (name)
+  (or (symbolp name)
+      (and (consp name)
+           (eq (car name) 'setf)
+           (symbolp (cadr name))
+           (null (cddr name)))))
 
 (defun maybe-funcall (package name &rest args)
   (let ((package (find-package package)))
@@ -793,6 +1389,1050 @@
         (when (fboundp symbol)
           (apply symbol args))))))
 
+(defun internal-time-microseconds (internal-time)
+  (round (* internal-time 1000000) internal-time-units-per-second))
+
+(defun elapsed-microseconds (start)
+  (internal-time-microseconds (- (get-internal-real-time) start)))
+
+(defun bytes-consed ()
+  #+sbcl (sb-ext:get-bytes-consed)
+  #-sbcl 0)
+
+(defun gc-run-time ()
+  #+sbcl sb-ext:*gc-run-time*
+  #-sbcl 0)
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Heap Statistics
+;;;
+;;; Python can query the state of the heap and the garbage collector, tune
+;;; the garbage collector, and trigger collections explicitly.  On SBCL, an
+;;; after-GC hook counts the collections and measures their pause times.
+;;; Statistics that are not available on the current implementation are
+;;; reported as NIL.
+
+(defvar *gc-count* 0)
+
+(defvar *gc-last-pause* 0)
+
+(defvar *gc-max-pause* 0)
+
+(defvar *gc-previous-run-time* 0)
+
+(defun note-gc ()
+  (let* ((run-time (gc-run-time))
+         (pause (- run-time *gc-previous-run-time*)))
+    (setf *gc-previous-run-time* run-time)
+    (setf *gc-last-pause* pause)
+    (setf *gc-max-pause* (max pause *gc-max-pause*))
+    (incf *gc-count*)))
+
+#+sbcl
+(pushnew 'note-gc sb-ext:*after-gc-hooks*)
+
+(defun seconds (internal-time)
+  (/ (float internal-time 1d0) internal-time-units-per-second))
+
+(defun heap-stats ()
+  (let ((stats (make-hash-table :test #'equal))
+        (handles (handle-table-objects *handle-table*)))
+    (flet ((stat (key value)
+             (setf (gethash key stats) value)))
+      (stat "dynamic_usage" #+sbcl (sb-kernel:dynamic-usage) #-sbcl nil)
+      (stat "dynamic_space_size" #+sbcl (sb-ext:dynamic-space-size) #-sbcl nil)
+      (stat "bytes_consed_between_gcs" #+sbcl (sb-ext:bytes-consed-between-gcs) #-sbcl nil)
+      (stat "bytes_consed" #+sbcl (bytes-consed) #-sbcl nil)
+      (stat "gc_count" #+sbcl *gc-count* #-sbcl nil)
+      (stat "gc_time" #+sbcl (seconds (gc-run-time)) #-sbcl nil)
+      (stat "gc_last_pause" #+sbcl (seconds *gc-last-pause*) #-sbcl nil)
+      (stat "gc_max_pause" #+sbcl (seconds *gc-max-pause*) #-sbcl nil)
+      (stat "handles" (with-lock ((handle-table-lock *handle-table*))
+                        (hash-table-count handles))))
+    stats))
+
+(defun set-bytes-consed-between-gcs (bytes)
+  (declare (ignorable bytes))
+  #+sbcl (setf (sb-ext:bytes-consed-between-gcs) bytes)
+  #-sbcl nil)
+
+(defun collect-garbage (full)
+  (declare (ignorable full))
+  #+sbcl (sb-ext:gc :full full)
+  #-sbcl nil)
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Messages
+;;;
+;;; Each message is a list whose first element is a keyword that describes
+;;; the kind of message, and whose second element is usually the ID of the
+;;; request it belongs to.  Python sends the following messages:
+;;;
+;;; (:EVAL ID LENGTH) - Followed by LENGTH characters of text, which are
+;;;    read and evaluated.
+;;;
+;;; (:CANCEL ID) - Interrupt the evaluation of the request with this ID.
+;;;
+;;; (:RETURN ID LENGTH) - Followed by LENGTH characters of text, which
+;;;    describe the outcome of the last callback of request ID.
+;;;
+;;; (:ACKNOWLEDGE ID COUNT) - Python has consumed COUNT chunks of the items
+;;;    of request ID, see WITH-EMITTER.
+;;;
+;;; (:PROTOCOL VERSION) - Switch to the framed protocol with the supplied
+;;;    version.  All further messages in both directions are frames.
+;;;
+;;; (:QUIT) - Terminate the Lisp process.
+;;;
+;;; Lisp sends the following messages:
+;;;
+;;; (:HELLO THREADS INTERRUPTIBLE FRAMING) - Sent once, before anything
+;;;    else, to describe the capabilities of this Lisp.  FRAMING is the
+;;;    version of the framed protocol, or NIL if it is not supported.
+;;;
+;;; (:OUTPUT ID STRING) - Some output of the evaluation of request ID.
+;;;
+;;; (:RESULT ID ((PACKAGE-NAME VALUES CONDITION) METRICS)) - The outcome
+;;;    of request ID.  Each request receives exactly one result.
+;;;
+;;; (:CALLBACK ID (FUNCTION-ID ARGUMENTS)) - Call the Python function with
+;;;    the supplied ID while evaluating request ID, see CALL-PYTHON.
+;;;
+;;; (:YIELD ID ITEMS) - A chunk of items of request ID, see WITH-EMITTER.
+;;;
+;;; Messages from Lisp to Python can be sent from several threads at once,
+;;; so each message is written while holding the lock of its connection.
+;;; Messages are printed before that lock is taken, though.
+;;;
+;;; Each connection also has its own handle table, its own current package,
+;;; and its own record of the classes that have already been announced to
+;;; Python.
+
+(defstruct (python (:constructor make-python (input output)))
+  (input nil :read-only t)
+  (output nil :read-only t)
+  (lock (make-lock "cl4py python stream") :read-only t)
+  ;; Either :TEXT or :FRAMED.
+  (protocol :text)
+  (handle-table (make-handle-table) :read-only t)
+  (announced-classes (make-hash-table :test #'eq) :read-only t)
+  (announced-by-value-classes (make-hash-table :test #'eq) :read-only t)
+  (package *package*)
+  ;; A hash table that maps the ID of each request that is currently being
+  ;; evaluated to the evaluating thread.
+  (request-threads (make-hash-table :test #'eql) :read-only t)
+  (request-threads-lock (make-lock "cl4py request threads") :read-only t)
+  ;; A hash table that maps the ID of each request that waits for the
+  ;; outcome of a callback to the text and the sections of that outcome,
+  ;; once it has arrived.
+  (returns (make-hash-table :test #'eql) :read-only t)
+  (returns-lock (make-lock "cl4py returns") :read-only t)
+  (returns-available (make-condition-variable "cl4py returns") :read-only t)
+  ;; A hash table that maps the ID of each request with an emitter to the
+  ;; number of chunks that Python has consumed, see WITH-EMITTER.  It is
+  ;; protected by the returns lock, too.
+  (acknowledgements (make-hash-table :test #'eql) :read-only t)
+  ;; The IDs of the Python functions whose Lisp counterparts have been
+  ;; garbage collected since the last result, see MAKE-PYTHON-FUNCTION.
+  (released-functions '())
+  (released-functions-lock (make-lock "cl4py released functions") :read-only t))
+
+(defun send-message (python &rest message)
+  ;; The message is printed before the lock of the connection is taken, so
+  ;; that printing a large result neither delays the messages of other
+  ;; threads nor defers interrupts.
+  (multiple-value-bind (text sections) (message-text python message)
+    (without-interrupts
+      (with-lock ((python-lock python))
+        (let ((stream (python-output python)))
+          (ecase (python-protocol python)
+            (:text
+             (write-string text stream))
+            (:framed
+             (write-frame stream (first message) (second message) text sections)))
+          (finish-output stream))))))
+
+;;; Return the text and the binary sections of MESSAGE in the protocol of
+;;; the connection PYTHON.
+(defun message-text (python message)
+  (let ((*read-eval* nil)
+        (*print-circle* t))
+    (ecase (python-protocol python)
+      (:text
+       (values
+        (if (eq (first message) :result)
+            (destructuring-bind (id metrics &rest data) (rest message)
+              (format nil "(:RESULT ~D ~A)~%" id
+                      (result-text data metrics (take-released-functions python))))
+            (with-output-to-string (text)
+              (pyprint message text)))
+        #()))
+      (:framed
+       (destructuring-bind (kind id &rest data) message
+         (declare (ignore id))
+         (let ((*sections* (make-array 0 :adjustable t :fill-pointer 0)))
+           (values
+            (ecase kind
+              (:output
+               (first data))
+              (:result
+               (result-text (rest data) (first data) (take-released-functions python)))
+              ((:callback :yield)
+               (with-output-to-string (text)
+                 (pyprint (first data) text))))
+            *sections*)))))))
+
+;;; The result of a request is sent as a list of three elements.  The first
+;;; element is a list of the name of the current package, the values, and
+;;; the condition.  The second element is a list of metrics, see
+;;; PROCESS-REQUEST, followed by the time it took to print the first
+;;; element.  The third element is a list of the IDs of released Python
+;;; functions, see MAKE-PYTHON-FUNCTION.
+(defun result-text (data metrics released-functions)
+  (let* ((start (get-internal-real-time))
+         (text (with-output-to-string (text)
+                 (pyprint data text))))
+    (format nil "(~A (~{~D ~}~D) (~{~D~^ ~}))"
+            text metrics (elapsed-microseconds start) released-functions)))
+
+;;; Return the next message from Python.  The text of each :EVAL message is
+;;; included in the message, followed by a vector of binary sections.
+(defun read-message (python)
+  (let ((stream (python-input python)))
+    (ecase (python-protocol python)
+      (:text
+       (let ((message (with-standard-io-syntax
+                        (let ((*read-eval* nil))
+                          (read stream nil '(:quit))))))
+         (if (member (first message) '(:eval :return))
+             (destructuring-bind (id length) (rest message)
+               (list (first message) id (read-payload stream length) #()))
+             message)))
+      (:framed
+       (multiple-value-bind (kind id text sections) (read-frame stream)
+         (ecase kind
+           (:eval (list :eval id text sections))
+           (:return (list :return id text sections))
+           (:acknowledge (list :acknowledge id (parse-integer text)))
+           (:cancel (list :cancel id))
+           (:quit (list :quit))))))))
+
+(defun read-payload (stream length)
+  (let* ((string (make-string length))
+         (end (read-sequence string stream)))
+    (if (= end length)
+        string
+        (subseq string 0 end))))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Frames
+;;;
+;;; In the framed protocol, each message is a frame with the following
+;;; layout.  All integers are unsigned and big-endian.
+;;;
+;;;  2 bytes  - The magic string "CL".
+;;;  1 byte   - The protocol version.
+;;;  1 byte   - The kind of message, see *FRAME-KINDS*.
+;;;  2 bytes  - The number of binary sections N.
+;;;  4 bytes  - The request ID, or zero.
+;;;  4 bytes  - The length of the text in octets.
+;;;  N*8 bytes - The length of each binary section in octets.
+;;;
+;;; The header is followed by the UTF-8 encoded text, and by the binary
+;;; sections.  The text of :EVAL and :RESULT frames is an S-expression, and
+;;; the text of :OUTPUT frames is the output itself.  Arrays are sent as
+;;; binary sections in the Numpy file format, and octet vectors are sent as
+;;; plain binary sections.  The S-expression refers to them by their index,
+;;; e.g., #N0 or #Y1.
+
+(defconstant +frame-version+ 1)
+
+(defparameter *frame-kinds*
+  '(:eval 1 :cancel 2 :quit 3 :output 4 :result 5 :callback 6 :return 7
+    :yield 8 :acknowledge 9))
+
+(defun framing-supported-p ()
+  #+sbcl t
+  #-sbcl nil)
+
+(defun string-octets (string)
+  #+sbcl (sb-ext:string-to-octets string :external-format :utf-8)
+  #-sbcl (error "Framing is not supported on this implementation."))
+
+(defun octets-string (octets)
+  #+sbcl (sb-ext:octets-to-string octets :external-format :utf-8)
+  #-sbcl (error "Framing is not supported on this implementation."))
+
+(defun store-integer (integer octets start length)
+  (loop for index below length do
+    (setf (aref octets (+ start index))
+          (ldb (byte 8 (* 8 (- length index 1))) integer))))
+
+(defun load-integer (octets start length)
+  (let ((integer 0))
+    (loop for index below length do
+      (setf integer (logior (ash integer 8) (aref octets (+ start index)))))
+    integer))
+
+(defun read-octets (stream length)
+  (let ((octets (make-array length :element-type '(unsigned-byte 8))))
+    (unless (= (read-sequence octets stream) length)
+      (error 'end-of-file :stream stream))
+    octets))
+
+(defun write-frame (stream kind id text sections)
+  (let* ((text (string-octets text))
+         (count (length sections))
+         (header (make-array (+ 14 (* 8 count)) :element-type '(unsigned-byte 8))))
+    (setf (aref header 0) (char-code #\C))
+    (setf (aref header 1) (char-code #\L))
+    (setf (aref header 2) +frame-version+)
+    (setf (aref header 3) (getf *frame-kinds* kind))
+    (store-integer count header 4 2)
+    (store-integer id header 6 4)
+    (store-integer (length text) header 10 4)
+    (loop for section across sections
+          for start from 14 by 8 do
+            (store-integer (length section) header start 8))
+    (write-sequence header stream)
+    (write-sequence text stream)
+    (loop for section across sections do
+      (write-sequence section stream))))
+
+;;; Return the kind, the request ID, the text and the binary sections of
+;;; the next frame.  At the end of the stream, return a :QUIT frame.
+(defun read-frame (stream)
+  (let ((header (make-array 14 :element-type '(unsigned-byte 8))))
+    (unless (= (read-sequence header stream) 14)
+      (return-from read-frame (values :quit 0 "" #())))
+    (unless (and (= (aref header 0) (char-code #\C))
+                 (= (aref header 1) (char-code #\L))
+                 (= (aref header 2) +frame-version+))
+      (error "Invalid frame header: ~S" header))
+    (let* ((kind (loop for (key code) on *frame-kinds* by #'cddr
+                       when (= code (aref header 3)) return key
+                       finally (error "Invalid frame kind: ~D" (aref header 3))))
+           (count (load-integer header 4 2))
+           (id (load-integer header 6 4))
+           (text-length (load-integer header 10 4))
+           (lengths (read-octets stream (* 8 count)))
+           (text (octets-string (read-octets stream text-length)))
+           (sections (make-array count)))
+      (loop for index below count do
+        (setf (aref sections index)
+              (read-octets stream (load-integer lengths (* 8 index) 8))))
+      (values kind id text sections))))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Streaming Output
+;;;
+;;; While an expression is evaluated, its output is sent to Python in
+;;; chunks of at most *OUTPUT-CHUNK-SIZE* characters.  A chunk is sent
+;;; whenever the buffer is full, at the end of each line, and whenever the
+;;; output is finished or forced explicitly.  At most *OUTPUT-LIMIT*
+;;; characters are sent per evaluation, the rest is discarded.
+
+(defvar *output-chunk-size* 4096)
+
+(defvar *output-limit* nil)
+
+(defclass python-output-stream (fundamental-character-output-stream)
+  ((%python :initarg :python :reader python-output-stream-python)
+   (%id :initarg :id :reader python-output-stream-id)
+   (%buffer :initform (make-array *output-chunk-size*
+                                  :element-type 'character
+                                  :fill-pointer 0)
+            :reader python-output-stream-buffer)
+   (%column :initform 0 :accessor python-output-stream-column)
+   (%remaining :initform *output-limit* :accessor python-output-stream-remaining)))
+
+(defun make-python-output-stream (python id)
+  (make-instance 'python-output-stream :python python :id id))
+
+(defun send-output (stream string)
+  (send-message (python-output-stream-python stream)
+                :output
+                (python-output-stream-id stream)
+                string))
+
+(defun flush-python-output-stream (stream)
+  (let ((buffer (python-output-stream-buffer stream))
+        (remaining (python-output-stream-remaining stream)))
+    (when (plusp (fill-pointer buffer))
+      (cond ((null remaining)
+             (send-output stream (copy-seq buffer)))
+            ((plusp remaining)
+             (let ((end (min remaining (fill-pointer buffer))))
+               (decf (python-output-stream-remaining stream) end)
+               (send-output stream (subseq buffer 0 end))
+               (when (zerop (python-output-stream-remaining stream))
+                 (send-output stream (format nil "~&[Output truncated after ~D characters.]~%"
+                                             *output-limit*))))))
+      (setf (fill-pointer buffer) 0))))
+
+(defmethod stream-write-char ((stream python-output-stream) char)
+  (let ((buffer (python-output-stream-buffer stream)))
+    (vector-push char buffer)
+    (if (char= char #\Newline)
+        (progn (setf (python-output-stream-column stream) 0)
+               (flush-python-output-stream stream))
+        (progn (incf (python-output-stream-column stream))
+               (when (= (fill-pointer buffer) (array-dimension buffer 0))
+                 (flush-python-output-stream stream)))))
+  char)
+
+(defmethod stream-write-string ((stream python-output-stream) string &optional (start 0) end)
+  (loop for index from start below (or end (length string)) do
+    (stream-write-char stream (char string index)))
+  string)
+
+(defmethod stream-line-column ((stream python-output-stream))
+  (python-output-stream-column stream))
+
+(defmethod stream-finish-output ((stream python-output-stream))
+  (flush-python-output-stream stream))
+
+(defmethod stream-force-output ((stream python-output-stream))
+  (flush-python-output-stream stream))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Interrupts
+;;;
+;;; Python interrupts long-running evaluations either by sending a :CANCEL
+;;; message, or, when the REPL itself is busy evaluating, by sending SIGINT
+;;; to the Lisp process.  In both cases, the evaluating thread signals a
+;;; condition of type EVALUATION-INTERRUPTED, unless it has already
+;;; finished evaluating that request.  This condition is a serious
+;;; condition, but not an error, so that it is not accidentally handled by
+;;; user code.  It unwinds the evaluation to the REPL, which reports it to
+;;; Python.
+
+(define-condition evaluation-interrupted (serious-condition)
+  ()
+  (:report "The evaluation has been interrupted."))
+
+;;; The connection and the ID of the request that is evaluated by the
+;;; current thread, or NIL.
+(defvar *python* nil)
+
+(defvar *request-id* nil)
+
+;;; The thread that runs the REPL.
+(defvar *repl-thread* nil)
+
+(defun interruptible-p ()
+  #+sbcl t
+  #-sbcl nil)
+
+(defun interrupt-request (python id)
+  (when (and (eq *python* python)
+             (eql *request-id* id))
+    (error 'evaluation-interrupted)))
+
+(defun cancel-request (python id)
+  (let ((thread (with-lock ((python-request-threads-lock python))
+                  (gethash id (python-request-threads python)))))
+    (when thread
+      (ignore-errors
+       (interrupt-thread thread (lambda () (interrupt-request python id)))))))
+
+(defun interrupt-all-requests (python)
+  (loop for id in (with-lock ((python-request-threads-lock python))
+                    (loop for id being each hash-key of (python-request-threads python)
+                          collect id))
+        do (if (and (eq *python* python) (eql id *request-id*))
+               (interrupt-request python id)
+               (cancel-request python id))))
+
+(defun install-interrupt-handler (python)
+  (setf *repl-thread* (current-thread))
+  #+sbcl
+  (sb-sys:enable-interrupt
+   sb-unix:sigint
+   (lambda (signal info context)
+     (declare (ignore signal info context))
+     (interrupt-thread *repl-thread*
+                       (lambda () (interrupt-all-requests python))))))
+
+(defun evaluate (python id form)
+  (let ((lock (python-request-threads-lock python))
+        (table (python-request-threads python)))
+    (without-interrupts
+      (with-lock (lock)
+        (setf (gethash id table) (current-thread))))
+    (unwind-protect
+         (let ((*python* python)
+               (*request-id* id))
+           (multiple-value-list (eval form)))
+      (without-interrupts
+        (with-lock (lock)
+          (remhash id table))))))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Workers
+;;;
+;;; Worker threads are created on demand, whenever a request arrives and no
+;;; worker is idle.  This way, requests never wait for each other, even if
+;;; one of them blocks until some other request has been evaluated.  Idle
+;;; workers wait until they are notified that a new task is available, and
+;;; terminate once they have been idle for *WORKER-IDLE-TIMEOUT* seconds.
+
+;;; A boolean, indicating whether requests should be evaluated by worker
+;;; threads.  If false, each request is evaluated by the REPL itself.
+(defvar *threads* (threads-supported-p))
+
+(defvar *tasks* '())
+
+(defvar *idle-workers* 0)
+
+(defvar *tasks-lock* (make-lock "cl4py tasks"))
+
+(defvar *task-available* (make-condition-variable "cl4py task available"))
+
+;;; The number of seconds after which an idle worker terminates, so that a
+;;; burst of concurrent requests doesn't leave a thread for each of them.
+(defvar *worker-idle-timeout* 10)
+
+(defun worker-loop ()
+  (loop
+    (let ((task (with-lock (*tasks-lock*)
+                  (loop until *tasks* do
+                    (incf *idle-workers*)
+                    (let ((notified (condition-variable-wait
+                                     *task-available* *tasks-lock* *worker-idle-timeout*)))
+                      (decf *idle-workers*)
+                      (unless (or notified *tasks*)
+                        (return-from worker-loop))))
+                  (pop *tasks*))))
+      ;; The connection of a task may be closed before its result has
+      ;; been sent.  Any other error must not escape the worker either,
+      ;; because that would terminate the whole Lisp process.
+      (handler-case (funcall task)
+        (stream-error () nil)
+        (serious-condition () nil)))))
+
+(defun submit-task (task)
+  (with-lock (*tasks-lock*)
+    (setf *tasks* (append *tasks* (list task)))
+    ;; Each task needs its own worker, so we only rely on idle workers if
+    ;; there are at least as many of them as there are tasks.
+    (if (>= *idle-workers* (length *tasks*))
+        (condition-variable-notify *task-available*)
+        (spawn-thread #'worker-loop "cl4py worker"))))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Callbacks
+;;;
+;;; Python functions are sent to Lisp as funcallable instances of the class
+;;; PYTHON-FUNCTION.  Calling one of them while evaluating a request sends
+;;; a :CALLBACK message to Python, and waits for the :RETURN message with
+;;; the outcome.  The calling thread is blocked until then, but other
+;;; requests are still evaluated as usual.  This way, Python functions can
+;;; call Lisp again, and callbacks can be nested arbitrarily.
+
+(define-condition python-error (error)
+  ((%message :initarg :message :reader python-error-message))
+  (:report
+   (lambda (condition stream)
+     (format stream "Python signaled an error: ~A"
+             (python-error-message condition)))))
+
+(defclass python-function ()
+  ((%python :initarg :python :reader python-function-python)
+   (%id :initarg :id :reader python-function-id))
+  (:metaclass funcallable-standard-class))
+
+(defmethod initialize-instance :after ((function python-function) &key)
+  (set-funcallable-instance-function
+   function
+   (lambda (&rest arguments)
+     (call-python function arguments))))
+
+(defmethod pyprint-write ((function python-function) stream)
+  (format stream "#~D@" (python-function-id function)))
+
+;;; The #n@ reader macro creates a Lisp function that calls the Python
+;;; function with the supplied ID.  Without an ID, it is followed by a list
+;;; of the kind of some Python input and the ID of the Python function that
+;;; supplies its chunks, see MAKE-PYTHON-INPUT.
+(defun sharpsign-at-sign (s c n)
+  (declare (ignore c))
+  (if n
+      (make-python-function *python* n)
+      (destructuring-bind (kind id) (read s t nil t)
+        (make-python-input kind (make-python-function *python* id)))))
+
+;;; Each #n@ creates a fresh PYTHON-FUNCTION.  Once it has been garbage
+;;; collected, its ID is sent to Python with the next result.  Python counts
+;;; how often it has sent each function, and forgets the function once the
+;;; same number of its counterparts has been released.  Without finalizers,
+;;; i.e., on implementations other than SBCL, Python functions are never
+;;; released.
+(defun make-python-function (python id)
+  (let ((function (make-instance 'python-function :python python :id id)))
+    #+sbcl (sb-ext:finalize function (python-function-finalizer python id) :dont-save t)
+    function))
+
+;;; The finalizer must not reference the function itself.
+(defun python-function-finalizer (python id)
+  (lambda ()
+    (with-lock ((python-released-functions-lock python))
+      (push id (python-released-functions python)))))
+
+(defun take-released-functions (python)
+  (with-lock ((python-released-functions-lock python))
+    (shiftf (python-released-functions python) '())))
+
+(set-dispatch-macro-character #\# #\@ 'sharpsign-at-sign *cl4py-readtable*)
+
+(defun call-python (function arguments)
+  (let ((python (python-function-python function))
+        (id *request-id*))
+    (unless (and id (eq python *python*))
+      (error "Python functions can only be called while evaluating a ~
+              request of their connection."))
+    (send-message python :callback id (list (python-function-id function) arguments))
+    (destructuring-bind (kind &rest values)
+        (multiple-value-call #'read-request (receive-return python id))
+      (ecase kind
+        (:values (values-list values))
+        (:error (error 'python-error :message (first values)))))))
+
+;;; Called by the REPL whenever the outcome of a callback arrives.
+(defun deliver-return (python id text sections)
+  (with-lock ((python-returns-lock python))
+    (setf (gethash id (python-returns python)) (cons text sections))
+    (condition-variable-broadcast (python-returns-available python))))
+
+;;; Wait until the outcome of the current callback of request ID has been
+;;; delivered, and return its text and sections.
+(defun receive-return (python id)
+  (let ((table (python-returns python))
+        (lock (python-returns-lock python)))
+    (unwind-protect
+         (progn
+           (wait-until python (lambda () (nth-value 1 (gethash id table))))
+           (with-lock (lock)
+             (destructuring-bind (text . sections) (gethash id table)
+               (values text sections))))
+      (with-lock (lock)
+        (remhash id table)))))
+
+;;; Wait until TEST, a function of zero arguments, returns true.  TEST is
+;;; called again whenever the REPL has delivered a message.  Without worker
+;;; threads, the waiting thread is the REPL itself, so it reads and handles
+;;; all further messages, until TEST is satisfied.  Requests that arrive in
+;;; the meantime are evaluated right away.
+(defun wait-until (python test)
+  (if *threads*
+      (let ((lock (python-returns-lock python)))
+        (with-lock (lock)
+          (loop until (funcall test)
+                do (condition-variable-wait (python-returns-available python) lock))))
+      (loop until (funcall test) do
+        (destructuring-bind (kind &rest arguments) (read-message python)
+          (ecase kind
+            (:eval
+             (destructuring-bind (id text sections) arguments
+               (process-request python id text sections)))
+            (:cancel
+             (cancel-request python (first arguments)))
+            (:return
+             (destructuring-bind (id text sections) arguments
+               (deliver-return python id text sections)))
+            (:acknowledge
+             (destructuring-bind (id count) arguments
+               (deliver-acknowledgement python id count)))
+            (:quit
+             (quit)))))))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Streams
+;;;
+;;; A request can send any number of items to Python before its result, by
+;;; calling EMIT within the dynamic extent of WITH-EMITTER.  Items are
+;;; collected in chunks of CHUNK-SIZE items, and each chunk is sent as a
+;;; :YIELD message.  Python acknowledges each chunk that it has consumed,
+;;; and at most WINDOW chunks are unacknowledged at any time.  Once that
+;;; limit is reached, EMIT waits for Python, so that neither side buffers
+;;; more than WINDOW chunks.
+
+(defstruct (emitter
+            (:constructor make-emitter (python id window chunk-size)))
+  (python nil :read-only t)
+  (id nil :read-only t)
+  (window nil :type (integer 1) :read-only t)
+  (chunk-size nil :type (integer 1) :read-only t)
+  ;; The items of the current chunk, in reverse order.
+  (items '() :type list)
+  (count 0 :type fixnum)
+  ;; The number of chunks that have been sent.
+  (sent 0 :type fixnum))
+
+(defvar *emitter* nil)
+
+(defmacro with-emitter ((&key (window 8) (chunk-size 64)) &body body)
+  "Evaluate BODY such that each call to EMIT sends an item to Python."
+  `(call-with-emitter (lambda () ,@body) ,window ,chunk-size))
+
+(defun call-with-emitter (thunk window chunk-size)
+  (let* ((python *python*)
+         (id *request-id*)
+         (table (python-acknowledgements python))
+         (lock (python-returns-lock python))
+         (*emitter* (make-emitter python id window chunk-size)))
+    (with-lock (lock)
+      (setf (gethash id table) 0))
+    (unwind-protect
+         (multiple-value-prog1 (funcall thunk)
+           (flush-emitter *emitter*))
+      (with-lock (lock)
+        (remhash id table)))))
+
+(defun emit (item)
+  "Send ITEM to Python, which receives it as the next element of the
+iterator that is returned by Lisp.stream."
+  (let ((emitter *emitter*))
+    (unless emitter
+      (error "EMIT can only be used within WITH-EMITTER."))
+    (push item (emitter-items emitter))
+    (when (>= (incf (emitter-count emitter)) (emitter-chunk-size emitter))
+      (flush-emitter emitter))
+    item))
+
+(defun flush-emitter (emitter)
+  (let ((python (emitter-python emitter))
+        (id (emitter-id emitter)))
+    (when (emitter-items emitter)
+      (let ((table (python-acknowledgements python)))
+        (wait-until python
+                    (lambda ()
+                      (< (- (emitter-sent emitter) (gethash id table 0))
+                         (emitter-window emitter)))))
+      (send-message python :yield id (nreverse (emitter-items emitter)))
+      (setf (emitter-items emitter) '())
+      (setf (emitter-count emitter) 0)
+      (incf (emitter-sent emitter)))))
+
+;;; Called by the REPL whenever Python has consumed some chunks.  COUNT is
+;;; the number of chunks of request ID that Python has consumed so far.
+;;; Acknowledgements of requests that have no emitter are ignored.
+(defun deliver-acknowledgement (python id count)
+  (with-lock ((python-returns-lock python))
+    (let ((table (python-acknowledgements python)))
+      (when (nth-value 1 (gethash id table))
+        (setf (gethash id table) count)
+        (condition-variable-broadcast (python-returns-available python))))))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Python Input
+;;;
+;;; Python file objects and iterators are sent to Lisp as Python functions
+;;; that return the next chunk of their data, and that return an empty
+;;; chunk at the end.  Lisp wraps these functions in objects that fetch
+;;; another chunk whenever the previous one has been consumed.  Text files
+;;; become character input streams, binary files become binary input
+;;; streams, and all other iterators become instances of PYTHON-ITERATOR.
+;;; This way, Lisp can process inputs of any size with bounded memory.
+
+(defclass python-input ()
+  ((%function :initarg :function :reader python-input-function)
+   (%buffer :initform #() :accessor python-input-buffer)
+   (%position :initform 0 :accessor python-input-position)
+   (%exhausted :initform nil :accessor python-input-exhausted)))
+
+(defclass python-character-input-stream (python-input fundamental-character-input-stream)
+  ())
+
+(defclass python-octet-input-stream (python-input fundamental-binary-input-stream)
+  ())
+
+(defclass python-iterator (python-input)
+  ())
+
+(defun make-python-input (kind function)
+  (make-instance
+   (ecase kind
+     (:characters 'python-character-input-stream)
+     (:octets 'python-octet-input-stream)
+     (:items 'python-iterator))
+   :function function))
+
+;;; Ensure that the buffer of INPUT has at least one unconsumed element, and
+;;; return whether this was possible.
+(defun python-input-fill (input)
+  (loop while (and (>= (python-input-position input)
+                       (length (python-input-buffer input)))
+                   (not (python-input-exhausted input)))
+        do (let ((chunk (funcall (python-input-function input))))
+             (if (zerop (length chunk))
+                 (setf (python-input-exhausted input) t)
+                 (setf (python-input-buffer input) chunk
+                       (python-input-position input) 0))))
+  (< (python-input-position input)
+     (length (python-input-buffer input))))
+
+(defun python-input-next (input eof-value)
+  (if (python-input-fill input)
+      (prog1 (aref (python-input-buffer input) (python-input-position input))
+        (incf (python-input-position input)))
+      eof-value))
+
+(defmethod stream-read-char ((stream python-character-input-stream))
+  (python-input-next stream :eof))
+
+(defmethod stream-unread-char ((stream python-character-input-stream) char)
+  (declare (ignore char))
+  (decf (python-input-position stream))
+  nil)
+
+(defmethod stream-read-byte ((stream python-octet-input-stream))
+  (python-input-next stream :eof))
+
+(defun next-item (iterator &optional (eof-error-p t) eof-value)
+  "Return the next item of the Python ITERATOR.  At the end, signal an
+error if EOF-ERROR-P is true, and return EOF-VALUE otherwise."
+  (let ((item (python-input-next iterator iterator)))
+    (cond ((not (eq item iterator)) item)
+          (eof-error-p (error "The Python iterator ~S is exhausted." iterator))
+          (t eof-value))))
+
+(defmacro do-items ((var iterator &optional result) &body body)
+  "Evaluate BODY with VAR bound to each remaining item of the Python
+ITERATOR, and return RESULT."
+  (let ((iterator-var (gensym "ITERATOR")))
+    `(let ((,iterator-var ,iterator))
+       (loop for ,var = (next-item ,iterator-var nil ,iterator-var)
+             until (eq ,var ,iterator-var)
+             do (progn ,@body))
+       ,result)))
+
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;;;
+;;; Decoding Requests
+;;;
+;;; Requests are written by the Python function LISPIFY, which only uses a
+;;; small subset of the Lisp syntax: integers, strings, lists, vectors,
+;;; hash tables, handles, and symbols of the form |PACKAGE|::|NAME|.
+;;; DECODE-REQUEST parses this subset directly from the text of a request,
+;;; without the overhead of the stream and reader machinery, and caches the
+;;; packages and symbols it encounters.  Everything else, e.g., floats and
+;;; arrays, is passed on to READ.  Requests with #N= labels are read by READ
+;;; entirely, because labels may refer to objects that are being read.
+
+(defun whitespace-char-p (char)
+  (case char
+    ((#\space #\tab #\newline #\return #\page) t)
+    (otherwise nil)))
+
+(defun string-delimiter-char-p (char)
+  (or (char= char #\") (char= char #\\)))
+
+(defun delimiter-char-p (char)
+  (or (whitespace-char-p char)
+      (case char
+        ((#\( #\) #\" #\' #\; #\{ #\} #\|) t)
+        (otherwise nil))))
+
+;;; Return whether TEXT contains something that looks like a #N= or #N#
+;;; label.  False positives, e.g., within strings, are harmless.
+(defun labelsp (text)
+  (declare (simple-string text))
+  (loop for start = (position #\# text) then (position #\# text :start (1+ start))
+        while start
+        thereis (let ((end (position-if-not #'digit-char-p text :start (1+ start))))
+                  (and end
+                       (> end (1+ start))
+                       (member (schar text end) '(#\= #\#))))))
+
+(defun decode-request (text sections)
+  (let ((text (coerce text 'simple-string))
+        (*readtable* *cl4py-readtable*)
+        (*sections* sections))
+    (if (labelsp text)
+        (read-from-string text)
+        (decode-text text))))
+
+(defun decode-text (text)
+  (declare (simple-string text))
+  (let ((position 0)
+        (end (length text))
+        ;; A hash table from package names to conses of a package and a
+        ;; hash table from symbol names to symbols.
+        (packages (make-hash-table :test #'equal)))
+    (declare (fixnum position end))
+    (labels ((peek ()
+               (loop while (and (< position end)
+                                (whitespace-char-p (schar text position)))
+                     do (incf position))
+               (and (< position end) (schar text position)))
+             (delegate ()
+               (multiple-value-bind (object next)
+                   (read-from-string text t nil :start position)
+                 (setf position next)
+                 object))
+             (decode ()
+               (let ((char (peek)))
+                 (case char
+                   (#\( (incf position) (decode-list #\)))
+                   (#\" (incf position) (decode-string))
+                   (#\| (decode-symbol))
+                   (#\{ (incf position) (decode-hash-table))
+                   (#\# (decode-sharpsign))
+                   ((nil #\) #\} #\' #\;) (delegate))
+                   (otherwise (decode-token)))))
+             (decode-list (close)
+               (let* ((head (list nil))
+                      (tail head))
+                 (loop
+                   (let ((char (peek)))
+                     (cond ((eql char close)
+                            (incf position)
+                            (return (cdr head)))
+                           ((and (eql char #\.)
+                                 (< (1+ position) end)
+                                 (whitespace-char-p (schar text (1+ position))))
+                            (incf position)
+                            (setf (cdr tail) (decode))
+                            (unless (eql (peek) close)
+                              (error "More than one object follows . in a list."))
+                            (incf position)
+                            (return (cdr head)))
+                           (t
+                            (let ((cons (list (decode))))
+                              (setf (cdr tail) cons)
+                              (setf tail cons))))))))
+             (decode-string ()
+               ;; Strings without escapes are copied in one piece, all
+               ;; others in chunks between the escapes.
+               (let* ((begin (1- position))
+                      (start position)
+                      (stop (position-if #'string-delimiter-char-p text :start start)))
+                 (flet ((unterminated ()
+                          ;; Let READ signal a suitable error.
+                          (setf position begin)
+                          (return-from decode-string (delegate))))
+                   (cond ((not stop)
+                          (unterminated))
+                         ((char= (schar text stop) #\")
+                          (setf position (1+ stop))
+                          (subseq text start stop))
+                         (t
+                          (with-output-to-string (stream)
+                            (loop
+                              (write-string text stream :start start :end stop)
+                              (when (char= (schar text stop) #\")
+                                (setf position (1+ stop))
+                                (return))
+                              (when (>= (1+ stop) end)
+                                (unterminated))
+                              (write-char (schar text (1+ stop)) stream)
+                              (setf start (+ stop 2))
+                              (setf stop (position-if #'string-delimiter-char-p text :start start))
+                              (unless stop
+                                (unterminated)))))))))
+             (decode-bars ()
+               ;; Return the name between two vertical bars, or NIL if it
+               ;; contains escapes.
+               (let ((stop (position-if (lambda (char) (or (char= char #\|) (char= char #\\)))
+                                        text :start (1+ position))))
+                 (when (and stop (char= (schar text stop) #\|))
+                   (prog1 (subseq text (1+ position) stop)
+                     (setf position (1+ stop))))))
+             (decode-symbol ()
+               (let* ((start position)
+                      (name (decode-bars))
+                      (package-name nil))
+                 (when (and name
+                            (< (+ position 2) end)
+                            (char= (schar text position) #\:))
+                   (if (and (char= (schar text (1+ position)) #\:)
+                            (char= (schar text (+ position 2)) #\|))
+                       (progn (incf position 2)
+                              (setf package-name name)
+                              (setf name (decode-bars)))
+                       (setf name nil)))
+                 (if (or (not name)
+                         (and (< position end)
+                              (not (delimiter-char-p (schar text position)))))
+                     (progn (setf position start)
+                            (delegate))
+                     (multiple-value-bind (symbol foundp) (find-cached-symbol name package-name)
+                       (cond (foundp symbol)
+                             (t
+                              (setf position start)
+                              (delegate)))))))
+             (find-cached-symbol (name package-name)
+               ;; Return the symbol with the given name in the package with
+               ;; the given name, or in the current package if the package
+               ;; name is NIL.  The second value is false if there is no
+               ;; such package.
+               (let ((entry (or (gethash package-name packages)
+                                (let ((package (if package-name
+                                                   (find-package package-name)
+                                                   *package*)))
+                                  (when package
+                                    (setf (gethash package-name packages)
+                                          (cons package (make-hash-table :test #'equal))))))))
+                 (if (not entry)
+                     (values nil nil)
+                     (values (or (gethash name (cdr entry))
+                                 (setf (gethash name (cdr entry))
+                                       (intern name (car entry))))
+                             t))))
+             (decode-hash-table ()
+               (let ((table (make-hash-table :test #'equal)))
+                 (loop for (key value) on (decode-list #\}) by #'cddr do
+                   (setf (gethash key table) value))
+                 table))
+             (decode-sharpsign ()
+               (let* ((start position)
+                      (stop (or (position-if-not #'digit-char-p text :start (1+ position))
+                                end))
+                      (char (and (< stop end) (schar text stop))))
+                 (cond ((and (eql char #\?) (> stop (1+ start)))
+                        (setf position (1+ stop))
+                        (handle-object (parse-integer text :start (1+ start) :end stop)))
+                       ((and (eql char #\!) (> stop (1+ start)))
+                        (setf position (1+ stop))
+                        (free-handle (parse-integer text :start (1+ start) :end stop))
+                        (decode))
+                       ((and (eql char #\%) (> stop (1+ start)))
+                        (setf position (1+ stop))
+                        (setf *handle-scope* (parse-integer text :start (1+ start) :end stop))
+                        (decode))
+                       ((and (eql char #\() (= stop (1+ start)))
+                        (setf position (1+ stop))
+                        (coerce (decode-list #\)) 'simple-vector))
+                       (t
+                        (delegate)))))
+             (decode-token ()
+               (let* ((start position)
+                      (stop (or (position-if #'delimiter-char-p text :start position) end))
+                      (digits-start (if (find (schar text start) "+-") (1+ start) start))
+                      (digits-end (if (char= (schar text (1- stop)) #\.) (1- stop) stop)))
+                 (cond ((and (< digits-start digits-end)
+                             (loop for index from digits-start below digits-end
+                                   always (digit-char-p (schar text index))))
+                        (setf position stop)
+                        (parse-integer text :start start :end digits-end))
+                       ((or (and (= (- stop start) 1) (char= (schar text start) #\T))
+                            (and (= (- stop start) 3) (string= text "NIL" :start1 start :end1 stop)))
+                        (setf position stop)
+                        (values (find-cached-symbol (subseq text start stop) nil)))
+                       (t
+                        (delegate))))))
+      (decode))))
+
 ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 ;;;
 ;;; The cl4py REPL
@@ -801,47 +2441,143 @@
   (maybe-funcall "UIOP" "QUIT")
   (maybe-funcall "CL-USER" "QUIT"))
 
+(defun condition-information (condition)
+  (list (class-name (class-of condition))
+        (if *backtrace*
+            (concatenate
+             'string
+             (condition-string condition)
+             (with-output-to-string (stream)
+               (maybe-funcall
+                "UIOP" "PRINT-CONDITION-BACKTRACE"
+                condition :stream stream)))
+            (condition-string condition))))
+
+(defun read-request (text sections)
+  (decode-request text sections))
+
+;;; Each request is read and evaluated in the current package of its
+;;; connection.  A request that changes the current package also changes
+;;; the package of its connection.
+;;;
+;;; The result of each request is accompanied by a list of metrics: the
+;;; microseconds spent reading and evaluating the request, the number of
+;;; bytes consed, and the microseconds spent collecting garbage.  Other
+;;; threads may cons and collect garbage at the same time, so the last two
+;;; metrics are only accurate when requests are evaluated one at a time.
+(defun process-request (python id text sections)
+  (let* ((package (python-package python))
+         (*package* package)
+         (*handle-table* (python-handle-table python))
+         (*handle-scope* nil)
+         (*announced-classes* (python-announced-classes python))
+         (*announced-by-value-classes* (python-announced-by-value-classes python))
+         ;; Python functions that are read refer to this connection.
+         (*python* python)
+         (output (make-python-output-stream python id))
+         (start (get-internal-real-time))
+         (bytes-consed (bytes-consed))
+         (gc-run-time (gc-run-time))
+         (read-time nil))
+    (multiple-value-bind (value condition)
+        (let ((*standard-output* output)
+              (*trace-output* output))
+          (handler-case
+              (let ((form (read-request text sections)))
+                (setf read-time (elapsed-microseconds start))
+                (values (evaluate python id form) nil))
+            (serious-condition (c)
+              (values '() c))))
+      (let* ((total-time (elapsed-microseconds start))
+             (read-time (or read-time total-time))
+             (metrics (list read-time
+                            (- total-time read-time)
+                            (- (bytes-consed) bytes-consed)
+                            (internal-time-microseconds
+                             (- (gc-run-time) gc-run-time)))))
+        (unless (eq *package* package)
+          (setf (python-package python) *package*))
+        ;; First, send any remaining output.
+        (finish-output output)
+        ;; Then, send the name of the current package, the obtained
+        ;; values, and the obtained condition, or NIL.  If the values
+        ;; cannot be printed, the resulting condition is sent instead.
+        (handler-case
+            (send-message python
+                          :result
+                          id
+                          metrics
+                          (package-name *package*)
+                          value
+                          (and condition (condition-information condition)))
+          (stream-error (c)
+            (error c))
+          (serious-condition (c)
+            (send-message python
+                          :result
+                          id
+                          metrics
+                          (package-name *package*)
+                          '()
+                          (condition-information c))))))))
+
+(defun repl (python &key (quit t))
+  (send-message python :hello
+                (threads-supported-p)
+                (interruptible-p)
+                (and (framing-supported-p) +frame-version+))
+  (loop
+    (destructuring-bind (kind &rest arguments) (read-message python)
+      (ecase kind
+        (:eval
+         (destructuring-bind (id text sections) arguments
+           (if *threads*
+               (submit-task (lambda () (process-request python id text sections)))
+               (process-request python id text sections))))
+        (:cancel
+         (cancel-request python (first arguments)))
+        (:return
+         (destructuring-bind (id text sections) arguments
+           (deliver-return python id text sections)))
+        (:acknowledge
+         (destructuring-bind (id count) arguments
+           (deliver-acknowledgement python id count)))
+        (:protocol
+         (assert (eql (first arguments) +frame-version+))
+         (setf (python-protocol python) :framed))
+        (:quit
+         (when quit (quit))
+         (return))))))
+
+(defun command-line-argument (name)
+  (second (member name #+sbcl sb-ext:*posix-argv* #-sbcl '() :test #'string=)))
+
 (defun cl4py (&rest args)
   (declare (ignore args))
-  (let* ((python (make-two-way-stream *standard-input* *standard-output*))
-         (lisp-output (make-string-output-stream))
-         (*standard-output* lisp-output)
-         (*trace-output* lisp-output))
-    (flet ((read-python ()
-             (let ((*readtable* *cl4py-readtable*))
-               (read python))))
-      (loop
-        (multiple-value-bind (value condition)
-            (handler-case (values (multiple-value-list (eval (read-python))) nil)
-              (reader-error (c)
-                (clear-input python)
-                (values '() c))
-              (serious-condition (c)
-                (values '() c)))
-          (let ((*read-eval* nil)
-                (*print-circle* t))
-            ;; First, write the name of the current package.
-            (pyprint (package-name *package*) python)
-            ;; Second, write the obtained value.
-            (pyprint value python)
-            ;; Third, write the obtained condition, or NIL.
-            (if condition
-                (pyprint
-                 (list (class-name (class-of condition))
-                       (if *backtrace*
-                           (concatenate
-                            'string
-                             (condition-string condition)
-                             (with-output-to-string (stream)
-                               (maybe-funcall
-                                "UIOP" "PRINT-CONDITION-BACKTRACE"
-                                condition :stream stream))))
-                       (condition-string condition))
-                 python)
-                (pyprint nil python))
-            ;; Fourth, write the output that has been obtained so far.
-            (finish-output python)
-            (pyprint (get-output-stream-string lisp-output) python)))))))
+  (let ((address (command-line-argument "--listen")))
+    (if address
+        ;; The server is only loaded on demand, because it depends on
+        ;; sockets.
+        (progn
+          #+sbcl (require :sb-bsd-sockets)
+          (load (merge-pathnames "server.lisp" *load-truename*))
+          (funcall 'serve address))
+        ;; The lengths of requests are measured in characters, so both
+        ;; sides must agree on UTF-8, regardless of the current locale.
+        ;; The streams are bivalent, so that they can also be used for
+        ;; framing.
+        (let ((python
+                (make-python
+                 #+sbcl (sb-sys:make-fd-stream 0 :input t :external-format :utf-8
+                                                 :element-type :default
+                                                 :buffering :full)
+                 #-sbcl *standard-input*
+                 #+sbcl (sb-sys:make-fd-stream 1 :output t :external-format :utf-8
+                                                 :element-type :default
+                                                 :buffering :full)
+                 #-sbcl *standard-output*)))
+          (install-interrupt-handler python)
+          (repl python)))))
 
 ;;; Finally, launch the REPL.
 (cl4py)
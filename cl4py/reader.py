@@ -1,6 +1,8 @@
 import re
 import os
-import numpy
+import io
+import weakref
+import threading
 import importlib.machinery
 import importlib.util
 from fractions import Fraction
@@ -36,12 +38,12 @@ SyntaxType = Enum('SyntaxType',
 
 class Readtable:
     def __init__(self, lisp):
-        self.lisp = lisp
+        # The readtable is used by a background thread of its Lisp object,
+        # so it must not keep that object alive.
+        self._lisp = weakref.ref(lisp)
         self.macro_characters = {}
-        # The variable tables is a stack of dicts, where one dict is pushed
-        # for each non-recursive call to read.  These dicts are used to
-        # resolve circular references.
-        self.tables = []
+        # Each thread has its own stack of tables.
+        self.local = threading.local()
         self.set_macro_character('(', left_parenthesis)
         self.set_macro_character(')', right_parenthesis)
         self.set_macro_character('{', left_curly_bracket)
@@ -54,14 +56,36 @@ class Readtable:
         self.set_dispatch_macro_character('#', "'", sharpsign_single_quote)
         self.set_dispatch_macro_character('#', '(', sharpsign_left_parenthesis)
         self.set_dispatch_macro_character('#', '?', sharpsign_questionmark)
+        self.set_dispatch_macro_character('#', '$', sharpsign_dollar)
         self.set_dispatch_macro_character('#', 'A', sharpsign_a)
         self.set_dispatch_macro_character('#', 'C', sharpsign_c)
+        self.set_dispatch_macro_character('#', 'F', sharpsign_f)
         self.set_dispatch_macro_character('#', 'M', sharpsign_m)
         self.set_dispatch_macro_character('#', 'N', sharpsign_n)
+        self.set_dispatch_macro_character('#', 'S', sharpsign_s)
+        self.set_dispatch_macro_character('#', 'Y', sharpsign_y)
+        self.set_dispatch_macro_character('#', '@', sharpsign_at_sign)
         self.set_dispatch_macro_character('#', '=', sharpsign_equal)
         self.set_dispatch_macro_character('#', '#', sharpsign_sharpsign)
 
 
+    @property
+    def lisp(self):
+        return self._lisp()
+
+
+    @property
+    def tables(self):
+        # The variable tables is a stack of dicts, where one dict is pushed
+        # for each non-recursive call to read.  These dicts are used to
+        # resolve circular references.
+        try:
+            return self.local.tables
+        except AttributeError:
+            self.local.tables = []
+            return self.local.tables
+
+
     def get_macro_character(self, char):
         return self.macro_characters[char]
 
@@ -106,6 +130,16 @@ class Readtable:
                 self.tables.pop()
 
 
+    def read_string(self, string, sections=()):
+        """Read an object from STRING.  The binary sections of a frame are
+referenced by their index, e.g., #N0."""
+        self.local.sections = sections
+        try:
+            return self.read(io.StringIO(string))
+        finally:
+            self.local.sections = ()
+
+
     def read_aux(self, stream):
         while True:
             # 1. read one character
@@ -180,6 +214,7 @@ class Readtable:
             base = m.group(1)
             exponent_marker = m.group(2)
             exponent = m.group(3) or "0"
+            import numpy
             if not exponent_marker:
                 return numpy.float32(base + 'e' + exponent)
             elif exponent_marker in 'sS':
@@ -338,16 +373,23 @@ def sharpsign_left_parenthesis(r, s, c, n):
 
 
 def sharpsign_questionmark(r, s, c, n):
-    cls_name = r.read_aux(s)
+    data = r.read_aux(s)
     lisp = r.lisp
-    cls = lisp.classes.get(cls_name)
-    if cls:
-        return cls(lisp, n)
+    # The first instance of each class is preceded by the names of its
+    # member functions.
+    if isinstance(data, Cons):
+        cls = lisp.wrapper_class(data.car, tuple(data.cdr))
     else:
-        obj = LispWrapper(lisp, n)
-        lst = lisp.unpatched_instances.setdefault(cls_name, [])
-        lst.append(obj)
-        return obj
+        cls = lisp.classes[data]
+    return cls(lisp, n)
+
+
+def sharpsign_dollar(r, s, c, n):
+    # Handles of a handle scope are followed by the ID of that scope.
+    scope = r.read_aux(s)
+    wrapper = sharpsign_questionmark(r, s, c, n)
+    r.lisp.add_to_handle_scope(scope, wrapper)
+    return wrapper
 
 
 def sharpsign_a(r, s, c, n):
@@ -359,6 +401,7 @@ def sharpsign_a(r, s, c, n):
             return list(L)
         else:
             return [listify(l,n-1) for l in L]
+    import numpy
     return numpy.array(listify(L, n))
 
 
@@ -373,6 +416,15 @@ CONSTANT_TAG = 2
 VARIABLE_TAG = 3
 
 
+def sharpsign_f(r, s, c, n):
+    # Infinities and NaNs are sent as the bits of an IEEE 754 float.
+    import numpy
+    (width, bits) = list(r.read_aux(s))
+    if width == 32:
+        return numpy.array(bits, dtype=numpy.uint32).view(numpy.float32)[()]
+    return numpy.array(bits, dtype=numpy.uint64).view(numpy.float64)[()]
+
+
 def sharpsign_m(r, s, c, n):
     data = r.read_aux(s)
     pkgname, alist = data.car, data.cdr
@@ -402,6 +454,26 @@ def sharpsign_m(r, s, c, n):
     return module
 
 
+def sharpsign_s(r, s, c, n):
+    data = r.read_aux(s)
+    head, plist = data.car, data.cdr
+    lisp = r.lisp
+    # The first instance of each class is preceded by its slot names.
+    if isinstance(head, Cons):
+        cls = structure_class(head.car, list(head.cdr))
+        lisp.structure_classes[head.car] = cls
+    else:
+        cls = lisp.structure_classes[head]
+    slots = dict(zip(cls.lisp_slots, cls.__slots__))
+    obj = cls()
+    while plist:
+        # Slots that are unknown to the class are ignored.
+        if plist.car in slots:
+            setattr(obj, slots[plist.car], plist.cdr.car)
+        plist = plist.cdr.cdr
+    return obj
+
+
 def sharpsign_equal(r, s, c, n):
     value = r.read_aux(s)
     r.tables[-1][n] = value
@@ -413,8 +485,55 @@ def sharpsign_sharpsign(r, s, c, n):
 
 
 def sharpsign_n(r, s, c, n):
-    f = r.read_aux(s)
-    A = numpy.load(f)
-    os.remove(f)
+    import numpy
+    if skip_whitespace(r, s) == '(':
+        s.read_char()
+        return read_object_array(r, s)
+    source = r.read_aux(s)
+    # In the framed protocol, the array is a binary section of the current
+    # message.
+    if isinstance(source, int):
+        return numpy.load(io.BytesIO(r.local.sections[source]))
+    A = numpy.load(source)
+    os.remove(source)
+    return A
+
+
+def read_object_array(r, s):
+    # The dimensions of the array are followed by its elements in row-major
+    # order, which are stored directly in a fresh array.
+    import numpy
+    dimensions = r.read_aux(s)
+    A = numpy.empty(tuple(dimensions) if dimensions else (), dtype=object)
+    flat = A.reshape(-1)
+    for index in range(flat.size):
+        flat[index] = r.read_aux(s)
+    if skip_whitespace(r, s) != ')':
+        raise RuntimeError('Too many elements for an array of shape {}.'.format(A.shape))
+    s.read_char()
     return A
 
+
+def skip_whitespace(r, s):
+    """Skip all whitespace and return the next character, without consuming
+it."""
+    while True:
+        c = s.read_char()
+        if r.syntax_type(c) != SyntaxType.WHITESPACE:
+            s.unread_char()
+            return c
+
+
+def sharpsign_at_sign(r, s, c, n):
+    # Python functions that have been sent to Lisp are sent back as their
+    # callback ID.
+    return r.lisp.callbacks[n]
+
+
+def sharpsign_y(r, s, c, n):
+    source = r.read_aux(s)
+    # In the framed protocol, the octets are a binary section of the
+    # current message.  Otherwise, they are a string of hex digits.
+    if isinstance(source, int):
+        return bytes(r.local.sections[source])
+    return bytes.fromhex(source)
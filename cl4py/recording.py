@@ -0,0 +1,227 @@
+"""Recording and replaying the traffic between Python and Lisp.
+
+A Lisp object that is created with record=PATH, or that has called
+start_recording, writes each message that it sends or receives to a
+recording.  Each record consists of the time since the start of the
+recording, the direction and kind of the message, the request ID, and the
+size of the message.  The text and the binary sections of each evaluation
+request are recorded, too, so that the recorded requests can be replayed
+later with
+
+    python -m cl4py.recording RECORDING [--speed FACTOR] [--address ADDRESS]
+
+The replay reports the latency percentiles and the throughput of the
+replayed requests, next to the latencies in the recording.  Requests that
+refer to handles or Python callbacks of the recorded session only replay
+faithfully if the replayed session creates the same handles.  Recordings
+of the framed protocol must be replayed with the framed protocol, and vice
+versa.
+"""
+
+import concurrent.futures
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from .protocol import _FRAME_KINDS, _FRAME_KIND_NAMES
+
+_MAGIC = b'CL4PYREC\x01'
+
+# The time in seconds, the direction, the kind of message, the request ID,
+# the size of the message, the length of the recorded text in octets, and
+# the number of recorded binary sections.
+_RECORD = struct.Struct('>dBBIQIH')
+
+_SECTION_LENGTH = struct.Struct('>Q')
+
+SENT = 0
+RECEIVED = 1
+
+Record = namedtuple('Record', ['time', 'direction', 'kind', 'id', 'size',
+                               'text', 'sections'])
+
+
+class Recorder:
+    """Writes messages to the recording at PATH.  The size of received
+messages is only known in the framed protocol, and zero otherwise."""
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(_MAGIC)
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, direction, kind, id, size, text='', sections=()):
+        # pylint: disable=redefined-builtin
+        data = text.encode('utf-8')
+        header = _RECORD.pack(time.perf_counter() - self.start, direction,
+                              _FRAME_KINDS[kind], id, size or 0,
+                              len(data), len(sections))
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(header)
+            self.file.write(data)
+            for section in sections:
+                self.file.write(_SECTION_LENGTH.pack(len(section)))
+                self.file.write(section)
+
+    def sent(self, kind, id, size, text, sections):
+        # pylint: disable=redefined-builtin
+        # Only evaluation requests can be replayed, so only their text and
+        # sections are recorded.
+        if kind == 'eval':
+            self.record(SENT, kind, id, size, text, sections)
+        else:
+            self.record(SENT, kind, id, size)
+
+    def received(self, message):
+        (kind, id, _, info) = message
+        self.record(RECEIVED, kind, id, info[0] if info else 0)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_recording(path):
+    """Return a list of the records of the recording at PATH."""
+    records = []
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('{} is not a cl4py recording.'.format(path))
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                # A recording that has not been closed properly may end with
+                # an incomplete record.
+                return records
+            (seconds, direction, code, id, size, length, count) = _RECORD.unpack(header)
+            text = f.read(length).decode('utf-8')
+            sections = []
+            for _ in range(count):
+                (n,) = _SECTION_LENGTH.unpack(f.read(_SECTION_LENGTH.size))
+                sections.append(f.read(n))
+            records.append(Record(seconds, direction, _FRAME_KIND_NAMES[code],
+                                  id, size, text, sections))
+
+
+def recorded_latencies(records):
+    """Return a dict from the ID of each recorded request to the seconds
+between sending it and receiving its result."""
+    sent = {}
+    latencies = {}
+    for record in records:
+        if record.direction == SENT and record.kind == 'eval':
+            sent[record.id] = record.time
+        elif record.direction == RECEIVED and record.kind == 'result' and record.id in sent:
+            latencies[record.id] = record.time - sent.pop(record.id)
+    return latencies
+
+
+def percentile(values, q):
+    """Return the Q-quantile of the sorted list VALUES."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {'count': len(latencies),
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None}
+
+
+def replay(records, target, speed=1.0, concurrency=16, timeout=None):
+    """Send the recorded evaluation requests to TARGET, which is a Lisp
+object or a ConnectionPool.  Requests are sent at the recorded pace,
+accelerated by the factor SPEED.  If SPEED is None, each request is sent
+as soon as one of CONCURRENCY threads is available.  At most CONCURRENCY
+requests are in flight at a time, so a ConnectionPool is used by at most
+that many connections at once.  Return a dict with the
+latency percentiles and the throughput of the replay and the recording."""
+    requests = [record for record in records
+                if record.direction == SENT and record.kind == 'eval']
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def send(record):
+        nonlocal errors
+        lisp = target.acquire() if hasattr(target, 'acquire') else target
+        start = time.perf_counter()
+        try:
+            lisp._evaluate_text(record.text, record.sections, timeout) # pylint: disable=protected-access
+        except Exception: # pylint: disable=broad-except
+            with lock:
+                errors += 1
+        finally:
+            if lisp is not target:
+                lisp.close()
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for record in requests:
+            if speed:
+                delay = (record.time - requests[0].time) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(send, record)
+    elapsed = time.perf_counter() - start
+    recorded = recorded_latencies(records)
+    duration = requests[-1].time - requests[0].time if requests else 0
+    return {'requests': len(requests),
+            'errors': errors,
+            'seconds': elapsed,
+            'throughput': len(requests) / elapsed if elapsed else None,
+            'latency': latency_summary(latencies),
+            'recorded_seconds': duration,
+            'recorded_latency': latency_summary(list(recorded.values()))}
+
+
+def main():
+    # pylint: disable=import-outside-toplevel
+    import argparse
+    import json
+    from .lisp import Lisp
+    from .pool import ConnectionPool
+    parser = argparse.ArgumentParser(description='Replay a cl4py recording.')
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay this many times faster, or as fast as possible if 0.')
+    parser.add_argument('--address',
+                        help='Replay to the Lisp server at this address instead of a new Lisp.')
+    parser.add_argument('--pool', type=int, default=0,
+                        help='Use at most this many concurrent connections to the server.')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--timeout', type=float)
+    parser.add_argument('--text', action='store_true',
+                        help='Use the text protocol instead of framing.')
+    options = parser.parse_args()
+    address = options.address
+    if address and address.isdigit():
+        address = int(address)
+    concurrency = options.concurrency
+    if address and options.pool:
+        target = ConnectionPool(address, maxsize=options.pool, framed=not options.text)
+        # The pool only bounds the number of idle connections, so the
+        # number of concurrent connections is bounded by the number of
+        # threads that send requests.
+        concurrency = min(concurrency, options.pool)
+    else:
+        target = Lisp(address=address, framed=not options.text)
+    records = read_recording(options.recording)
+    report = replay(records, target, options.speed or None,
+                    concurrency, options.timeout)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    target.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+;;; The cl4py server.  When the cl4py REPL is started with the arguments
+;;; --listen ADDRESS, it loads this file and accepts connections from any
+;;; number of Python processes instead of talking to its parent process.
+;;; An address that contains a slash is the name of a Unix domain socket.
+;;; Any other address is the number of a TCP port on the loopback
+;;; interface.  Each connection has its own REPL thread, its own handle
+;;; table, and its own current package, but all connections share the same
+;;; Lisp image.
+
+(in-package #:cl4py)
+
+(defun local-address-p (address)
+  (find #\/ address))
+
+(defun make-server-socket (address)
+  (if (local-address-p address)
+      (let ((socket (make-instance 'sb-bsd-sockets:local-socket :type :stream)))
+        (when (probe-file address)
+          (delete-file address))
+        (sb-bsd-sockets:socket-bind socket address)
+        socket)
+      (let ((socket (make-instance 'sb-bsd-sockets:inet-socket
+                      :type :stream
+                      :protocol :tcp)))
+        (setf (sb-bsd-sockets:sockopt-reuse-address socket) t)
+        ;; The server evaluates arbitrary code, so it must never be
+        ;; reachable from other hosts.
+        (sb-bsd-sockets:socket-bind socket #(127 0 0 1) (parse-integer address))
+        socket)))
+
+(defun serve-connection (socket)
+  (unwind-protect
+       (handler-case
+           (repl (let ((stream (sb-bsd-sockets:socket-make-stream
+                                socket
+                                :input t
+                                :output t
+                                :element-type :default
+                                :external-format :utf-8
+                                :buffering :full)))
+                   (make-python stream stream))
+                 :quit nil)
+         ;; The client has disconnected.
+         (stream-error () nil)
+         (error (condition)
+           (format *error-output* "~&cl4py: Connection failed: ~A~%" condition)))
+    (sb-bsd-sockets:socket-close socket)))
+
+(defun serve (address &key (backlog 16))
+  (unless (threads-supported-p)
+    (error "The cl4py server requires thread support."))
+  (let ((socket (make-server-socket address)))
+    (unwind-protect
+         (progn
+           (sb-bsd-sockets:socket-listen socket backlog)
+           (loop
+             (let ((connection (sb-bsd-sockets:socket-accept socket)))
+               (spawn-thread (lambda () (serve-connection connection))
+                             "cl4py connection"))))
+      (sb-bsd-sockets:socket-close socket)
+      (when (local-address-p address)
+        (ignore-errors (delete-file address))))))
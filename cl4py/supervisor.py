@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+import weakref
+import concurrent.futures
+from .lisp import Lisp, LispTerminatedError
+
+
+class Supervisor:
+    """Maintains a Lisp object that is replaced by a fresh one whenever its
+process dies or hangs.  Each new Lisp object is created with the supplied
+keyword arguments, e.g., cmd or core, and is then initialized by INIT, which
+is either a function of one argument or the file name of a Lisp file to
+load.  If STANDBY is true, a spare Lisp object is initialized in the
+background, so that it can take over immediately.
+
+A background thread checks every CHECK_INTERVAL seconds whether the Lisp
+process is still alive.  If HANG_TIMEOUT is not None and Lisp evaluates
+requests in threads, it also checks whether Lisp answers an empty request
+within that many seconds, and kills the process otherwise.  Hangs are not
+detected if threads=False is passed, because a single long evaluation
+would be indistinguishable from a hang.
+
+Lisp objects that have been obtained from a previous Lisp process raise a
+StaleHandleError when they are used."""
+    def __init__(self, init=None, standby=False, check_interval=1.0,
+                 hang_timeout=None, **kwargs):
+        self.init = init
+        self.standby = standby
+        self.hang_timeout = hang_timeout
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.closed = False
+        # The number of times the Lisp object has been replaced.
+        self.respawns = 0
+        self.current = self.spawn()
+        # A future for the spare Lisp object, if standby is true.
+        self.spare = None
+        self.start_spare()
+        threading.Thread(target=monitor,
+                         args=(weakref.ref(self), check_interval),
+                         daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def spawn(self):
+        lisp = Lisp(**self.kwargs)
+        if isinstance(self.init, (str, os.PathLike)):
+            lisp.function('load')(os.fspath(self.init))
+        elif self.init is not None:
+            self.init(lisp)
+        return lisp
+
+    def start_spare(self):
+        if not self.standby or self.closed:
+            return
+        future = concurrent.futures.Future()
+        def run():
+            try:
+                future.set_result(self.spawn())
+            except BaseException as e: # pylint: disable=broad-except
+                future.set_exception(e)
+        threading.Thread(target=run, daemon=True).start()
+        self.spare = future
+
+    def take_spare(self):
+        """Return the spare Lisp object if it is alive, and None otherwise."""
+        (spare, self.spare) = (self.spare, None)
+        if spare is None:
+            return None
+        try:
+            lisp = spare.result()
+        except Exception: # pylint: disable=broad-except
+            return None
+        return lisp if lisp.alive else None
+
+    @property
+    def lisp(self):
+        """The current Lisp object, which is replaced first if it has died."""
+        lisp = self.current
+        if not lisp.alive:
+            self.replace(lisp)
+        return self.current
+
+    def replace(self, lisp):
+        """Replace LISP by a fresh Lisp object, unless that has happened
+already."""
+        with self.lock:
+            if self.closed:
+                raise LispTerminatedError('The supervisor has been closed.')
+            if self.current is not lisp:
+                return
+            lisp.kill()
+            self.current = self.take_spare() or self.spawn()
+            self.respawns += 1
+            self.start_spare()
+
+    def check(self):
+        """Replace the current Lisp object if it has died or hangs."""
+        lisp = self.current
+        if lisp.alive and self.hang_timeout is not None and lisp.threaded:
+            # The deadline must not depend on Lisp, which may not even
+            # respond to an interrupt.
+            try:
+                lisp.submit(()).result(self.hang_timeout)
+            except concurrent.futures.TimeoutError:
+                self.replace(lisp)
+                return
+            except LispTerminatedError:
+                pass
+        if not lisp.alive or lisp.dispatcher.closed:
+            self.replace(lisp)
+
+    def eval(self, expr, timeout=None):
+        """Evaluate EXPR in the current Lisp object.  If its process dies
+meanwhile, it is replaced, and the LispTerminatedError is raised."""
+        lisp = self.lisp
+        try:
+            return lisp.eval(expr, timeout)
+        except LispTerminatedError:
+            self.replace(lisp)
+            raise
+
+    def function(self, name):
+        return self.eval( ('CL:FUNCTION', name) )
+
+    def find_package(self, name):
+        return self.lisp.find_package(name)
+
+    def close(self):
+        """Terminate the current and the spare Lisp object."""
+        with self.lock:
+            self.closed = True
+            (spare, self.spare) = (self.spare, None)
+        self.current.terminate()
+        if spare is not None:
+            spare.add_done_callback(
+                lambda future: future.exception() or future.result().terminate())
+
+
+def monitor(ref, interval):
+    while True:
+        time.sleep(interval)
+        supervisor = ref()
+        if supervisor is None or supervisor.closed:
+            return
+        try:
+            supervisor.check()
+        except Exception: # pylint: disable=broad-except
+            # The next check tries again.
+            pass
+        del supervisor
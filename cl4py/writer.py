@@ -1,46 +1,165 @@
 import re
-import numpy
+import io
+import math
+import struct
+import enum
+import types
+import functools
+import itertools
+import collections.abc
+import sys
+import threading
 import tempfile
 import random
 from fractions import Fraction
 from .data import *
 from .circularity import *
 
-def lispify(lisp, obj):
-    return lispify_datum(decircularize(obj, lisp.readtable))
+# While lispifying a request of the framed protocol, the binary sections of
+# that request are collected in the list local.sections.
+local = threading.local()
+
+
+def lispify(lisp, obj, sections=None):
+    local.sections = sections
+    local.readtable = lisp.readtable
+    try:
+        return lispify_datum(decircularize(obj, lisp.readtable))
+    finally:
+        local.sections = None
+        local.readtable = None
 
 
 def lispify_datum(obj):
-    lispifier = lispifiers.get(type(obj))
-    if lispifier:
-        return lispifier(obj)
-    elif isinstance(obj, LispWrapper):
-        return "#{}?".format(obj.handle)
-    else:
+    cls = type(obj)
+    lispifier = dispatch_cache.get(cls)
+    if not lispifier:
+        lispifier = find_lispifier(cls)
+        dispatch_cache[cls] = lispifier
+    return lispifier(obj)
+
+
+# Encoders convert instances of user-defined types to objects that can be
+# lispified.  This dict maps from types to encoders.
+encoders = {}
+
+# A dict from concrete types to the lispifier that has been found for them
+# by find_lispifier.
+dispatch_cache = {}
+
+
+def register_encoder(cls, encoder):
+    """Lispify each instance of CLS, or of one of its subclasses, by
+lispifying the result of calling ENCODER with that instance.  The result
+must not contain shared or circular structure."""
+    encoders[cls] = encoder
+    dispatch_cache.clear()
+
+
+def unregister_encoder(cls):
+    encoders.pop(cls, None)
+    dispatch_cache.clear()
+
+
+def find_lispifier(cls):
+    """Return the lispifier or encoder for the most specific class in the
+method resolution order of CLS that has one."""
+    # The lispifiers of NumPy objects are added on demand, also for
+    # subclasses that are defined elsewhere, e.g., in numpy.ma.
+    if 'numpy' in sys.modules and any(base.__module__.split('.')[0] == 'numpy'
+                                      for base in cls.__mro__):
+        add_numpy_lispifiers()
+    for base in cls.__mro__:
+        if base in encoders:
+            encoder = encoders[base]
+            return lambda obj: lispify_datum(encoder(obj))
+        if base in lispifiers:
+            return lispifiers[base]
+    # Files and iterators are recognized by abstract base classes, which
+    # need not be part of the method resolution order.
+    for base, lispifier in abstract_lispifiers:
+        if issubclass(cls, base):
+            return lispifier
+    def fail(obj):
         raise RuntimeError("Cannot lispify {}.".format(obj))
+    return fail
 
 
 def lispify_ndarray(A):
     if not A.dtype.hasobject:
         return lispify_specialized_ndarray(A)
-
-    def rec(A):
-        if not getattr(A, 'ndim'):
-            return lispify_datum(A)
-        if A.ndim == 0:
-            return " " + lispify_datum(A.item())
-        else:
-            return "(" + " ".join(rec(a) for a in A) + ")"
-    return "#{}A".format(A.ndim) + rec(A)
+    # Arrays of objects are written as their dimensions, followed by their
+    # elements in row-major order.
+    return "#N(({}) {})".format(" ".join(str(n) for n in A.shape),
+                                " ".join(lispify_datum(elt) for elt in A.ravel().tolist()))
 
 
 def lispify_specialized_ndarray(A):
+    import numpy
+    # Lisp only reads arrays in C order.
+    A = numpy.ascontiguousarray(A)
+    sections = getattr(local, 'sections', None)
+    if sections is not None:
+        buffer = io.BytesIO()
+        numpy.save(buffer, A)
+        sections.append(buffer.getvalue())
+        return '#N{}'.format(len(sections) - 1)
     r = random.randrange(2**63-1)
     tmp = tempfile.gettempdir() + '/cl4py-array-{}.npy'.format(r)
     numpy.save(tmp, A)
     return '#N"{}"'.format(tmp)
 
 
+def lispify_bytes(x):
+    # Bytes objects are sent as octet vectors.  In the framed protocol, the
+    # buffer itself is a binary section of the request, so that no copy is
+    # made for the text of the request.
+    sections = getattr(local, 'sections', None)
+    if sections is not None:
+        if isinstance(x, memoryview):
+            x = x.cast('B') if x.c_contiguous else x.tobytes()
+        sections.append(x)
+        return '#Y{}'.format(len(sections) - 1)
+    return '#Y"{}"'.format(x.hex())
+
+
+def lispify_callable(x):
+    # Python functions are sent as their callback ID.  Lisp turns them into
+    # functions that call back into Python.
+    return '#{}@'.format(local.readtable.lisp.callback_id(x))
+
+
+# The number of characters or octets that are read per chunk of a file, and
+# the number of items per chunk of an iterator.
+input_chunk_size = 65536
+
+iterator_chunk_size = 256
+
+
+def lispify_input(kind, read):
+    # Files and iterators are sent as a Python function that returns their
+    # next chunk.  Lisp calls it on demand, until it returns an empty chunk.
+    readtable = local.readtable
+    def fetch():
+        chunk = read()
+        if not chunk:
+            readtable.lisp.release_callback(fetch)
+        return chunk
+    return '#@(:{} {})'.format(kind, readtable.lisp.callback_id(fetch))
+
+
+def lispify_text_file(f):
+    return lispify_input('CHARACTERS', lambda: f.read(input_chunk_size))
+
+
+def lispify_binary_file(f):
+    return lispify_input('OCTETS', lambda: f.read(input_chunk_size) or b'')
+
+
+def lispify_iterator(x):
+    return lispify_input('ITEMS', lambda: list(itertools.islice(x, iterator_chunk_size)))
+
+
 def lispify_dict(d):
     s = "{"
     for key, value in d.items():
@@ -58,9 +177,12 @@ def lispify_tuple(x):
     if len(x) == 0:
         return "NIL"
     else:
-        # This should never happen, because decircularize implicitly
-        # converts tuples to cl4py Lists.
-        raise RuntimeError('Cannot lispify non-empty tuple.')
+        # Usually, decircularize has converted tuples to cl4py Lists
+        # already.  Only tuples that are returned by encoders remain.
+        return lispify_datum(List(*(symbol_from_str(elt, local.readtable)
+                                    if isinstance(elt, str)
+                                    else elt
+                                    for elt in x)))
 
 
 def lispify_Cons(x):
@@ -74,6 +196,25 @@ def lispify_Cons(x):
     return "(" + content + ")"
 
 
+def lispify_LispWrapper(x):
+    # Handles are only valid within the Lisp process that created them, and
+    # only until their handle scope ends.
+    if x.released:
+        raise StaleHandleError('{!r} has been released by its handle scope.'.format(x))
+    if x.lisp is not local.readtable.lisp:
+        if x.lisp.alive:
+            raise StaleHandleError('{!r} belongs to a different Lisp object.'.format(x))
+        raise StaleHandleError('The Lisp process of {!r} has terminated.'.format(x))
+    return "#{}?".format(x.handle)
+
+
+def lispify_LispStructure(x):
+    content = lispify_datum(x.lisp_name)
+    for slot, value in x.slot_items():
+        content += " " + lispify_datum(slot) + " " + lispify_datum(value)
+    return "#S(" + content + ")"
+
+
 def lispify_Symbol(x):
     if not x.package:
         return "|" + x.name + "|"
@@ -85,27 +226,52 @@ def lispify_Complex(x):
     return "#C(" + lispify_datum(x.real) + " " + lispify_datum(x.imag) + ")"
 
 
+# Floats are written with the shortest number of digits that reads back as
+# the same float.  Infinities and NaNs are written as #F(WIDTH BITS), where
+# BITS are the bits of an IEEE 754 float of WIDTH bits.
+
+def lispify_float(digits, marker):
+    if 'e' in digits:
+        return digits.replace('e', marker)
+    return digits + marker + '0'
+
+
+def lispify_float_bits(x, width):
+    (fmt, bits) = ('>f', '>I') if width == 32 else ('>d', '>Q')
+    return '#F({} {})'.format(width, struct.unpack(bits, struct.pack(fmt, x))[0])
+
+
 def lispify_float16(x):
-    return '{:E}'.format(x).replace('E', 'S')
+    # Lisp implementations such as SBCL read short floats as single floats,
+    # so the shortest digits of a float16 would denote a different value.
+    # Each float16 is exactly representable as a float32, though.
+    import numpy
+    return lispify_float32(numpy.float32(x))
 
 
 def lispify_float32(x):
-    return '{:E}'.format(x)
+    if not math.isfinite(x):
+        return lispify_float_bits(float(x), 32)
+    return lispify_float(str(x), 'F')
 
 
 def lispify_float64(x):
-    return '{:E}'.format(x).replace('E', 'D')
+    if not math.isfinite(x):
+        return lispify_float_bits(x, 64)
+    return lispify_float(float.__repr__(x), 'D')
 
 
 def lispify_longdouble(x):
-    return '{:E}'.format(x).replace('E', 'L')
+    # Lisp implementations such as SBCL read long floats as double floats,
+    # so long doubles are narrowed to doubles.
+    return lispify_float64(float(x))
 
 
 lispifiers = {
     # Built-in objects.
     bool          : lambda x: "T" if x else "NIL",
     type(None)    : lambda x: "NIL",
-    int           : str,
+    int           : int.__repr__,
     float         : lispify_float64,
     complex       : lispify_Complex,
     list          : lambda x: "#(" + " ".join(lispify_datum(elt) for elt in x) + ")",
@@ -113,27 +279,64 @@ lispifiers = {
     tuple         : lispify_tuple,
     str           : lispify_str,
     dict          : lispify_dict,
+    bytes         : lispify_bytes,
+    bytearray     : lispify_bytes,
+    memoryview    : lispify_bytes,
+    types.FunctionType : lispify_callable,
+    types.BuiltinFunctionType : lispify_callable,
+    types.MethodType : lispify_callable,
+    functools.partial : lispify_callable,
     # cl4py objects.
     Cons          : lispify_Cons,
     Symbol        : lispify_Symbol,
     Keyword       : lispify_Symbol,
     SharpsignEquals : lambda x: "#" + str(x.label) + "=" + lispify_datum(x.obj),
     SharpsignSharpsign : lambda x: "#" + str(x.label) + "#",
-    # Numpy objects.
-    numpy.ndarray : lispify_ndarray,
-    numpy.str_    : lispify_str,
-    numpy.int8    : str,
-    numpy.int16   : str,
-    numpy.int32   : str,
-    numpy.int64   : str,
-    numpy.uint8   : str,
-    numpy.uint16  : str,
-    numpy.uint32  : str,
-    numpy.uint64  : str,
-    numpy.float16 : lispify_float16,
-    numpy.float32 : lispify_float32,
-    numpy.float64 : lispify_float64,
-    numpy.longdouble : lispify_longdouble,
-    numpy.complex64 : lispify_Complex,
-    numpy.complex128 : lispify_Complex,
+    LispWrapper   : lispify_LispWrapper,
+    LispStructure : lispify_LispStructure,
+    # Enums are sent as keywords, unless they are also instances of some
+    # other type, such as IntEnums.
+    enum.Enum     : lambda x: lispify_Symbol(Keyword(x.name.upper())),
 }
+
+
+abstract_lispifiers = [
+    (io.TextIOBase, lispify_text_file),
+    (io.RawIOBase, lispify_binary_file),
+    (io.BufferedIOBase, lispify_binary_file),
+    (collections.abc.Iterator, lispify_iterator),
+]
+
+
+def add_numpy_lispifiers():
+    """Add the lispifiers of NumPy objects, unless this has already been
+done.  Return whether any lispifiers have been added.  This function is
+called on the first use of a NumPy object, so that cl4py itself doesn't
+need to import NumPy."""
+    import numpy
+    if numpy.ndarray in lispifiers:
+        return False
+    dispatch_cache.clear()
+    lispifiers.update({
+        numpy.ndarray : lispify_ndarray,
+        numpy.bool_   : lambda x: "T" if x else "NIL",
+        # NumPy scalars without a lispifier of their own are sent as the
+        # corresponding Python scalar.
+        numpy.generic : lambda x: lispify_datum(x.item()),
+        numpy.str_    : lispify_str,
+        numpy.int8    : str,
+        numpy.int16   : str,
+        numpy.int32   : str,
+        numpy.int64   : str,
+        numpy.uint8   : str,
+        numpy.uint16  : str,
+        numpy.uint32  : str,
+        numpy.uint64  : str,
+        numpy.float16 : lispify_float16,
+        numpy.float32 : lispify_float32,
+        numpy.float64 : lispify_float64,
+        numpy.longdouble : lispify_longdouble,
+        numpy.complex64 : lispify_Complex,
+        numpy.complex128 : lispify_Complex,
+    })
+    return True
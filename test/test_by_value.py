@@ -0,0 +1,71 @@
+from pytest import fixture
+import cl4py
+from cl4py import List, Symbol
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    lisp = cl4py.Lisp()
+    lisp.eval( ('defstruct', 'point', 'x', 'y') )
+    lisp.eval( ('defclass', 'pair', (),
+                (('left', ':initarg', ':left'),
+                 ('right', ':initarg', ':right'))) )
+    lisp.transfer_by_value('point')
+    lisp.transfer_by_value('pair')
+    return lisp
+
+
+def test_structure_by_value(lisp):
+    p = lisp.eval( ('make-point', ':x', 1, ':y', 2) )
+    assert isinstance(p, cl4py.data.LispStructure)
+    assert (p.x, p.y) == (1, 2)
+    assert not hasattr(p, '__dict__')
+    assert lisp.eval( ('point-y', ('quote', p)) ) == 2
+
+
+def test_standard_object_by_value(lisp):
+    pairs = lisp.eval( ('loop', 'for', 'i', 'below', 3, 'collect',
+                        ('make-instance', ('quote', 'pair'), ':left', 'i')) )
+    assert [pair.left for pair in pairs] == [0, 1, 2]
+    assert not hasattr(pairs.car, 'right')
+    pair = type(pairs.car)(left=5, right=List(6))
+    assert lisp.eval( ('slot-value', ('quote', pair), ('quote', 'right')) ) == List(6)
+
+
+def test_by_value_roundtrip(lisp):
+    p = lisp.eval( ('make-point', ':x', "foo", ':y', ('list', 1, 2)) )
+    assert lisp.function('identity')(p) == p
+    lisp.transfer_by_value('point', False)
+    assert isinstance(lisp.eval( ('make-point',) ), cl4py.data.LispWrapper)
+    lisp.transfer_by_value('point')
+
+
+def test_redefined_class(lisp):
+    lisp.eval( ('defclass', 'segment', (), (('start', ':initarg', ':start'),)) )
+    lisp.transfer_by_value('segment')
+    s = lisp.eval( ('make-instance', ('quote', 'segment'), ':start', 1) )
+    assert s.start == 1
+    lisp.eval( ('defclass', 'segment', (),
+                (('start', ':initarg', ':start'), ('label', ':initarg', ':label'))) )
+    s = lisp.eval( ('make-instance', ('quote', 'segment'), ':start', 3, ':label', "foo") )
+    assert (s.start, s.label) == (3, "foo")
+
+
+def test_unusual_slot_names(lisp):
+    lisp.eval( ('defclass', 'odd', (),
+                (('%data', ':initarg', ':data'),
+                 ('foo?', ':initarg', ':foo'),
+                 ('lisp-name', ':initarg', ':name'),
+                 ('x', ':initarg', ':x'),
+                 ('cl4py::x', ':initarg', ':x2'))) )
+    lisp.transfer_by_value('odd')
+    odd = lisp.eval( ('make-instance', ('quote', 'odd'), ':data', 1, ':foo', 2,
+                      ':name', 3, ':x', 4, ':x2', 5) )
+    assert [value for _, value in odd.slot_items()] == [1, 2, 3, 4, 5]
+    assert (odd.data, odd.foo_, odd.lisp_name_2, odd.x, odd.x_2) == (1, 2, 3, 4, 5)
+    assert odd.lisp_name.name == 'ODD'
+    assert lisp.function('identity')(odd) == odd
+    assert lisp.eval( ('slot-value', ('quote', odd), ('quote', 'cl4py::x')) ) == 5
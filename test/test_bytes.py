@@ -0,0 +1,47 @@
+import numpy
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module", params=[True, False], ids=['framed', 'text'])
+def lisp(request):
+    return cl4py.Lisp(framed=request.param)
+
+
+def test_bytes(lisp):
+    identity = lisp.function('identity')
+    for data in [b'', b'\x00\xff', bytes(range(256)) * 1000]:
+        assert identity(data) == data
+    assert lisp.eval( ('type-of', b'abc') ) == \
+        cl4py.List(cl4py.Symbol('SIMPLE-ARRAY', 'CL'),
+                   cl4py.List(cl4py.Symbol('UNSIGNED-BYTE', 'CL'), 8),
+                   cl4py.List(3))
+
+
+def test_bytearray_and_memoryview(lisp):
+    identity = lisp.function('identity')
+    assert identity(bytearray(b'abc')) == b'abc'
+    assert identity(memoryview(b'abcdef')[2:4]) == b'cd'
+    assert identity(memoryview(b'abcdef')[::2]) == b'ace'
+
+
+def test_octet_vectors(lisp):
+    octets = ('make-array', 3, ':element-type', cl4py.Quote(('unsigned-byte', 8)),
+              ':initial-element', 7)
+    assert lisp.eval( ('cl4py:python-bytes', octets) ) == b'\x07\x07\x07'
+    assert lisp.eval( ('cl4py:python-bytes', ('reverse', b'abc')) ) == b'cba'
+    # Other octet vectors are NumPy arrays.
+    A = lisp.eval(octets)
+    assert isinstance(A, numpy.ndarray) and A.dtype == numpy.uint8
+    assert list(A) == [7, 7, 7]
+
+
+def test_uint8_arrays(lisp):
+    identity = lisp.function('identity')
+    A = numpy.arange(200, dtype='uint8')
+    B = identity(A)
+    assert isinstance(B, numpy.ndarray) and B.dtype == numpy.uint8
+    assert numpy.array_equal(A, B)
@@ -0,0 +1,49 @@
+import time
+import pytest
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module", params=[True, False], ids=['threads', 'inline'])
+def lisp(request):
+    return cl4py.Lisp(threads=request.param)
+
+
+def test_callbacks(lisp):
+    mapcar = lisp.function('mapcar')
+    assert mapcar(lambda x: x * 2, cl4py.List(1, 2, 3)) == cl4py.List(2, 4, 6)
+    assert lisp.function('funcall')(max, 7, 2) == 7
+    def square(x):
+        return x * x
+    assert lisp.function('identity')(square) is square
+
+
+def test_nested_callbacks(lisp):
+    funcall = lisp.function('funcall')
+    add = lisp.function('+')
+    assert funcall(lambda: funcall(lambda x: add(x, 1), 41)) == 42
+
+
+def test_callback_errors(lisp):
+    def fail():
+        raise ValueError('no')
+    with pytest.raises(RuntimeError):
+        lisp.function('funcall')(fail)
+    assert lisp.eval( ('+', 1, 2) ) == 3
+
+
+def test_callbacks_are_released(lisp):
+    funcall = lisp.function('funcall')
+    before = len(lisp.callbacks)
+    for i in range(200):
+        assert funcall(lambda x, i=i: x + i, 1) == i + 1
+    # Lisp releases its references to the callbacks once they have been
+    # garbage collected.
+    deadline = time.monotonic() + 10
+    while len(lisp.callbacks) > before + 20 and time.monotonic() < deadline:
+        lisp.gc(full=True)
+        time.sleep(0.1)
+    assert len(lisp.callbacks) <= before + 20
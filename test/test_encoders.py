@@ -0,0 +1,45 @@
+import enum
+import dataclasses
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp()
+
+
+class Count(int):
+    pass
+
+
+class Color(enum.Enum):
+    RED = 1
+
+
+class Size(enum.IntEnum):
+    LARGE = 3
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+def test_subclasses(lisp):
+    identity = lisp.function('identity')
+    assert identity(Count(5)) == 5
+    assert identity(Color.RED) == cl4py.Keyword('RED')
+    assert identity(Size.LARGE) == 3
+
+
+def test_encoders(lisp):
+    cl4py.register_encoder(Point, lambda point: cl4py.List(point.x, point.y))
+    try:
+        assert lisp.function('reverse')(Point(1, 2)) == cl4py.List(2, 1)
+    finally:
+        cl4py.unregister_encoder(Point)
@@ -82,3 +82,17 @@ def test_error(cl, lisp):
     cl.load(retval[0])
     with pytest.raises(RuntimeError):
         lisp.eval( ("CL-USER::MAKE-ERROR", ))
+
+
+def test_member_functions(lisp):
+    lisp.eval( ('defclass', 'account', (),
+                (('balance', ':initarg', ':balance', ':accessor', 'balance'),)) )
+    accounts = lisp.eval( ('list',
+                           ('make-instance', ('quote', 'account'), ':balance', 10),
+                           ('make-instance', ('quote', 'account'), ':balance', 20)) )
+    a, b = list(accounts)
+    assert type(a) is type(b)
+    assert a.balance() == 10
+    b.set_balance(25)
+    assert b.balance() == 25
+    assert cl4py.Lisp().class_table is lisp.class_table
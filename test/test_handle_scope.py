@@ -0,0 +1,55 @@
+import pytest
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp()
+
+
+def handle_count(lisp):
+    return lisp.heap_stats()['handles']
+
+
+def test_handle_scope(lisp):
+    before = handle_count(lisp)
+    outside = lisp.eval( ('make-hash-table',) )
+    with lisp.handle_scope() as scope:
+        tables = [lisp.eval( ('make-hash-table',) ) for _ in range(100)]
+        kept = scope.retain(lisp.eval( ('make-hash-table',) ))
+        scope.retain(outside)
+        assert handle_count(lisp) == before + 102
+    assert handle_count(lisp) == before + 2
+    assert all(table.released for table in tables)
+    with pytest.raises(cl4py.StaleHandleError):
+        lisp.eval( ('hash-table-count', tables[0]) )
+    assert lisp.eval( ('hash-table-count', kept) ) == 0
+    assert lisp.eval( ('hash-table-count', outside) ) == 0
+
+
+def test_nested_handle_scopes(lisp):
+    before = handle_count(lisp)
+    with lisp.handle_scope():
+        with lisp.handle_scope() as inner:
+            inner.retain(lisp.eval( ('make-hash-table',) ))
+            lisp.eval( ('make-hash-table',) )
+        assert handle_count(lisp) == before + 1
+    assert handle_count(lisp) == before
+
+
+def test_memoized_results_in_handle_scope(lisp):
+    lisp.eval( ('defun', 'cl-user::make-table', ('n',),
+                ('make-hash-table', ':size', 'n')) )
+    make_table = lisp.memoize('cl-user::make-table')
+    with lisp.handle_scope():
+        table = make_table(10)
+    assert table.released
+    # The released table has not been cached.
+    table = make_table(10)
+    assert not table.released
+    assert lisp.eval( ('hash-table-count', table) ) == 0
+    assert make_table(10) is table
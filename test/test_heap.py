@@ -0,0 +1,40 @@
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp(bytes_consed_between_gcs=64 * 1024 * 1024)
+
+
+def test_heap_stats(lisp):
+    stats = lisp.heap_stats()
+    assert set(stats) >= {'dynamic_usage', 'dynamic_space_size',
+                          'bytes_consed_between_gcs', 'gc_count', 'gc_time',
+                          'gc_last_pause', 'gc_max_pause', 'handles'}
+    if stats['bytes_consed_between_gcs'] is not None:
+        assert stats['bytes_consed_between_gcs'] == 64 * 1024 * 1024
+
+
+def test_handles(lisp):
+    before = lisp.heap_stats()['handles']
+    objects = [lisp.eval( ('make-hash-table',) ) for _ in range(5)]
+    assert lisp.heap_stats()['handles'] >= before + len(objects)
+
+
+def test_gc(lisp):
+    before = lisp.heap_stats()['gc_count']
+    lisp.gc(full=True)
+    after = lisp.heap_stats()['gc_count']
+    if before is not None:
+        assert after > before
+
+
+def test_runtime_options():
+    lisp = cl4py.Lisp(dynamic_space_size=1024)
+    stats = lisp.heap_stats()
+    if stats['dynamic_space_size'] is not None:
+        assert stats['dynamic_space_size'] == 1024 * 1024 * 1024
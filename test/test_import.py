@@ -0,0 +1,39 @@
+import subprocess
+import sys
+
+# The time in seconds that importing cl4py may take, excluding the startup
+# of the Python interpreter itself.
+IMPORT_BUDGET = 0.25
+
+
+def import_cl4py():
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            'import cl4py\n'
+            'print(time.perf_counter() - start)\n'
+            'print(" ".join(sorted(sys.modules)))\n')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                            text=True, check=True).stdout.splitlines()
+    return (float(output[0]), set(output[1].split()))
+
+
+def test_import_time():
+    # Take the best of several runs, to be robust against noise.
+    assert min(import_cl4py()[0] for _ in range(3)) < IMPORT_BUDGET
+
+
+def test_lazy_imports():
+    (_, modules) = import_cl4py()
+    for module in ['numpy', 'pkg_resources', 'urllib.request']:
+        assert module not in modules
+
+
+def test_lazy_numpy_lispifiers():
+    # NumPy subclasses from other modules are recognized, too, even if no
+    # object from the numpy module has been lispified before.
+    code = ('import numpy.ma\n'
+            'from cl4py.writer import find_lispifier\n'
+            'print(find_lispifier(numpy.ma.MaskedArray).__name__)\n')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                            text=True, check=True).stdout
+    assert output.strip() == 'lispify_ndarray'
@@ -0,0 +1,40 @@
+import io
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp()
+
+
+def test_text_files(lisp):
+    text = 'first line\nsecond line\n' * 10000
+    read_line = lisp.function('read-line')
+    assert read_line(io.StringIO(text)) == 'first line'
+    count_lines = lisp.eval( ('lambda', ('stream',),
+                              ('loop', 'for', 'line', '=', ('read-line', 'stream', (), ()),
+                               'while', 'line', 'count', 'line')) )
+    assert count_lines(io.StringIO(text)) == 20000
+
+
+def test_binary_files(lisp):
+    data = bytes(range(256)) * 1000
+    sum_octets = lisp.eval( ('lambda', ('stream',),
+                             ('loop', 'for', 'octet', '=', ('read-byte', 'stream', (), ()),
+                              'while', 'octet', 'sum', 'octet')) )
+    assert sum_octets(io.BytesIO(data)) == sum(data)
+
+
+def test_iterators(lisp):
+    sum_items = lisp.eval( ('lambda', ('iterator',),
+                            ('let', (('sum', 0),),
+                             ('cl4py:do-items', ('item', 'iterator', 'sum'),
+                              ('incf', 'sum', 'item')))) )
+    assert sum_items(iter(range(10000))) == sum(range(10000))
+    assert sum_items(i * i for i in range(10)) == 285
+    next_item = lisp.function('cl4py:next-item')
+    assert next_item(iter(['a', 'b'])) == 'a'
@@ -0,0 +1,100 @@
+import time
+import threading
+import pytest
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module", params=[True, False], ids=['threads', 'inline'])
+def lisp(request):
+    return cl4py.Lisp(threads=request.param)
+
+
+def test_timeout(lisp):
+    start = time.monotonic()
+    with pytest.raises(cl4py.LispTimeoutError):
+        lisp.eval( ('loop',), timeout=0.5 )
+    assert time.monotonic() - start < 5
+    # The Lisp process is still usable afterwards.
+    assert lisp.eval( ('+', 2, 3), timeout=5 ) == 5
+
+
+def test_unwind_protect(lisp):
+    lisp.eval( ('defvar', '*cleaned-up*', ()) )
+    with pytest.raises(cl4py.LispTimeoutError):
+        lisp.eval( ('unwind-protect', ('loop',),
+                    ('setf', '*cleaned-up*', 't')), timeout=0.5 )
+    assert lisp.eval( ('progn', '*cleaned-up*') ) == True
+
+
+def test_future(lisp):
+    future = lisp.submit( ('+', 1, 2) )
+    assert future.result(timeout=5) == 3
+
+
+def test_cancel_running_future(lisp):
+    future = lisp.submit( ('loop',) )
+    time.sleep(0.5)
+    assert future.running()
+    assert future.cancel()
+    with pytest.raises(cl4py.LispCancelledError):
+        future.result(timeout=5)
+    assert lisp.eval( ('*', 2, 3) ) == 6
+
+
+def test_slow_unwinding(lisp):
+    if not lisp.threaded:
+        return
+    # The cancelled request only unwinds after the interrupt grace period.
+    # It raises nonetheless, and neither the Lisp process nor the other
+    # request is affected.
+    future = lisp.submit( ('sb-sys:without-interrupts', ('sleep', 3), 1) )
+    other = lisp.submit( ('progn', ('sleep', 4), 2) )
+    time.sleep(0.5)
+    assert future.cancel()
+    start = time.monotonic()
+    with pytest.raises(cl4py.LispCancelledError):
+        future.result(timeout=10)
+    assert time.monotonic() - start < lisp.interrupt_grace + 1
+    assert other.result(timeout=10) == 2
+    assert lisp.alive
+    assert lisp.eval( ('+', 1, 2) ) == 3
+
+
+def test_slow_unwinding_timeout(lisp):
+    if not lisp.threaded:
+        return
+    start = time.monotonic()
+    with pytest.raises(cl4py.LispTimeoutError):
+        lisp.eval( ('sb-sys:without-interrupts', ('sleep', 3)), timeout=0.2 )
+    assert time.monotonic() - start < lisp.interrupt_grace + 1.5
+    assert lisp.eval( ('+', 1, 2) ) == 3
+
+
+def test_kill_after_grace():
+    lisp = cl4py.Lisp(threads=False, interrupt_grace=0.5)
+    start = time.monotonic()
+    with pytest.raises(cl4py.LispTimeoutError):
+        lisp.eval( ('sb-sys:without-interrupts', ('sleep', 5)), timeout=0.2 )
+    assert time.monotonic() - start < 4
+    assert not lisp.alive
+
+
+def test_innermost_request():
+    lisp = cl4py.Lisp(threads=False)
+    futures = []
+    cancelled = []
+    def nested():
+        # The outer request is not the innermost one while the nested
+        # request is evaluated, so it cannot be interrupted.
+        timer = threading.Timer(0.3, lambda: cancelled.append(futures[0].cancel()))
+        timer.start()
+        value = lisp.eval( ('progn', ('sleep', 1), 1) )
+        timer.join()
+        return value
+    futures.append(lisp.submit( ('+', ('funcall', nested), 1) ))
+    assert futures[0].result(timeout=10) == 2
+    assert cancelled == [False]
@@ -0,0 +1,49 @@
+import numpy
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp()
+
+
+def test_memoize(lisp):
+    lisp.eval( ('defvar', 'cl-user::*calls*', 0) )
+    lisp.eval( ('defun', 'cl-user::count-calls', ('x',),
+                ('incf', 'cl-user::*calls*'), ('length', 'x')) )
+    count_calls = lisp.memoize('cl-user::count-calls', maxsize=2)
+    assert count_calls(cl4py.List(1, 2, 3)) == 3
+    assert count_calls(cl4py.List(1, 2, 3)) == 3
+    assert count_calls(numpy.arange(5)) == 5
+    assert count_calls(numpy.arange(5)) == 5
+    assert lisp.eval( cl4py.Symbol('*CALLS*', 'COMMON-LISP-USER') ) == 2
+    info = count_calls.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (2, 2, 2)
+    assert count_calls.invalidate(numpy.arange(5))
+    count_calls(numpy.arange(5))
+    lisp.invalidate_memoized()
+    count_calls(cl4py.List(1, 2, 3))
+    assert lisp.eval( cl4py.Symbol('*CALLS*', 'COMMON-LISP-USER') ) == 4
+
+
+def test_ttl(lisp):
+    random = lisp.memoize('random', ttl=0)
+    random(10)
+    random(10)
+    assert random.cache_info().hits == 0
+
+
+class Vector(numpy.ndarray):
+    pass
+
+
+def test_canonical_form_of_subclasses():
+    A = numpy.arange(5).view(Vector)
+    assert cl4py.memoize.canonical_form(A) == cl4py.memoize.canonical_form(numpy.arange(5))
+    B = numpy.empty(2, dtype=object).view(Vector)
+    B[:] = [1, 'x']
+    assert cl4py.memoize.canonical_form(B)
@@ -0,0 +1,43 @@
+from pytest import fixture
+import cl4py
+from cl4py.metrics import Histogram
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp(metrics=True)
+
+
+def test_hook(lisp):
+    recorded = []
+    lisp.metrics.add_hook(recorded.append)
+    lisp.eval( ('progn', ('cl:princ', 'foo'), ('make-list', 1000)) )
+    lisp.metrics.remove_hook(recorded.append)
+    (metrics,) = recorded
+    assert metrics.output_size == 3
+    assert metrics.lisp_consed > 0
+    assert metrics.total >= metrics.lispify + metrics.send + metrics.wait
+    assert metrics.lisp_eval >= 0
+
+
+def test_summary(lisp):
+    lisp.metrics.reset()
+    for i in range(10):
+        lisp.eval( ('+', i, 1) )
+    summary = lisp.metrics.summary()
+    assert summary['total']['count'] == 10
+    assert summary['total']['min'] <= summary['total']['p50'] <= summary['total']['max']
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in [0, 1, 2, 3, 4, 100]:
+        histogram.add(value)
+    assert histogram.count == 6
+    assert histogram.buckets == {None: 1, 0: 1, 1: 1, 2: 2, 7: 1}
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.6) == 4
+    assert histogram.quantile(1.0) == 100
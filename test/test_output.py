@@ -0,0 +1,54 @@
+import time
+import logging
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+def test_output_callback():
+    chunks = []
+    lisp = cl4py.Lisp(output=chunks.append)
+    cl = lisp.find_package('CL')
+    cl.write_line("foo")
+    cl.princ("bar")
+    assert chunks == ["foo\n", "bar"]
+    assert lisp.eval( ('progn', ('princ', 42), 42) ) == 42
+    assert chunks[-1] == "42"
+
+
+def test_output_limit():
+    chunks = []
+    lisp = cl4py.Lisp(output=chunks.append, output_limit=10)
+    lisp.eval( ('dotimes', ('i', 100), ('princ', 123)) )
+    assert chunks[0] == "1231231231"
+    assert "truncated" in chunks[1]
+    chunks.clear()
+    lisp.eval( ('princ', 456) )
+    assert chunks == ["456"]
+
+
+def test_output_logger(caplog):
+    lisp = cl4py.Lisp(output=logging.getLogger('cl4py-test'))
+    with caplog.at_level(logging.INFO):
+        lisp.find_package('CL').write_line("hello")
+    assert "hello" in caplog.text
+
+
+def test_stderr_is_drained():
+    lines = []
+    lisp = cl4py.Lisp(stderr=lines.append, stderr_lines=3)
+    # Much more output than fits into the pipe, so Lisp would block forever
+    # if standard error was not drained while it is evaluating.
+    lisp.eval( ('dotimes', ('i', 10000),
+                ('format', '*error-output*', "~D ~A~%", 'i',
+                 ('make-string', 100, ':initial-element', ('code-char', 120)))),
+               timeout=60 )
+    lisp.eval( ('finish-output', '*error-output*') )
+    deadline = time.monotonic() + 10
+    while len(lines) < 10000 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(lines) == 10000
+    assert lines[0] == '0 ' + 'x' * 100 + '\n'
+    assert lines[-1] == '9999 ' + 'x' * 100 + '\n'
+    assert list(lisp.stderr_tail) == lines[-3:]
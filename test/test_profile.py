@@ -0,0 +1,32 @@
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp()
+
+
+def busy_loop():
+    return ('loop', 'repeat', 20000000, 'sum', ('random', 10))
+
+
+def test_cpu_profile(lisp):
+    with lisp.profile(mode='cpu', sample_interval=0.001) as report:
+        lisp.eval( busy_loop() )
+    if report.supported:
+        assert report.flat
+        assert all(entry['self'] <= entry['total'] for entry in report.flat)
+        assert report.graph
+    else:
+        assert report.flat == []
+
+
+def test_alloc_profile(lisp):
+    with lisp.profile(mode='alloc') as report:
+        lisp.eval( ('loop', 'repeat', 100000, 'collect', ('make-list', 10)) )
+    assert report.mode == 'alloc'
+    assert report.supported is not None
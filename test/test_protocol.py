@@ -0,0 +1,105 @@
+import numpy
+import pytest
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module", params=[True, False], ids=['framed', 'text'])
+def lisp(request):
+    return cl4py.Lisp(framed=request.param)
+
+
+def test_protocol(lisp):
+    assert lisp.eval( ('+', 2, 3) ) == 5
+    assert lisp.eval( ('values', 1, 2) ) == (1, 2)
+
+
+def test_arrays(lisp):
+    for A in [numpy.arange(12, dtype='float64').reshape(3, 4),
+              numpy.arange(-5, 5, dtype='int32'),
+              numpy.arange(10, dtype='uint8'),
+              numpy.asfortranarray(numpy.ones((2, 3), dtype='float32')),
+              numpy.array([1+2j, 3-4j], dtype='complex128')]:
+        B = lisp.eval( ('identity', cl4py.Quote(A)) )
+        assert B.dtype == A.dtype
+        assert numpy.array_equal(A, B)
+
+
+def test_object_arrays(lisp):
+    A = numpy.empty((2, 3), dtype=object)
+    A[0] = [1, 'foo', 2.5]
+    A[1] = [cl4py.List(1, 2), None, 3]
+    B = lisp.eval( ('identity', cl4py.Quote(A)) )
+    assert B.dtype == object and B.shape == (2, 3)
+    assert B[0, 1] == 'foo' and B[1, 0] == cl4py.List(1, 2)
+    assert lisp.eval( ('array-dimensions', cl4py.Quote(A)) ) == cl4py.List(2, 3)
+    assert lisp.eval( ('aref', cl4py.Quote(A), 1, 2) ) == 3
+
+
+def test_strings(lisp):
+    identity = lisp.function('identity')
+    for string in ['', 'foo', '"', '\\', 'a"b\\c"', 'x' * 100000]:
+        assert identity(string) == string
+
+
+def test_decoding(lisp):
+    identity = lisp.function('identity')
+    for data in [0, -12, 2**100, 1.5, 'a"b', cl4py.List(1, cl4py.List(2, 3), 'x'),
+                 cl4py.DottedList(1, 2, 3), [1, [2, 'foo']], {1: 'one', 'two': 2},
+                 cl4py.Keyword('FOO'), cl4py.Symbol('CAR', 'COMMON-LISP'), True, ()]:
+        assert identity(data) == data
+    table = lisp.eval( ('make-hash-table',) )
+    assert identity(table) is table
+    assert lisp.eval( ('symbol-name', cl4py.Quote(cl4py.Symbol('NEW-SYMBOL'))) ) \
+        == 'NEW-SYMBOL'
+    with pytest.raises(RuntimeError):
+        lisp.eval( cl4py.Symbol('FOO', 'NO-SUCH-PACKAGE') )
+
+
+def test_floats(lisp):
+    identity = lisp.function('identity')
+    for x in [0.1, 1 / 3, 1e300, 5e-324, 1e16, -2.5e-7, float('inf'), float('-inf')]:
+        assert identity(x) == x
+        assert identity(numpy.float32(x)) == numpy.float32(x)
+    for x in [65504, 0.1, 1 / 3, 6e-8, -2.5e-5, float('inf')]:
+        assert identity(numpy.float16(x)) == numpy.float16(x)
+    for x in [0.1, 1 / 3, -2.5e-7, float('inf')]:
+        assert identity(numpy.longdouble(x)) == float(numpy.longdouble(x))
+    assert numpy.copysign(1, identity(-0.0)) == -1
+    assert numpy.isnan(identity(float('nan')))
+    assert lisp.eval( ('>', float('inf'), 1e308) ) is True
+    assert identity(complex(float('inf'), 0.1)) == complex(float('inf'), 0.1)
+    A = numpy.array([numpy.nan, numpy.inf, -numpy.inf, 0.1])
+    assert numpy.array_equal(identity(A), A, equal_nan=True)
+
+
+def test_shared_structure(lisp):
+    shared = lisp.eval( ('let', (('x', ('list', 1, 2)),), ('list', 'x', 'x')) )
+    assert shared.car is shared.cdr.car
+    circular = lisp.eval( ('let', (('x', ('list', 1)),), ('setf', ('cdr', 'x'), 'x')) )
+    assert circular.cdr is circular
+
+
+def test_error(lisp):
+    with pytest.raises(RuntimeError):
+        lisp.eval( ('error', ('cl:princ', 'foo')) )
+    assert lisp.eval( ('length', cl4py.Quote(numpy.zeros(7))) ) == 7
+
+
+def test_decode_error():
+    lisp = cl4py.Lisp()
+    def fail(r, s, c, n):
+        r.read_aux(s)
+        raise KeyError(n)
+    lisp.readtable.set_dispatch_macro_character('#', 'C', fail)
+    with pytest.raises(cl4py.DecodeError):
+        lisp.eval( ('complex', 1, 2) )
+    # Only the request whose result could not be decoded fails.
+    assert lisp.alive
+    assert lisp.eval( ('+', 2, 3) ) == 5
+    with pytest.raises(cl4py.DecodeError):
+        lisp.eval( ('list', 1, ('complex', 1, 2)) )
+    assert lisp.eval( ('list', 1, 2) ) == cl4py.List(1, 2)
@@ -0,0 +1,30 @@
+from pytest import fixture
+import cl4py
+from cl4py.recording import read_recording, replay
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp()
+
+
+def test_recording(lisp, tmp_path):
+    path = tmp_path / 'session.cl4py'
+    lisp.start_recording(path)
+    for i in range(10):
+        lisp.eval( ('+', i, 1) )
+    lisp.eval( ('length', b'abc') )
+    lisp.stop_recording()
+    records = read_recording(path)
+    requests = [r for r in records if r.kind == 'eval']
+    results = [r for r in records if r.kind == 'result']
+    assert len(requests) == len(results) == 11
+    assert all(r.text for r in requests)
+    assert all(a.time <= b.time for a, b in zip(records, records[1:]))
+    report = replay(records, lisp, speed=None)
+    assert report['requests'] == 11
+    assert report['errors'] == 0
+    assert report['latency']['count'] == 11
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import pytest
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def address():
+    address = os.path.join(tempfile.mkdtemp(), 'cl4py.sock')
+    server = cl4py.serve(address)
+    yield address
+    server.kill()
+    server.wait()
+
+
+def test_connect(address):
+    with cl4py.Lisp(address=address) as lisp:
+        assert lisp.eval( ('+', 2, 3) ) == 5
+
+
+def test_connections(address):
+    a = cl4py.Lisp(address=address)
+    b = cl4py.Lisp(address=address)
+    a.eval( ('defpackage', 'cl4py-server-test', ('use', 'cl')) )
+    a.eval( ('in-package', 'cl4py-server-test') )
+    # Each connection has its own current package.
+    assert a.package == 'CL4PY-SERVER-TEST'
+    b.eval( ('+', 1, 1) )
+    assert b.package != 'CL4PY-SERVER-TEST'
+    # But both connections share the same Lisp image.
+    a.eval( ('defparameter', 'cl-user::*shared*', 42) )
+    assert b.eval( ('progn', 'cl-user::*shared*') ) == 42
+    # Handles remain valid while another connection comes and goes.
+    f = a.eval( ('lambda', ('x',), ('*', 'x', 2)) )
+    b.terminate()
+    assert f(21) == 42
+    a.terminate()
+
+
+def test_pool(address):
+    lisp = cl4py.connect(address)
+    lisp.close()
+    assert cl4py.connect(address) is lisp
+    lisp.close()
+
+
+def test_pool_resets_connections(address):
+    lisp = cl4py.connect(address)
+    lisp.eval( ('defpackage', 'cl4py-pool-test', ('use', 'cl')) )
+    lisp.eval( ('in-package', 'cl4py-pool-test') )
+    lisp.start_recording(os.path.join(tempfile.mkdtemp(), 'pool.rec'))
+    lisp.close()
+    assert lisp.package == 'COMMON-LISP-USER'
+    assert lisp.recorder is None
+    assert cl4py.connect(address) is lisp
+    lisp.close()
+
+
+def test_pool_arguments(address):
+    cl4py.connect(address).close()
+    with pytest.raises(ValueError):
+        cl4py.connect(address, threads=False)
@@ -0,0 +1,33 @@
+import itertools
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module", params=[True, False], ids=['threads', 'inline'])
+def lisp(request):
+    return cl4py.Lisp(threads=request.param)
+
+
+def test_stream(lisp):
+    items = lisp.stream( ('dotimes', ('i', 1000), ('cl4py:emit', 'i')),
+                         window=2, chunk_size=10 )
+    assert list(items) == list(range(1000))
+    assert list(lisp.stream( () )) == []
+
+
+def test_stream_interleaved(lisp):
+    items = lisp.stream( ('dotimes', ('i', 100), ('cl4py:emit', ('list', 'i'))),
+                         window=1, chunk_size=1 )
+    for i, item in enumerate(items):
+        assert item == cl4py.List(i)
+        assert lisp.eval( ('+', i, 1) ) == i + 1
+
+
+def test_stream_close(lisp):
+    items = lisp.stream( ('loop', ('cl4py:emit', 1)), window=2, chunk_size=3 )
+    assert list(itertools.islice(items, 10)) == [1] * 10
+    items.close()
+    assert lisp.eval( ('+', 1, 2) ) == 3
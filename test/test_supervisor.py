@@ -0,0 +1,45 @@
+import os
+import time
+import signal
+import pytest
+import cl4py
+
+
+def define_answer(lisp):
+    lisp.eval( ('defparameter', 'cl-user::*answer*', 42) )
+
+
+@pytest.mark.parametrize('standby', [False, True])
+def test_respawn(standby):
+    with cl4py.Supervisor(init=define_answer, standby=standby) as supervisor:
+        answer = cl4py.Symbol('*ANSWER*', 'COMMON-LISP-USER')
+        assert supervisor.eval(answer) == 42
+        table = supervisor.eval( ('make-hash-table',) )
+        supervisor.lisp.process.kill()
+        supervisor.lisp.process.wait()
+        assert supervisor.eval(answer) == 42
+        assert supervisor.respawns == 1
+        with pytest.raises(cl4py.StaleHandleError):
+            supervisor.function('hash-table-count')(table)
+        with pytest.raises(cl4py.StaleHandleError):
+            supervisor.eval( ('hash-table-count', table) )
+
+
+def test_terminated_error():
+    lisp = cl4py.Lisp()
+    lisp.process.kill()
+    lisp.process.wait()
+    with pytest.raises(cl4py.LispTerminatedError):
+        lisp.eval( ('+', 1, 2) )
+
+
+def test_hang_detection():
+    with cl4py.Supervisor(check_interval=0.2, hang_timeout=0.5) as supervisor:
+        lisp = supervisor.lisp
+        os.kill(lisp.process.pid, signal.SIGSTOP)
+        deadline = time.monotonic() + 10
+        while supervisor.respawns == 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert supervisor.respawns == 1
+        assert not lisp.alive
+        assert supervisor.eval( ('+', 1, 2) ) == 3
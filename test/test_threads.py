@@ -0,0 +1,51 @@
+import time
+import threading
+import pytest
+from pytest import fixture
+import cl4py
+
+# pytest forces violation of this pylint rule
+# pylint: disable=redefined-outer-name
+
+
+@fixture(scope="module")
+def lisp():
+    return cl4py.Lisp()
+
+
+def test_concurrent_futures(lisp):
+    if not lisp.threaded:
+        return
+    start = time.monotonic()
+    futures = [lisp.submit( ('progn', ('sleep', 1), i) ) for i in range(4)]
+    assert [future.result(timeout=10) for future in futures] == [0, 1, 2, 3]
+    assert time.monotonic() - start < 3
+
+
+def test_concurrent_threads(lisp):
+    results = {}
+    def run(i):
+        results[i] = lisp.eval( ('*', i, i) )
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert results == {i: i * i for i in range(8)}
+
+
+def test_inline():
+    lisp = cl4py.Lisp(threads=False)
+    assert not lisp.threaded
+    futures = [lisp.submit( ('+', i, 1) ) for i in range(4)]
+    assert [future.result(timeout=10) for future in futures] == [1, 2, 3, 4]
+
+
+def test_unprintable_result(lisp):
+    lisp.eval( ('defclass', 'unprintable', (), ()) )
+    lisp.eval( ('defmethod', 'cl4py::pyprint-write', (('object', 'unprintable'), 'stream'),
+                ('error', "Cannot print ~S.", 'object')) )
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            lisp.eval( ('make-instance', ('quote', 'unprintable')) )
+    assert lisp.eval( ('+', 1, 2) ) == 3